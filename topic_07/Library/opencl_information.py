@@ -18,6 +18,13 @@ class opencl_information:
     def __init__(self):
         pass
 
+    def get_devices(self):
+        devices = []
+        for i,platformNum in enumerate(cl.get_platforms()):
+            for j,device in enumerate(platformNum.get_devices()):
+                devices.append((i, j, device))
+        return devices
+
     def print_platforms(self):
         for i,platformNum in enumerate(cl.get_platforms()):
             print('Platform %d - Name %s, Vendor %s' %(i,platformNum.name,platformNum.vendor))
@@ -241,43 +241,44 @@ bool is_target_met(unsigned int *hash, unsigned int *target)
 }
 
 /**
- * Using a sequential search find a nonce that meets the target
- * requirement.
- *
- * NOTE: For real world applications, a random search pattern should
- * be used instead to find the nonce.
+ * Search for a nonce that meets the target requirement, starting from the
+ * SHA-256 midstate of the complete 64 byte chunks of the block data. Only
+ * the final one or two chunks, which hold the nonce, are hashed for every
+ * nonce. The tail holds those chunks as big endian words with the nonce
+ * bytes set to zero, and the padding and message length already applied.
  */
-kernel void mine_sequential(
+kernel void mine_midstate(
     global unsigned long *seed,
     global unsigned int *window_size,
-    global unsigned int *block_data,
-    global int *block_data_len,
+    global unsigned int *midstate,
+    global unsigned int *tail,
+    global int *tail_info,
     global unsigned long *nonce,
-    global unsigned int *target,
-    global unsigned int *output_hash)
+    global unsigned int *target)
 {
     // set the start index for the thread
-    unsigned long start_nonce = *seed + (get_global_id(0) * *window_size);
+    unsigned long current_nonce = *seed + (get_global_id(0) * *window_size);
 
-    if (get_global_id(0) == 0)
-          *nonce = 0;
+    // the number of words in the tail and the offset of the nonce in bytes
+    int tail_words = tail_info[0];
+    int nonce_offset = tail_info[1];
 
-    // initialize the input buffer
-    __private unsigned int input_buffer[256];
-    
-    for (int i = 0; i < *block_data_len / 4; i++) {
-        input_buffer[i] = block_data[i];
-    }
-
-    // copy the target to local memory
+    // copy the constant input to private memory
+    unsigned int loc_midstate[8];
     unsigned int loc_target[8];
     for (int i = 0; i < 8; i++) {
+        loc_midstate[i] = midstate[i];
         loc_target[i] = target[i];
     }
 
-    // attempt a sequation search for the nonce
+    unsigned int loc_tail[32];
+    for (int i = 0; i < tail_words; i++) {
+        loc_tail[i] = tail[i];
+    }
+
+    unsigned int W[32];
+    unsigned int state[8];
     unsigned int hash[8];
-    unsigned long current_nonce = start_nonce;
 
     for (unsigned int i = 0; i < *window_size; i++) {
         // if the nonce has been set in another thread stop the search
@@ -285,23 +286,33 @@ kernel void mine_sequential(
             return;
         }
 
-        // add the nonce to the input buffer
-        input_buffer[*block_data_len / 4] = current_nonce & 0xFFFFFFFF;
-        input_buffer[(*block_data_len + 4) / 4] = (current_nonce >> 32);
+        // add the little endian nonce bytes to the big endian tail words
+        for (int j = 0; j < tail_words; j++) {
+            W[j] = loc_tail[j];
+        }
+        for (int j = 0; j < 8; j++) {
+            int position = nonce_offset + j;
+            W[position >> 2] |= ((unsigned int)(current_nonce >> (j * 8)) & 0xff)
+                << ((3 - (position & 3)) * 8);
+        }
 
-        // get the hash value
-        hash_private(input_buffer, *block_data_len + 8, hash);
+        // compress the final chunks from the midstate
+        for (int j = 0; j < 8; j++) {
+            state[j] = loc_midstate[j];
+        }
+        sha256_process2(W, state);
+        if (tail_words > 16) {
+            sha256_process2(W + 16, state);
+        }
+
+        // store the digest in the byte order used by is_target_met
+        for (int j = 0; j < 8; j++) {
+            hash[j] = SWAP(state[j]);
+        }
 
         // check if the hash is less than or equal to the target
         if (is_target_met(hash, loc_target)) {
             *nonce = current_nonce;
-
-            if (output_hash != NULL) {
-                for (int j = 0; j < 8; j++) {
-                    output_hash[j] = hash[j];
-                }
-            }
-
             return;
         }
 
@@ -309,5 +320,3 @@ kernel void mine_sequential(
         current_nonce++;
     }
 }
-
-
@@ -0,0 +1,213 @@
+"""
+This module implements benchmarks used to measure the performance of the
+Zimcoin node.
+
+Usage:
+    python benchmarks.py memory [block_count]
+    python benchmarks.py codec [block_count]
+    python benchmarks.py hashrate [seconds] [opencl|cpu]
+    python benchmarks.py tune [platform_id] [device_id]
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import tracemalloc
+from persistence import dict_to_block, block_to_dict, block_to_bytes, bytes_to_block
+
+
+def create_block_dict(height : int, transaction_count : int = 25) -> dict:
+    """
+    Create a block dictionary, as stored by the persistence, filled with
+    random data of the correct sizes.
+
+    Parameters:
+        height (int): The height of the block.
+        transaction_count (int): The number of transactions in the block.
+
+    Returns:
+        dict: The block dictionary.
+    """
+    transactions = [dict(
+        sender_hash=os.urandom(20).hex(),
+        recipient_hash=os.urandom(20).hex(),
+        sender_public_key=os.urandom(88).hex(),
+        amount=1_000 + i,
+        fee=10,
+        nonce=height,
+        signature=os.urandom(71).hex(),
+        txid=os.urandom(32).hex()) for i in range(transaction_count)]
+
+    return dict(
+        previous=os.urandom(32).hex(),
+        height=height,
+        miner=os.urandom(20).hex(),
+        transactions=transactions,
+        timestamp=1_650_000_000 + height,
+        difficulty=2 ** 40,
+        block_id=os.urandom(32).hex(),
+        nonce=height * 7919)
+
+
+def measure_memory(create, count : int) -> float:
+    """
+    Measure the memory allocated by a function and kept alive by its
+    result, divided by a count.
+    """
+    gc.collect()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    result = create()
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del result
+    return (end - start) / count
+
+
+def measure_block_memory(block_count : int = 1000,
+                         transaction_count : int = 25) -> tuple:
+    """
+    Measure the memory used per block to hold a chain of decoded blocks,
+    and to hold the same blocks in their packed form.
+
+    Parameters:
+        block_count (int): The number of blocks to decode.
+        transaction_count (int): The number of transactions per block.
+
+    Returns:
+        tuple: The number of bytes allocated per decoded block and per
+            packed block.
+    """
+    block_dicts = [create_block_dict(height, transaction_count)
+                   for height in range(block_count)]
+
+    decoded_memory = measure_memory(
+        lambda: [dict_to_block(block_dict) for block_dict in block_dicts],
+        block_count)
+
+    blocks = [dict_to_block(block_dict) for block_dict in block_dicts]
+    packed_memory = measure_memory(
+        lambda: [block.pack() for block in blocks],
+        block_count)
+
+    return decoded_memory, packed_memory
+
+
+def measure_codec(block_count : int = 1000,
+                  transaction_count : int = 25) -> dict:
+    """
+    Measure the encode and decode throughput of the JSON and binary block
+    codecs, and the encoded size of the blocks.
+
+    Parameters:
+        block_count (int): The number of blocks to encode and decode.
+        transaction_count (int): The number of transactions per block.
+
+    Returns:
+        dict: The (bytes per block, blocks encoded per second, blocks
+            decoded per second) by codec name.
+    """
+    blocks = [dict_to_block(create_block_dict(height, transaction_count))
+              for height in range(block_count)]
+
+    codecs = {
+        'json': (lambda block: json.dumps(block_to_dict(block)),
+                 lambda data: dict_to_block(json.loads(data))),
+        'binary': (block_to_bytes, bytes_to_block),
+    }
+
+    results = {}
+    for name, (encode, decode) in codecs.items():
+        start = time.perf_counter()
+        encoded = [encode(block) for block in blocks]
+        encode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        decoded = [decode(data) for data in encoded]
+        decode_time = time.perf_counter() - start
+
+        assert decoded[-1].block_id == blocks[-1].block_id
+        size = sum(len(data) for data in encoded) / block_count
+        results[name] = (size,
+                         block_count / encode_time,
+                         block_count / decode_time)
+
+    return results
+
+
+def measure_hashrate(seconds : float = 5.0, pipeline_depth : int = 2,
+                     transaction_count : int = 25,
+                     window_size : int = 10,
+                     backend : str = 'opencl') -> float:
+    """
+    Measure the hashrate of the OpenCL miner on the first device, or of
+    the CPU miner, by mining a block that cannot be found until the
+    cutoff time.
+
+    Parameters:
+        seconds (float): The time to mine for.
+        pipeline_depth (int): The number of kernel launches kept in flight.
+        transaction_count (int): The number of transactions in the block.
+        window_size (int): The number of nonces tried by each work item.
+        backend (str): The mining backend, 'opencl' or 'cpu'.
+
+    Returns:
+        float: The number of hashes per second.
+    """
+    block = dict_to_block(create_block_dict(1, transaction_count))
+    if backend == 'cpu':
+        from cpu_miner import CpuMiner
+        miner = CpuMiner()
+    else:
+        from zimcoin_miner import ZimcoinMiner
+        miner = ZimcoinMiner(0, 0, window_size=window_size, pipeline_depth=pipeline_depth)
+
+    # warm up the device before the measurement
+    miner.mine(block.previous, 1, block.miner, block.transactions,
+               block.timestamp, 2 ** 127, time.time() + 0.5)
+
+    start = time.perf_counter()
+    miner.mine(block.previous, 1, block.miner, block.transactions,
+               block.timestamp, 2 ** 127, time.time() + seconds)
+    hashrate = miner.hash_count / (time.perf_counter() - start)
+    miner.close()
+    return hashrate
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+    elif sys.argv[1] == 'memory':
+        BLOCK_COUNT = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        for TRANSACTION_COUNT in [0, 25]:
+            DECODED, PACKED = measure_block_memory(BLOCK_COUNT, TRANSACTION_COUNT)
+            print(f'{TRANSACTION_COUNT:>2} transactions: {DECODED:,.0f} bytes per '
+                  f'block, {PACKED:,.0f} bytes per packed block')
+    elif sys.argv[1] == 'codec':
+        BLOCK_COUNT = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        for NAME, (SIZE, ENCODE, DECODE) in measure_codec(BLOCK_COUNT).items():
+            print(f'{NAME:>6}: {SIZE:,.0f} bytes per block, {ENCODE:,.0f} blocks/s '
+                  f'encoded, {DECODE:,.0f} blocks/s decoded')
+    elif sys.argv[1] == 'hashrate':
+        SECONDS = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+        if len(sys.argv) > 3 and sys.argv[3] == 'cpu':
+            HASHRATE = measure_hashrate(SECONDS, backend='cpu')
+            print(f'cpu: {HASHRATE:,.0f} hashes/s')
+        else:
+            for PIPELINE_DEPTH in [1, 2, 3]:
+                HASHRATE = measure_hashrate(SECONDS, PIPELINE_DEPTH)
+                print(f'pipeline depth {PIPELINE_DEPTH}: {HASHRATE:,.0f} hashes/s')
+    elif sys.argv[1] == 'tune':
+        from zimcoin_miner import ZimcoinMiner
+        PLATFORM_ID = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+        DEVICE_ID = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+        MINER = ZimcoinMiner(PLATFORM_ID, DEVICE_ID, use_profile=False)
+        for GLOBAL_SIZE, LOCAL_SIZE, WINDOW_SIZE, HASHRATE, LATENCY in MINER.tune():
+            print(f'global {GLOBAL_SIZE:>7}, local {str(LOCAL_SIZE):>4}, window {WINDOW_SIZE:>7}: '
+                  f'{HASHRATE:>13,.0f} hashes/s, {LATENCY * 1000:>9,.1f} ms')
+        print(f'saved {MINER.profile} to {MINER.profile_file()}')
+    else:
+        print("Unknown benchmark")
@@ -4,8 +4,138 @@ chain of blocks.
 """
 
 import logging
-from copy import deepcopy
-from blocks import Block
+from blocks import Block, UserState, UserStateOverlay
+
+# the number of blocks below the tip for which side branches are kept
+MAX_SIDE_BRANCH_DEPTH = 100
+
+
+class BlockUndo:
+    """
+    This class records what is needed to undo a block that was applied
+    to the blockchain state.
+    """
+    def __init__(self, previous_user_states : dict, difficulty : int):
+        """
+        Initialize the undo record.
+
+        Parameters:
+            previous_user_states (dict): The (balance, nonce) of every
+                user touched by the block before it was applied, or None
+                for users that were created by the block.
+            difficulty (int): The difficulty the block added to the
+                total difficulty of the chain.
+        """
+        self.previous_user_states = previous_user_states
+        self.difficulty = difficulty
+
+
+class BlockTreeNode:
+    """
+    This class represents a block in the block tree.
+    """
+    def __init__(self, block : Block, cumulative_difficulty : int):
+        """
+        Initialize the block tree node.
+
+        Parameters:
+            block (Block): The block.
+            cumulative_difficulty (int): The total difficulty of the
+                chain ending with the block.
+        """
+        self.block = block
+        self.cumulative_difficulty = cumulative_difficulty
+
+
+class BlockTree:
+    """
+    This class indexes the known blocks by block id, including the
+    blocks on side branches that are not part of the longest chain.
+    """
+    def __init__(self):
+        """
+        Initialize the block tree.
+        """
+        self.nodes = {}
+        self.side_block_ids = set()
+
+    def __contains__(self, block_id : bytes) -> bool:
+        return block_id in self.nodes
+
+    def get(self, block_id : bytes) -> BlockTreeNode:
+        """
+        Get the node of a block.
+
+        Parameters:
+            block_id (bytes): The id of the block.
+
+        Returns:
+            BlockTreeNode: The node or None if the block is not known.
+        """
+        return self.nodes.get(block_id)
+
+    def add(self, block : Block, cumulative_difficulty : int,
+            side_branch : bool = False) -> BlockTreeNode:
+        """
+        Add a block to the tree.
+
+        Parameters:
+            block (Block): The block to add.
+            cumulative_difficulty (int): The total difficulty of the
+                chain ending with the block.
+            side_branch (bool): True if the block is not on the longest
+                chain.
+
+        Returns:
+            BlockTreeNode: The node of the block.
+        """
+        node = BlockTreeNode(block, cumulative_difficulty)
+        self.nodes[block.block_id] = node
+        self.set_side_branch(block.block_id, side_branch)
+        return node
+
+    def set_side_branch(self, block_id : bytes, side_branch : bool) -> None:
+        """
+        Mark a block as being on a side branch or on the longest chain.
+        """
+        if side_branch:
+            self.side_block_ids.add(block_id)
+        else:
+            self.side_block_ids.discard(block_id)
+
+    def remove(self, block_id : bytes) -> None:
+        """
+        Remove a block from the tree.
+        """
+        self.nodes.pop(block_id, None)
+        self.side_block_ids.discard(block_id)
+
+    def side_branch_to(self, block_id : bytes) -> list:
+        """
+        Get the side branch blocks leading up to and including a block.
+
+        Parameters:
+            block_id (bytes): The id of the last block in the branch.
+
+        Returns:
+            list: The side branch blocks in ascending height order, empty
+                if the block is not on a side branch.
+        """
+        branch = []
+        while block_id in self.side_block_ids:
+            block = self.nodes[block_id].block
+            branch.append(block)
+            block_id = block.previous
+        branch.reverse()
+        return branch
+
+    def prune(self, min_height : int) -> None:
+        """
+        Remove the side branch blocks below a height.
+        """
+        for block_id in list(self.side_block_ids):
+            if self.nodes[block_id].block.height < min_height:
+                self.remove(block_id)
 
 
 class BlockchainState:
@@ -28,6 +158,20 @@ class BlockchainState:
         self.user_states = user_states
         self.total_difficulty = total_difficulty
 
+        # the undo records of the applied blocks by block id
+        self.undo_journal = {}
+
+        # the blocks on the longest chain and on side branches
+        self.block_tree = BlockTree()
+
+        # the users changed by the blocks applied or undone since the last
+        # call to pop_touched_users
+        self.touched_users = set()
+
+        # False while a branch is reorganized, so a rejected branch cannot
+        # prune the undo records of the longest chain
+        self.pruning = True
+
     def calculate_difficulty(self) -> int:
         """
         Calculate the difficulty of the chain.
@@ -61,12 +205,15 @@ class BlockchainState:
 
         return total_difficulty
 
-    def verify_and_apply_block(self, block : Block) -> bool:
+    def verify_and_apply_block(self, block : Block,
+                               verify_signatures : bool = True) -> bool:
         """
         Verify and apply a block to the blockchain state.
 
         Parameters:
             block (Block): The block to verify and apply.
+            verify_signatures (bool): False if the transaction signatures
+                were already verified by a SignatureVerifier.
 
         Returns:
             bool: True if the block was verified and applied, False otherwise.
@@ -88,13 +235,45 @@ class BlockchainState:
                 'Timestamp is wrong'
 
         # verify the block with the current difficulty
-        self.user_states = block.verify_and_get_changes(
-            self.calculate_difficulty(),
-            self.user_states)
+        difficulty = self.calculate_difficulty()
+        user_states = block.verify_and_get_changes(
+            difficulty,
+            self.user_states,
+            verify_signatures)
+
+        # record the user states replaced by the block so it can be undone
+        previous_user_states = {}
+        for key in user_states.touched:
+            user_state = self.user_states.get(key)
+            if user_state is None:
+                previous_user_states[key] = None
+            else:
+                previous_user_states[key] = (user_state.balance, user_state.nonce)
+
+        # write the changed user states through to the current user states
+        self.touched_users.update(user_states.touched)
+        user_states.commit()
 
         # add the block to the longest chain
-        self.total_difficulty += self.calculate_difficulty()
+        self.total_difficulty += difficulty
         self.longest_chain.append(block)
+        self.undo_journal[block.block_id] = BlockUndo(
+            previous_user_states, difficulty)
+        self.block_tree.add(block, self.total_difficulty)
+
+        # forget the undo records and tree nodes of blocks too deep to be
+        # reorganized, undoing them falls back to replaying them backwards
+        if self.pruning and len(self.longest_chain) > MAX_SIDE_BRANCH_DEPTH:
+            self.forget_block(len(self.longest_chain) - MAX_SIDE_BRANCH_DEPTH - 1)
+
+    def forget_block(self, height : int) -> None:
+        """
+        Remove the undo record and the tree node of a block on the longest
+        chain.
+        """
+        block_id = self.longest_chain[height].block_id
+        self.undo_journal.pop(block_id, None)
+        self.block_tree.remove(block_id)
 
     def undo_last_block(self) -> None:
         """
@@ -102,12 +281,139 @@ class BlockchainState:
         """
         # remove the last block from the longest chain
         block = self.longest_chain.pop()
+        block_undo = self.undo_journal.pop(block.block_id, None)
+
+        # replay the block backwards if it was not applied by this state
+        if block_undo is None:
+            self.total_difficulty -= block.difficulty
+            user_states = block.get_changes_for_undo(self.user_states)
+            self.touched_users.update(user_states.touched)
+            user_states.commit()
+            return
 
         # update the total difficulty
-        self.total_difficulty -= block.difficulty
+        self.total_difficulty -= block_undo.difficulty
+
+        # restore the user states touched by the block
+        self.touched_users.update(block_undo.previous_user_states)
+        for key, previous_user_state in block_undo.previous_user_states.items():
+            if previous_user_state is None:
+                self.user_states.pop(key, None)
+            else:
+                self.user_states[key] = UserState(*previous_user_state)
+
+    def pop_touched_users(self) -> set:
+        """
+        Get the users changed since the last call and start a new set.
 
-        # update the user states
-        self.user_states = block.get_changes_for_undo(self.user_states)
+        Returns:
+            set: The hashes of the users whose state was changed by the
+                blocks that were applied or undone.
+        """
+        touched_users = self.touched_users
+        self.touched_users = set()
+        return touched_users
+
+    def reorganize(self, new_branch : list) -> list:
+        """
+        Switch the longest chain to a heavier branch. Only the blocks
+        between the fork point and the two tips are undone and applied,
+        and the blockchain state is left unchanged if the new branch is
+        invalid or not heavier than the longest chain.
+
+        Parameters:
+            new_branch (list): The new branch of blocks. The first block
+                must follow a block on the longest chain or on a known
+                side branch.
+
+        Returns:
+            list: The blocks that were applied, including the known side
+                branch blocks the new branch was extended with.
+        """
+        # extend the branch back to the longest chain with known side blocks
+        new_branch = self.block_tree.side_branch_to(new_branch[0].previous) \
+                   + list(new_branch)
+        fork_height = new_branch[0].height
+
+        # verify that the branch forks from the longest chain
+        assert 0 <= fork_height <= len(self.longest_chain), \
+            'Block height is wrong'
+        if fork_height == 0:
+            assert new_branch[0].previous == bytes([0] * 32), \
+                'previous block id is wrong'
+        else:
+            assert new_branch[0].previous \
+                == self.longest_chain[fork_height - 1].block_id, \
+                'previous block id is wrong'
+
+        # reject a lighter branch before verifying any of its blocks
+        old_blocks = self.longest_chain[fork_height:]
+        fork_difficulty = self.total_difficulty \
+                        - sum(block.difficulty for block in old_blocks)
+        if fork_difficulty + sum(block.difficulty for block in new_branch) \
+                <= self.total_difficulty:
+            raise Exception('The total difficulty of the new chain is '
+                           +'lower than the old chain')
+
+        # undo and apply the blocks on an overlay of the user states so
+        # that nothing has to be restored if the new branch is invalid
+        old_user_states = self.user_states
+        old_total_difficulty = self.total_difficulty
+        old_undo_journal = {block.block_id: self.undo_journal.get(block.block_id)
+                            for block in old_blocks}
+        known_nodes = {block.block_id: self.block_tree.get(block.block_id)
+                       for block in new_branch if block.block_id in self.block_tree}
+        self.user_states = UserStateOverlay(old_user_states)
+
+        self.pruning = False
+        try:
+            while len(self.longest_chain) > fork_height:
+                self.undo_last_block()
+
+            for block in new_branch:
+                self.verify_and_apply_block(block)
+
+            if self.total_difficulty <= old_total_difficulty:
+                raise Exception('The total difficulty of the new chain is '
+                               +'lower than the old chain')
+        except Exception:
+            # throw away the new branch and restore the longest chain
+            for block in new_branch:
+                self.undo_journal.pop(block.block_id, None)
+                node = known_nodes.get(block.block_id)
+                if node is None:
+                    self.block_tree.remove(block.block_id)
+                else:
+                    self.block_tree.add(node.block, node.cumulative_difficulty,
+                                        side_branch=True)
+            for block_id, block_undo in old_undo_journal.items():
+                if block_undo is not None:
+                    self.undo_journal[block_id] = block_undo
+            del self.longest_chain[fork_height:]
+            self.longest_chain.extend(old_blocks)
+            self.user_states = old_user_states
+            self.total_difficulty = old_total_difficulty
+            raise
+        finally:
+            self.pruning = True
+
+        # write the changes through and keep the old blocks as a side branch
+        self.user_states.commit()
+        self.user_states = old_user_states
+
+        # forget the blocks of the new branch that are too deep now
+        for height in range(max(0, fork_height - MAX_SIDE_BRANCH_DEPTH),
+                            len(self.longest_chain) - MAX_SIDE_BRANCH_DEPTH):
+            self.forget_block(height)
+
+        cumulative_difficulty = fork_difficulty
+        for block in old_blocks:
+            cumulative_difficulty += block.difficulty
+            self.block_tree.add(block, cumulative_difficulty, side_branch=True)
+
+        self.block_tree.prune(len(self.longest_chain) - MAX_SIDE_BRANCH_DEPTH)
+
+        return new_branch
 
 def verify_reorg(
         old_state : BlockchainState, new_branch : list) -> BlockchainState:
@@ -123,21 +429,21 @@ def verify_reorg(
     Returns:
         BlockchainState: The new blockchain state.
     """
-    # copy the old state
-    new_state = deepcopy(old_state)
-
-    # undo blocks until the height is the same as the first block in
-    # the new branch
-    while new_state.longest_chain[-1].height >= new_branch[0].height:
-        new_state.undo_last_block()
-
-    # add the new blocks to the new state
-    for block in new_branch:
-        new_state.verify_and_apply_block(block)
-
-    # verify that the new chain is valid
-    if new_state.total_difficulty <= old_state.total_difficulty:
-        raise Exception('The total difficulty of the new chain is '
-                       +'lower than the old chain')
+    # create a new state that shares the blocks and the user states of
+    # the old state without copying them
+    new_state = BlockchainState(
+        list(old_state.longest_chain),
+        UserStateOverlay(old_state.user_states),
+        old_state.total_difficulty)
+    new_state.undo_journal = dict(old_state.undo_journal)
+    new_state.block_tree.nodes = dict(old_state.block_tree.nodes)
+    new_state.block_tree.side_block_ids = set(old_state.block_tree.side_block_ids)
+
+    # switch the new state to the new branch
+    new_state.reorganize(new_branch)
+
+    # flatten the overlay so that later blocks do not stack more overlays
+    # on top of the user states of the old state
+    new_state.user_states = dict(new_state.user_states)
 
     return new_state
@@ -5,8 +5,9 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 from cryptography.hazmat.primitives.asymmetric import ec
 
+import blockchain_state
 from blockchain_state import BlockchainState, verify_reorg
-from blocks import mine_block
+from blocks import Block, mine_block
 from transactions import create_signed_transaction
 
 
@@ -88,6 +89,95 @@ class BlockchainStateTest(unittest.TestCase):
         assert state.user_states[BOB_ADDRESS].nonce == -1
         assert state.total_difficulty == total_difficulty
 
+    def test_undo_new_users(self):
+        state = BlockchainState([], dict(), 0)
+        previous = bytes([0] * 32)
+        for height in range(2):
+            block = mine_block(previous, height, ALICE_ADDRESS, [], 120 * height, state.calculate_difficulty(),
+                               time() + 100)
+            state.verify_and_apply_block(block)
+            previous = block.block_id
+
+        transactions = [create_signed_transaction(ALICE_KEY, BOB_ADDRESS, 3000, 25, 0)]
+        block = mine_block(previous, 2, ALICE_ADDRESS, transactions, 240, state.calculate_difficulty(),
+                           time() + 150)
+        state.verify_and_apply_block(block)
+
+        assert set(state.undo_journal[block.block_id].previous_user_states) == {ALICE_ADDRESS, BOB_ADDRESS}
+        assert state.pop_touched_users() == {ALICE_ADDRESS, BOB_ADDRESS}
+        assert state.user_states[BOB_ADDRESS].balance == 2975
+
+        state.undo_last_block()
+
+        assert block.block_id not in state.undo_journal
+        assert state.pop_touched_users() == {ALICE_ADDRESS, BOB_ADDRESS}
+        assert BOB_ADDRESS not in state.user_states
+        assert state.user_states[ALICE_ADDRESS].balance == 20_000
+        assert state.user_states[ALICE_ADDRESS].nonce == -1
+        assert state.total_difficulty == 2000
+
+    def test_prune_undo_journal(self):
+        state = BlockchainState([], dict(), 0)
+        previous = bytes([0] * 32)
+        old_depth = blockchain_state.MAX_SIDE_BRANCH_DEPTH
+        blockchain_state.MAX_SIDE_BRANCH_DEPTH = 3
+        try:
+            for height in range(8):
+                block = mine_block(previous, height, ALICE_ADDRESS, [], 120 * height, state.calculate_difficulty(),
+                                   time() + 100)
+                state.verify_and_apply_block(block)
+                previous = block.block_id
+        finally:
+            blockchain_state.MAX_SIDE_BRANCH_DEPTH = old_depth
+
+        recent_ids = {block.block_id for block in state.longest_chain[-3:]}
+        assert set(state.undo_journal) == recent_ids
+        assert set(state.block_tree.nodes) == recent_ids
+
+        # blocks below the journal are undone by replaying them backwards
+        for _ in range(6):
+            state.undo_last_block()
+
+        assert state.user_states[ALICE_ADDRESS].balance == 20_000
+        assert state.total_difficulty == 2000
+
+    def test_reorganize_keeps_undo_journal(self):
+        state = BlockchainState([], dict(), 0)
+        previous = bytes([0] * 32)
+        old_depth = blockchain_state.MAX_SIDE_BRANCH_DEPTH
+        blockchain_state.MAX_SIDE_BRANCH_DEPTH = 3
+        try:
+            for height in range(8):
+                block = mine_block(previous, height, ALICE_ADDRESS, [], 120 * height, state.calculate_difficulty(),
+                                   time() + 100)
+                state.verify_and_apply_block(block)
+                previous = block.block_id
+            journal = dict(state.undo_journal)
+
+            # a branch replacing the tip that is rejected after it is longer
+            # than the journal keeps the undo records of the longest chain
+            previous = state.longest_chain[6].block_id
+            blocks = []
+            for height in range(7, 10):
+                block = mine_block(previous, height, BOB_ADDRESS, [], 120 * height, 1000, time() + 100)
+                blocks.append(block)
+                previous = block.block_id
+            block = mine_block(previous, 10, BOB_ADDRESS, [], 120 * 10, 2, time() + 100)
+            with self.assertRaisesRegex(Exception, "Incorrect difficulty"):
+                state.reorganize(blocks + [block])
+
+            assert state.undo_journal == journal
+            assert set(state.block_tree.nodes) == set(journal)
+
+            # an accepted branch prunes the blocks that are too deep
+            block = mine_block(previous, 10, BOB_ADDRESS, [], 120 * 10, state.calculate_difficulty(), time() + 100)
+            state.reorganize(blocks + [block])
+        finally:
+            blockchain_state.MAX_SIDE_BRANCH_DEPTH = old_depth
+
+        recent_ids = {block.block_id for block in state.longest_chain[-3:]}
+        assert set(state.undo_journal) == recent_ids
+
     def test_previous_validation(self):
         state = BlockchainState([], dict(), 0)
         block = mine_block(bytes([1] * 32), 0, ALICE_ADDRESS, [], 0, 1000, time() + 150)
@@ -148,6 +238,77 @@ class BlockchainStateTest(unittest.TestCase):
 
         assert new_state.user_states[ALICE_ADDRESS].balance == 80_000
         assert new_state.user_states[BOB_ADDRESS].balance == 80_000
+        assert isinstance(new_state.user_states, dict)
+
+    def test_reorganize_in_place(self):
+        state = BlockchainState([], dict(), 0)
+        previous = bytes([0] * 32)
+        for height in range(15):
+            block = mine_block(previous, height, ALICE_ADDRESS, [], 120 * height, state.calculate_difficulty(),
+                               time() + 100)
+            state.verify_and_apply_block(block)
+            previous = block.block_id
+
+        old_blocks = list(state.longest_chain)
+        previous = state.longest_chain[7].block_id
+        blocks = []
+        for height in range(8, 15):
+            block = mine_block(previous, height, BOB_ADDRESS, [], 120 * height, state.longest_chain[height].difficulty,
+                               time() + 100)
+            blocks.append(block)
+            previous = block.block_id
+
+        # a lighter branch is thrown away and the state is unchanged
+        with self.assertRaisesRegex(Exception, "total difficulty"):
+            state.reorganize(blocks)
+
+        assert state.longest_chain == old_blocks
+        assert state.user_states[ALICE_ADDRESS].balance == 150_000
+        assert BOB_ADDRESS not in state.user_states
+        assert blocks[0].block_id not in state.block_tree
+
+        # an invalid branch is thrown away and the state is unchanged
+        block = mine_block(previous, 15, BOB_ADDRESS, [], 120 * 15, 2, time() + 100)
+        with self.assertRaisesRegex(Exception, "Incorrect difficulty"):
+            state.reorganize(blocks + [block])
+
+        assert state.longest_chain == old_blocks
+        assert state.user_states[ALICE_ADDRESS].balance == 150_000
+        assert BOB_ADDRESS not in state.user_states
+        assert len(state.undo_journal) == 15
+
+        # a heavier branch replaces the tail of the longest chain
+        block = mine_block(previous, 15, BOB_ADDRESS, [], 120 * 15, state.calculate_difficulty(), time() + 100)
+        state.reorganize(blocks + [block])
+        blocks_tip = block
+
+        assert state.longest_chain == old_blocks[:8] + blocks + [block]
+        assert state.user_states[ALICE_ADDRESS].balance == 80_000
+        assert state.user_states[BOB_ADDRESS].balance == 80_000
+        assert state.block_tree.get(block.block_id).cumulative_difficulty == state.total_difficulty
+        assert state.block_tree.side_branch_to(old_blocks[-1].block_id) == old_blocks[8:]
+
+        # an invalid block on top of the side branch keeps the side blocks
+        block = Block(old_blocks[-1].block_id, 15, ALICE_ADDRESS, [], 120 * 15, 2 ** 200, bytes(32), 0)
+        with self.assertRaises(Exception):
+            state.reorganize([block])
+
+        assert state.longest_chain == old_blocks[:8] + blocks + [blocks_tip]
+        assert state.block_tree.side_branch_to(old_blocks[-1].block_id) == old_blocks[8:]
+
+        # the old branch is extended from the known side blocks
+        previous = old_blocks[-1].block_id
+        new_blocks = []
+        for height in range(15, 17):
+            difficulty = BlockchainState(old_blocks + new_blocks, dict(), 0).calculate_difficulty()
+            block = mine_block(previous, height, ALICE_ADDRESS, [], 120 * height, difficulty, time() + 100)
+            new_blocks.append(block)
+            previous = block.block_id
+
+        assert state.reorganize(new_blocks) == old_blocks[8:] + new_blocks
+        assert state.longest_chain == old_blocks + new_blocks
+        assert state.user_states[ALICE_ADDRESS].balance == 170_000
+        assert BOB_ADDRESS not in state.user_states
 
 
 if __name__ == '__main__':
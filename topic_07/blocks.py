@@ -3,15 +3,23 @@ This module implements the functionality for a block in the Zimcoin
 blockchain.
 """
 
-from copy import deepcopy
+from collections.abc import MutableMapping
+import struct
 import hashlib
 import miner_helper
+from transactions import Transaction
+
+# the packed block header: the previous block id, block id and miner,
+# the height, timestamp, difficulty, nonce and number of transactions
+PACKED_BLOCK = struct.Struct('<32s32s20sQQ16sQH')
 
 class UserState:
     """
     This class will be used to help keep track of the state of users as
     blocks are accepted onto the blockchain.
     """
+    __slots__ = ('balance', 'nonce')
+
     def __init__(self, balance : int, nonce : int):
         """
         Initialize the user state.
@@ -23,10 +31,126 @@ class UserState:
         self.balance = balance
         self.nonce = nonce
 
+# marker used by the overlay to record that a user state was removed
+_REMOVED = object()
+
+class UserStateOverlay(MutableMapping):
+    """
+    A copy-on-write view of the user states. Reads fall through to the
+    parent mapping and only the user states that are touched are copied
+    into the overlay, so applying a block costs time proportional to the
+    number of users it changes rather than the number of known users.
+    """
+    def __init__(self, parent):
+        """
+        Initialize the overlay.
+
+        Parameters:
+            parent (Mapping): The user states the overlay is layered on,
+                either a dictionary or another overlay.
+        """
+        self.parent = parent
+        self.changes = {}
+
+    def __getitem__(self, key : bytes) -> UserState:
+        if key in self.changes:
+            user_state = self.changes[key]
+            if user_state is _REMOVED:
+                raise KeyError(key)
+            return user_state
+        return self.parent[key]
+
+    def __setitem__(self, key : bytes, user_state : UserState):
+        self.changes[key] = user_state
+
+    def __delitem__(self, key : bytes):
+        if key not in self:
+            raise KeyError(key)
+        self.changes[key] = _REMOVED
+
+    def __contains__(self, key) -> bool:
+        if key in self.changes:
+            return self.changes[key] is not _REMOVED
+        return key in self.parent
+
+    def __iter__(self):
+        for key, user_state in self.changes.items():
+            if user_state is not _REMOVED:
+                yield key
+        for key in self.parent:
+            if key not in self.changes:
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    @property
+    def touched(self) -> set:
+        """
+        Get the keys of the user states changed in the overlay.
+        """
+        return set(self.changes)
+
+    def get_for_update(self, key : bytes, create : bool = False) -> UserState:
+        """
+        Get a user state that may be modified without affecting the
+        parent, copying it into the overlay the first time it is used.
+
+        Parameters:
+            key (bytes): The public key hash of the user.
+            create (bool): Create an empty user state if the user is not
+                known yet.
+
+        Returns:
+            UserState: The user state or None if the user is not known
+                and create is False.
+        """
+        user_state = self.changes.get(key)
+        if user_state is not None and user_state is not _REMOVED:
+            return user_state
+
+        parent_state = None
+        if user_state is None:
+            parent_state = self.parent.get(key)
+
+        if parent_state is not None:
+            user_state = UserState(parent_state.balance, parent_state.nonce)
+        elif create:
+            user_state = UserState(0, -1)
+        else:
+            return None
+
+        self.changes[key] = user_state
+        return user_state
+
+    def commit(self) -> None:
+        """
+        Write the changed user states to the parent and clear the
+        overlay.
+        """
+        for key, user_state in self.changes.items():
+            if user_state is _REMOVED:
+                self.parent.pop(key, None)
+            else:
+                self.parent[key] = user_state
+        self.changes = {}
+
+    def discard(self) -> None:
+        """
+        Throw away the changes recorded in the overlay.
+        """
+        self.changes = {}
+
 class Block:
     """
     This class represents a block in the blockchain.
     """
+    __slots__ = ('previous', 'height', 'miner', 'transactions', 'timestamp',
+                 'difficulty', 'block_id', 'nonce')
+
+    # the reward paid to the miner of every block
+    block_reward = 10_000
+
     def __init__(self, previous : bytes, height : int, miner : bytes,
                  transactions : list, timestamp : int, difficulty : int,
                  block_id : bytes, nonce : int):
@@ -63,11 +187,69 @@ class Block:
         self.difficulty = difficulty
         self.block_id = block_id
         self.nonce = nonce
-        self.block_reward = 10_000
+
+    def pack(self) -> bytes:
+        """
+        Pack the block into bytes with the header fields at fixed offsets
+        followed by the packed transactions.
+
+        Returns:
+            bytes: The packed block.
+        """
+        if len(self.previous) != 32:
+            raise ValueError('Invalid previous block id')
+        if len(self.block_id) != 32:
+            raise ValueError('Invalid block id')
+        if len(self.miner) != 20:
+            raise ValueError('Invalid miner address')
+
+        header = PACKED_BLOCK.pack(
+            self.previous,
+            self.block_id,
+            self.miner,
+            self.height,
+            self.timestamp,
+            self.difficulty.to_bytes(16, byteorder='little', signed=False),
+            self.nonce,
+            len(self.transactions))
+
+        return header + b''.join(
+            transaction.pack() for transaction in self.transactions)
+
+    @staticmethod
+    def unpack_from(buffer, offset : int = 0) -> tuple:
+        """
+        Unpack a block packed by Block.pack.
+
+        Parameters:
+            buffer (bytes): The buffer containing the packed block.
+            offset (int): The offset of the block in the buffer.
+
+        Returns:
+            tuple: The block and the offset following it in the buffer.
+        """
+        buffer = memoryview(buffer)
+        try:
+            (previous, block_id, miner, height, timestamp, difficulty, nonce,
+             transaction_count) = PACKED_BLOCK.unpack_from(buffer, offset)
+        except struct.error as error:
+            raise ValueError('The packed block is truncated') from error
+        offset += PACKED_BLOCK.size
+
+        transactions = []
+        for _ in range(transaction_count):
+            transaction, offset = Transaction.unpack_from(buffer, offset)
+            transactions.append(transaction)
+
+        block = Block(previous, height, miner, transactions, timestamp,
+                      int.from_bytes(difficulty, byteorder='little'),
+                      block_id, nonce)
+        return block, offset
 
     def verify_and_get_changes(self,
                                difficulty : int,
-                               previous_user_states : dict) -> dict:
+                               previous_user_states : MutableMapping,
+                               verify_signatures : bool = True) -> UserStateOverlay:
         """
         Verify that the block is valid and return the changes to the
         user states if the block is valid.
@@ -75,13 +257,16 @@ class Block:
         Parameters:
             difficulty (int): The expected difficulty for this block.
 
-            previous_user_states (dict): A dictionary of user states
-                representing the state of the users before the block was
-                mined.
+            previous_user_states (MutableMapping): The user states
+                before the block was mined, either a dictionary or an
+                overlay.
+
+            verify_signatures (bool): False if the transaction signatures
+                were already verified by a SignatureVerifier.
 
         Returns:
-            dict: A dictionary of user states representing the state of
-                the users after the block was mined.
+            UserStateOverlay: The user states after the block was mined,
+                layered on top of the previous user states.
         """
         # verify that the difficulty is correct
         assert self.difficulty == difficulty, 'Incorrect difficulty'
@@ -103,7 +288,8 @@ class Block:
         # if self.height == 0:
         #     assert len(self.transactions) == 0, 'There are transactions in the genesis block'
 
-        user_states = self.verify_and_update_transactions(previous_user_states)
+        user_states = self.verify_and_update_transactions(
+            previous_user_states, verify_signatures)
 
         return user_states
 
@@ -177,44 +363,44 @@ class Block:
         # verify that the block id is less than the difficulty
         return block_id_int < target
 
-    def verify_and_update_transactions(self, previous_user_states : dict) -> dict:
+    def verify_and_update_transactions(self, previous_user_states : MutableMapping,
+                                       verify_signatures : bool = True) -> UserStateOverlay:
         """
         Verify that the transactions in the block are valid.
 
         Parameters:
-            previous_user_states (dict): A dictionary of user states
-                representing the state of the users before the block was
-                mined.
+            previous_user_states (MutableMapping): The user states
+                before the block was mined, either a dictionary or an
+                overlay.
+
+            verify_signatures (bool): False if the transaction signatures
+                were already verified by a SignatureVerifier.
 
         Returns:
-            bool: True if the transactions are valid, False otherwise.
+            UserStateOverlay: The user states after the transactions were
+                applied, layered on top of the previous user states.
         """
         # create the output user states
-        user_states = deepcopy(previous_user_states)
-
-        # add the miner to the user states
-        if self.miner not in user_states:
-            user_states[self.miner] = UserState(0, -1)
+        user_states = UserStateOverlay(previous_user_states)
 
         # allocate the block reward to the miner
-        miner_state = user_states[self.miner]
+        miner_state = user_states.get_for_update(self.miner, create=True)
         miner_state.balance += self.block_reward
 
         for transaction in self.transactions:
             # get the sender user state
-            sender_state = user_states.get(transaction.sender_hash)
+            sender_state = user_states.get_for_update(transaction.sender_hash)
             assert sender_state is not None, 'Sender user state not found'
 
             # verify the transaction
             transaction.verify(
                 sender_balance=sender_state.balance,
-                sender_previous_nonce=sender_state.nonce)
+                sender_previous_nonce=sender_state.nonce,
+                check_signature=verify_signatures)
 
             # add the receiver to the user states if required
-            if transaction.recipient_hash not in user_states:
-                user_states[transaction.recipient_hash] = UserState(0, -1)
-
-            receiver_state = user_states[transaction.recipient_hash]
+            receiver_state = user_states.get_for_update(
+                transaction.recipient_hash, create=True)
 
             # update the nonce of the sender
             sender_state.nonce += 1
@@ -230,34 +416,34 @@ class Block:
 
         return user_states
 
-    def get_changes_for_undo(self, user_states_after : dict) -> dict:
+    def get_changes_for_undo(self, user_states_after : MutableMapping) -> UserStateOverlay:
         """
         Rollback the transactions in the block and return the previous
         state.
 
         Parameters:
-            user_states_after (dict): A dictionary of user states
-                representing the state of the users after the block was
-                mined.
+            user_states_after (MutableMapping): The user states after
+                the block was mined, either a dictionary or an overlay.
 
         Returns:
-            dict: A dictionary of user states representing the state of
-                the users before the block was mined.
+            UserStateOverlay: The user states before the block was mined,
+                layered on top of the user states after the block.
         """
         # create the output user states
-        user_states = deepcopy(user_states_after)
+        user_states = UserStateOverlay(user_states_after)
 
         # remove the block reward from the miner
-        miner_state = user_states[self.miner]
+        miner_state = user_states.get_for_update(self.miner)
         miner_state.balance -= self.block_reward
 
         for transaction in self.transactions:
             # get the sender user state
-            sender_state = user_states.get(transaction.sender_hash)
+            sender_state = user_states.get_for_update(transaction.sender_hash)
             assert sender_state is not None, 'Sender user state not found'
 
             # get the receiver user state
-            receiver_state = user_states[transaction.recipient_hash]
+            receiver_state = user_states.get_for_update(
+                transaction.recipient_hash)
 
             # rollback the nonce of the sender
             sender_state.nonce -= 1
@@ -253,3 +253,67 @@ class BlockDevelopment(unittest.TestCase):
             test_block.verify_and_get_changes(
                 difficulty=test_block.difficulty,
                 previous_user_states=test_states)
+
+    def test_user_states_not_copied(self):
+        """
+        Ensure that only the touched user states are copied and that the
+        previous user states are left unchanged.
+        """
+        # get the block for testing
+        test_block = self.get_transactions_block()
+
+        test_transaction = test_block.transactions[0]
+        sender_state = UserState(1000, 0)
+        other_state = UserState(50, 3)
+        test_states = {
+            test_transaction.sender_hash: sender_state,
+            b'\x01' * 20: other_state}
+
+        user_states = test_block.verify_and_get_changes(
+            difficulty=test_block.difficulty,
+            previous_user_states=test_states)
+
+        # the previous user states should not be modified
+        self.assertEqual(sender_state.balance, 1000)
+        self.assertEqual(sender_state.nonce, 0)
+        self.assertEqual(len(test_states), 2)
+
+        # only the sender and the miner (also the recipient) are touched
+        self.assertEqual(user_states.touched,
+                         {test_transaction.sender_hash, test_block.miner})
+        self.assertIs(user_states[b'\x01' * 20], other_state)
+        self.assertEqual(user_states[test_transaction.sender_hash].balance, 610)
+        self.assertEqual(user_states[test_block.miner].balance, 10_390)
+
+        # commit the changes to the previous user states
+        user_states.commit()
+        self.assertEqual(test_states[test_transaction.sender_hash].nonce, 1)
+        self.assertEqual(test_states[test_block.miner].balance, 10_390)
+
+        # undo the block and discard the changes
+        undo_states = test_block.get_changes_for_undo(test_states)
+        self.assertEqual(undo_states[test_transaction.sender_hash].balance, 1000)
+        undo_states.discard()
+        self.assertEqual(undo_states[test_transaction.sender_hash].balance, 610)
+
+    def test_pack(self):
+        """
+        Ensure that a block survives being packed and unpacked.
+        """
+        test_block = self.get_transactions_block()
+        packed = test_block.pack()
+
+        block, offset = Block.unpack_from(b'header' + packed, 6)
+        self.assertEqual(offset, 6 + len(packed))
+        self.assertEqual(block.block_id, test_block.block_id)
+        self.assertEqual(block.difficulty, test_block.difficulty)
+        self.assertEqual(block.calculate_block_id(), test_block.block_id)
+        self.assertEqual(block.transactions[0].create_txid(),
+                         test_block.transactions[0].txid)
+
+        # the block reward is shared by the blocks
+        with self.assertRaises(AttributeError):
+            block.block_reward = 0
+
+        with self.assertRaisesRegex(ValueError, 'truncated'):
+            Block.unpack_from(packed[:-1])
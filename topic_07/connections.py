@@ -1,15 +1,18 @@
 import json
-from typing import List
+from typing import List, Union
 
 import tornado
 from pykka import ThreadingActor
 from tornado.ioloop import IOLoop
-from tornado.web import Application
+from tornado.web import Application, RequestHandler
 from tornado.websocket import WebSocketHandler, websocket_connect, WebSocketClientConnection
 
 from blocks import Block
+from mining_metrics import get_sink, PROMETHEUS_CONTENT_TYPE
 from node import NodeStateSummary
-from persistence import block_to_dict, dict_to_block, transaction_to_dict, dict_to_transaction
+from persistence import block_to_dict, dict_to_block, transaction_to_dict, dict_to_transaction, \
+    blocks_to_bytes, transactions_to_bytes, decode_message, RECORD_BLOCKS, RECORD_TRANSACTIONS, \
+    CODEC_JSON, CODEC_BINARY
 from transactions import Transaction
 
 MAX_BLOCKS = 50
@@ -17,11 +20,13 @@ MAX_BLOCK_IDS = 100
 
 
 class ConnectionActor(ThreadingActor):
-    def __init__(self, connection_handler, node):
+    def __init__(self, connection_handler, node, codec: str = CODEC_JSON):
         super().__init__()
+        assert codec in (CODEC_JSON, CODEC_BINARY), "Unknown codec"
         self.node_server = connection_handler
         self.ioloop = IOLoop.current()
         self.node = node
+        self.codec = codec
 
     def send_state_summary(self, summary: NodeStateSummary):
         if summary.block_id is None:
@@ -43,6 +48,9 @@ class ConnectionActor(ThreadingActor):
         )))
 
     def send_blocks(self, blocks: List[Block]):
+        if self.codec == CODEC_BINARY:
+            self.send(blocks_to_bytes(blocks))
+            return
         self.send(json.dumps(dict(
             type='blocks',
             blocks=list(map(block_to_dict, blocks))
@@ -56,6 +64,9 @@ class ConnectionActor(ThreadingActor):
         )))
 
     def send_transactions(self, transactions: List[Transaction]):
+        if self.codec == CODEC_BINARY:
+            self.send(transactions_to_bytes(transactions))
+            return
         self.send(json.dumps(dict(
             type='transactions',
             transactions=list(map(transaction_to_dict, transactions))
@@ -67,6 +78,10 @@ class ConnectionActor(ThreadingActor):
         )))
 
     def send(self, message):
+        if isinstance(message, bytes):
+            print("Sending", len(message), "bytes")
+            self.ioloop.add_callback(self.node_server.write_message, message, True)
+            return
         print("Sending", message)
         self.ioloop.add_callback(self.node_server.write_message, message)
 
@@ -74,6 +89,15 @@ class ConnectionActor(ThreadingActor):
         self.node.remove_connection(self.actor_ref)
 
     def handle_message(self, message):
+        if isinstance(message, bytes):
+            message_type, items = decode_message(message)
+            print("Got binary message", message_type, len(items))
+            if message_type == RECORD_BLOCKS:
+                self.node.received_blocks(items)
+            elif message_type == RECORD_TRANSACTIONS:
+                self.node.received_transactions(items)
+            return
+
         parsed = json.loads(message)
         print("Got message", parsed)
 
@@ -114,16 +138,17 @@ class ConnectionActor(ThreadingActor):
 
 
 class ConnectionHandler(WebSocketHandler):
-    def initialize(self, node):
+    def initialize(self, node, codec=CODEC_JSON):
         print("Initialize")
         self.node = node
+        self.codec = codec
 
     def open(self):
-        connection_actor = ConnectionActor.start(self, self.node)
+        connection_actor = ConnectionActor.start(self, self.node, self.codec)
         self.connection = connection_actor.proxy()
         print("Opened connection", id(self))
 
-    def on_message(self, message: str):
+    def on_message(self, message: Union[str, bytes]):
         self.connection.handle_message(message)
 
     def on_close(self):
@@ -133,25 +158,39 @@ class ConnectionHandler(WebSocketHandler):
     def check_origin(self, origin: str) -> bool:
         return True
 
-def run_server(node, port):
+class MetricsHandler(RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+        self.write(get_sink().to_prometheus())
+
+
+def listen_metrics(port):
+    app = Application([
+        (r'/metrics', MetricsHandler),
+    ])
+    app.listen(port, "0.0.0.0")
+
+
+def run_server(node, port, codec=CODEC_JSON):
     app = Application([
-        (r'/', ConnectionHandler, dict(node=node)),
+        (r'/', ConnectionHandler, dict(node=node, codec=codec)),
+        (r'/metrics', MetricsHandler),
     ])
     app.listen(port, "0.0.0.0")
     tornado.ioloop.IOLoop.current().start()
 
 
-def remote_connection(node, address):
+def remote_connection(node, address, codec=CODEC_JSON):
     connection = None
 
     def connect_callback(connection_handler):
         nonlocal connection
         connection_handler: WebSocketClientConnection = connection_handler.result()
-        connection = ConnectionActor.start(connection_handler, node).proxy()
+        connection = ConnectionActor.start(connection_handler, node, codec).proxy()
         connection.send_state_summary(node.state_summary().get())
         connection.fetch_transactions()
 
-    def on_message_callback(message: str):
+    def on_message_callback(message: Union[str, bytes]):
         connection.handle_message(message)
 
     websocket_connect(address, callback=connect_callback, on_message_callback=on_message_callback)
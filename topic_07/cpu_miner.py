@@ -0,0 +1,142 @@
+"""
+This module implements a Zimcoin miner that runs on the CPU, for nodes
+without an OpenCL platform.
+"""
+
+import os
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from mining_backend import MiningBackend, NONCE_LIMIT
+
+# the number of nonces searched by a process before the miner checks the
+# cutoff time and the stop event again
+CHUNK_SIZE = 20_000
+
+# the number of chunks queued for every process
+CHUNKS_PER_PROCESS = 2
+
+# the time to wait for the result of the oldest chunk before the cutoff
+# time and the stop event are checked again
+POLL_INTERVAL = 0.01
+
+
+def search_nonces(block_data : bytes, target : int, start : int, count : int) -> tuple:
+    """
+    Search a range of nonces for one that meets the target. The hash of the
+    block data is calculated once and copied for every nonce.
+
+    Parameters:
+        block_data (bytes): The block data without the nonce.
+        target (int): The target the block id must be below.
+        start (int): The first nonce to try.
+        count (int): The number of nonces to try.
+
+    Returns:
+        tuple: The nonce that was found or 0, and the number of nonces
+            that were tried.
+    """
+    midstate = hashlib.sha256(block_data)
+    for nonce in range(start, start + count):
+        digest = midstate.copy()
+        digest.update(nonce.to_bytes(8, byteorder='little'))
+        if int.from_bytes(digest.digest(), byteorder='big') < target:
+            return nonce, nonce - start + 1
+    return 0, count
+
+
+class CpuMiner(MiningBackend):
+    """
+    Mine for Zimcoins on the CPU, with a pool of processes that search
+    consecutive chunks of the nonces.
+    """
+    name = 'cpu'
+
+    def __init__(self, processes : int = None, chunk_size : int = CHUNK_SIZE,
+                 cutoff_time : int = None):
+        """
+        Initialize the miner. The process pool is created once and reused
+        for every block that is mined.
+
+        Parameters:
+            processes (int): The number of processes, defaults to the number
+                of CPUs. A single process mines in the calling thread.
+            chunk_size (int): The number of nonces in a chunk.
+            cutoff_time (int): The default unix time at which to give up
+                mining a block.
+        """
+        super().__init__(cutoff_time)
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+        # the node runs its actors in threads, so the processes are
+        # spawned rather than forked
+        self.pool = None
+        if self.processes > 1:
+            self.pool = multiprocessing.get_context('spawn').Pool(self.processes)
+
+    def close(self):
+        """
+        Stop the process pool.
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    @property
+    def device_name(self) -> str:
+        """
+        Get the name of the device and the number of processes.
+        """
+        return f'cpu ({self.processes} processes)'
+
+    def search(self, block_data : bytes, target : int,
+               cutoff_time : float = None, stop_event : threading.Event = None,
+               start_nonce : int = 0, end_nonce : int = NONCE_LIMIT) -> int:
+        """
+        Search the nonces of the block data in chunks.
+        """
+        # the search skips 0 as a nonce of 0 means none was found
+        start = max(start_nonce, 1)
+        nonce = 0
+        self.hash_count = 0
+
+        if self.pool is None:
+            while nonce == 0 and start < end_nonce and not self.is_stopped(cutoff_time, stop_event):
+                count = min(self.chunk_size, end_nonce - start)
+                nonce, count = search_nonces(block_data, target, start, count)
+                self.hash_count += count
+                start += self.chunk_size
+            return nonce
+
+        # keep every process busy and collect the chunks in order
+        in_flight = deque()
+        for _ in range(self.processes * CHUNKS_PER_PROCESS):
+            if start >= end_nonce:
+                break
+            in_flight.append(self.pool.apply_async(
+                search_nonces, (block_data, target, start, min(self.chunk_size, end_nonce - start))))
+            start += self.chunk_size
+
+        while nonce == 0 and len(in_flight) > 0:
+            stopped = self.is_stopped(cutoff_time, stop_event)
+            if not in_flight[0].ready():
+                if stopped:
+                    break
+                in_flight[0].wait(POLL_INTERVAL)
+                continue
+
+            nonce, count = in_flight.popleft().get()
+            self.hash_count += count
+            if stopped:
+                break
+
+            if start < end_nonce:
+                in_flight.append(self.pool.apply_async(
+                    search_nonces, (block_data, target, start, min(self.chunk_size, end_nonce - start))))
+                start += self.chunk_size
+
+        # the chunks still in flight finish in the pool and are ignored
+        return nonce
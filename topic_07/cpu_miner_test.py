@@ -0,0 +1,79 @@
+"""
+This module implements the tests for the CPU miner.
+"""
+
+import threading
+import unittest
+from time import time
+from cpu_miner import CpuMiner, search_nonces
+from miner_helper import BACKEND_CPU, get_miner, mine_block
+from transactions import create_signed_transaction
+from cryptography.hazmat.primitives.asymmetric import ec
+
+MINER_ADDRESS = bytes.fromhex("3df8f04b3c159fdc6631c4b8b0874940344d173d")
+
+
+class CpuMinerTest(unittest.TestCase):
+    """
+    Test the CPU miner.
+    """
+    def test_search_nonces(self):
+        """
+        Verify that the nonce found in a range meets the target.
+        """
+        miner = CpuMiner(processes=1)
+        block = miner.create_block(bytes(32), 0, MINER_ADDRESS, [], 0, 1000)
+        nonce, count = search_nonces(bytes(block.to_bytes()), block.calculate_target(), 1, 100_000)
+        self.assertNotEqual(nonce, 0)
+        self.assertEqual(count, nonce)
+
+        block = miner.finish_block(block, nonce)
+        self.assertTrue(block.verify_proof_of_work())
+
+    def test_process_pool(self):
+        """
+        Verify that the processes mine a block with transactions.
+        """
+        private_key = ec.generate_private_key(ec.SECP256K1)
+        transactions = [create_signed_transaction(private_key, MINER_ADDRESS, 1000, 10, nonce)
+                        for nonce in range(3)]
+
+        miner = CpuMiner(processes=2, chunk_size=1000)
+        try:
+            block = miner.mine(bytes(32), 0, MINER_ADDRESS, transactions, int(time()), 5000,
+                               time() + 60)
+        finally:
+            miner.close()
+        self.assertTrue(block.verify_proof_of_work())
+        self.assertGreaterEqual(miner.hash_count, 1)
+
+    def test_stop_event(self):
+        """
+        Verify that setting the stop event abandons a block that cannot be
+        found.
+        """
+        miner = CpuMiner(processes=2, chunk_size=1000)
+        stop_event = threading.Event()
+        threading.Timer(0.2, stop_event.set).start()
+
+        start = time()
+        try:
+            block = miner.mine(bytes(32), 0, MINER_ADDRESS, [], int(time()), 2 ** 127,
+                               stop_event=stop_event)
+        finally:
+            miner.close()
+        self.assertEqual(block.nonce, 0)
+        self.assertLess(time() - start, 10)
+
+    def test_cpu_backend(self):
+        """
+        Verify that the CPU backend is used when it is selected.
+        """
+        self.assertIsInstance(get_miner(backend=BACKEND_CPU), CpuMiner)
+        block = mine_block(bytes(32), 0, MINER_ADDRESS, [], int(time()), 1000, time() + 30,
+                           backend=BACKEND_CPU)
+        self.assertTrue(block.verify_proof_of_work())
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -1,32 +1,52 @@
+import os
 import sys
 import time
 
 import tornado
 
 from miner import Miner
+from mining_pool import PoolServer, PoolWorker
 from node import Node
-from connections import run_server, remote_connection
+from connections import listen_metrics, run_server, remote_connection
 
 MINER_ADDRESS = b's\\s\x884u\x19\x11m\xad\xedA\x8c\x8f\xe5\x84k^]m'
 
+# miners that share the address each search their own slice of the nonces
+MINER_WORKER_ID = int(os.environ.get('ZIMCOIN_WORKER_ID', 0))
+MINER_WORKER_COUNT = int(os.environ.get('ZIMCOIN_WORKER_COUNT', 1))
+
+# the port of the metrics endpoint of a node that does not run a server
+METRICS_PORT = 46032
+
 
 if __name__ == "__main__":
     if len(sys.argv) == 1:
         REMOTE_NODES = ["ws://node.zimcoin.org:46030/"]
         node = Node.start("./blocks.sqlite").proxy()
-        miner = Miner.start(node, MINER_ADDRESS).proxy()
+        miner = Miner.start(node, MINER_ADDRESS, worker_id=MINER_WORKER_ID,
+                             worker_count=MINER_WORKER_COUNT).proxy()
 
         for remote in REMOTE_NODES:
             remote_connection(node, remote)
         miner.start_mining()
+        listen_metrics(METRICS_PORT)
 
         tornado.ioloop.IOLoop.current().start()
     elif sys.argv[1] == 'server':
         PORT = 46030
         REMOTE_NODES = []
         node = Node.start("./blocks.sqlite").proxy()
-        miner = Miner.start(node, MINER_ADDRESS).proxy()
+        miner = Miner.start(node, MINER_ADDRESS, worker_id=MINER_WORKER_ID,
+                             worker_count=MINER_WORKER_COUNT).proxy()
         miner.start_mining()
         run_server(node, PORT)
+    elif sys.argv[1] == 'pool':
+        PORT = 46030
+        node = Node.start("./blocks.sqlite").proxy()
+        pool = PoolServer.start(node, MINER_ADDRESS, host='0.0.0.0').proxy()
+        run_server(node, PORT)
+    elif sys.argv[1] == 'worker':
+        POOL_HOST = sys.argv[2] if len(sys.argv) > 2 else '127.0.0.1'
+        PoolWorker(POOL_HOST).run()
     else:
         print("Unknown command")
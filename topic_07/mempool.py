@@ -1,3 +1,5 @@
+import heapq
+import itertools
 from typing import Optional, List, Dict
 
 from blocks import UserState
@@ -5,48 +7,209 @@ from transactions import Transaction
 
 MAX_TRANSACTIONS = 50
 
+# the heaps are rebuilt once they hold this many times more entries than
+# there are transactions in the pool
+COMPACT_RATIO = 2
+
 
 class Mempool:
-    def __init__(self):
-        self.by_sender: dict[bytes, Transaction] = dict()
+    def __init__(self, capacity: int = MAX_TRANSACTIONS):
+        self.capacity = capacity
+
+        # the pending transactions of every sender by nonce, the nonces of
+        # a sender follow on from each other and from the sender's nonce
+        self.by_sender: dict[bytes, dict[int, Transaction]] = dict()
+        self.count = 0
+
+        # (fee, sequence, transaction) and (-fee, sequence, transaction)
+        # heaps, entries of replaced or removed transactions are skipped
+        # when they are found instead of being removed from the heaps
+        self.sequence = itertools.count()
+        self.min_heap = []
+        self.max_heap = []
+
+    def is_pooled(self, transaction: Transaction) -> bool:
+        chain = self.by_sender.get(transaction.sender_hash)
+        return chain is not None and chain.get(transaction.nonce) is transaction
+
+    def push(self, transaction: Transaction):
+        sequence = next(self.sequence)
+        heapq.heappush(self.min_heap, (transaction.fee, sequence, transaction))
+        heapq.heappush(self.max_heap, (-transaction.fee, sequence, transaction))
+
+        self.compact()
+
+    def compact(self):
+        if max(len(self.min_heap), len(self.max_heap)) > COMPACT_RATIO * max(self.count, self.capacity):
+            self.rebuild()
+
+    def rebuild(self):
+        self.min_heap = []
+        self.max_heap = []
+        for transaction in self.get_transactions():
+            sequence = next(self.sequence)
+            self.min_heap.append((transaction.fee, sequence, transaction))
+            self.max_heap.append((-transaction.fee, sequence, transaction))
+        heapq.heapify(self.min_heap)
+        heapq.heapify(self.max_heap)
+
+    def remove_from(self, sender_hash: bytes, nonce: int):
+        # remove a transaction and the transactions of the sender after it
+        chain = self.by_sender[sender_hash]
+        while nonce in chain:
+            del chain[nonce]
+            self.count -= 1
+            nonce += 1
+        if len(chain) == 0:
+            del self.by_sender[sender_hash]
 
     def get_min_fee(self) -> Optional[Transaction]:
-        min_fee_transaction = None
-        for transaction in self.by_sender.values():
-            if min_fee_transaction is None or min_fee_transaction.fee > transaction.fee:
-                min_fee_transaction = transaction
-        return min_fee_transaction
-
-    def add_transaction(self, transaction: Transaction) -> bool:
-        if transaction.sender_hash in self.by_sender:
-            old_transaction = self.by_sender[transaction.sender_hash]
-            if old_transaction.fee < transaction.fee:
-                self.by_sender[transaction.sender_hash] = transaction
-                return True
-            return False
-        else:
-            if len(self.by_sender) < MAX_TRANSACTIONS:
-                self.by_sender[transaction.sender_hash] = transaction
-                return True
+        while len(self.min_heap) > 0 and not self.is_pooled(self.min_heap[0][2]):
+            heapq.heappop(self.min_heap)
+        if len(self.min_heap) == 0:
+            return None
+        return self.min_heap[0][2]
+
+    def add_transaction(self, transaction: Transaction, sender_state: Optional[UserState]) -> bool:
+        if sender_state is None:
+            raise ValueError('Sender user state not found')
+
+        # verify the transaction against the sender state after the pending
+        # transactions of the sender with lower nonces
+        chain = self.by_sender.get(transaction.sender_hash, dict())
+        previous_nonce = sender_state.nonce
+        balance = sender_state.balance
+        while previous_nonce + 1 < transaction.nonce and previous_nonce + 1 in chain:
+            previous_nonce += 1
+            balance -= chain[previous_nonce].amount
+        transaction.verify(balance, previous_nonce)
+
+        if transaction.nonce in chain:
+            old_transaction = chain[transaction.nonce]
+            if old_transaction.fee >= transaction.fee:
+                return False
 
+            # drop the later transactions the sender can no longer afford
+            chain[transaction.nonce] = transaction
+            self.push(transaction)
+            balance -= transaction.amount
+            nonce = transaction.nonce + 1
+            while nonce in chain and chain[nonce].amount <= balance:
+                balance -= chain[nonce].amount
+                nonce += 1
+            if nonce in chain:
+                self.remove_from(transaction.sender_hash, nonce)
+            return True
+
+        if self.count >= self.capacity:
             min_fee_transaction = self.get_min_fee()
-            if min_fee_transaction.fee < transaction.fee:
-                self.by_sender[transaction.sender_hash] = transaction
-                del self.by_sender[min_fee_transaction.sender_hash]
-                return True
-            return False
+            if min_fee_transaction.fee >= transaction.fee:
+                return False
+            if min_fee_transaction.sender_hash == transaction.sender_hash:
+                # the transaction follows on from the one that would be evicted
+                return False
+            self.remove_from(min_fee_transaction.sender_hash, min_fee_transaction.nonce)
+
+        self.by_sender.setdefault(transaction.sender_hash, chain)[transaction.nonce] = transaction
+        self.count += 1
+        self.push(transaction)
+        return True
 
     def filter(self, user_states: Dict[bytes, UserState]):
         new_transactions = dict()
-        for transaction in self.by_sender.values():
-            try:
-                state = user_states[transaction.sender_hash]
-                transaction.verify(state.balance, state.nonce)
-            except:
-                print("Removing transaction", transaction.txid, "from mempool")
-            else:
-                new_transactions[transaction.sender_hash] = transaction
+        count = 0
+        for sender_hash, chain in self.by_sender.items():
+            state = user_states.get(sender_hash)
+            if state is None:
+                continue
+
+            # keep the transactions that still follow on from the sender state
+            balance, previous_nonce = state.balance, state.nonce
+            new_chain = dict()
+            for nonce in sorted(chain):
+                transaction = chain[nonce]
+                if nonce <= previous_nonce:
+                    continue
+                try:
+                    transaction.verify(balance, previous_nonce)
+                except ValueError as exception:
+                    print("Removing transaction", transaction.txid, "from mempool", exception)
+                    break
+                new_chain[nonce] = transaction
+                balance -= transaction.amount
+                previous_nonce = nonce
+
+            if len(new_chain) > 0:
+                new_transactions[sender_hash] = new_chain
+                count += len(new_chain)
         self.by_sender = new_transactions
+        self.count = count
+        self.rebuild()
+
+    def revalidate(self, user_states: Dict[bytes, UserState], sender_hashes):
+        # only the senders changed by a block are checked, and only with the
+        # balance and nonce rules as the rest was verified when the
+        # transactions were added
+        for sender_hash in sender_hashes:
+            chain = self.by_sender.get(sender_hash)
+            if chain is None:
+                continue
+
+            state = user_states.get(sender_hash)
+            if state is None:
+                self.remove_from(sender_hash, min(chain))
+                continue
+
+            # forget the transactions that were included in the chain
+            for nonce in [nonce for nonce in chain if nonce <= state.nonce]:
+                del chain[nonce]
+                self.count -= 1
+
+            # keep the transactions that still follow on from the sender state
+            balance, next_nonce = state.balance, state.nonce + 1
+            while next_nonce in chain and chain[next_nonce].amount <= balance:
+                balance -= chain[next_nonce].amount
+                next_nonce += 1
+            for nonce in [nonce for nonce in chain if nonce >= next_nonce]:
+                print("Removing transaction", chain[nonce].txid, "from mempool")
+                del chain[nonce]
+                self.count -= 1
+
+            if len(chain) == 0:
+                del self.by_sender[sender_hash]
+        self.compact()
 
     def get_transactions(self) -> List[Transaction]:
-        return list(self.by_sender.values())
\ No newline at end of file
+        return [transaction for chain in self.by_sender.values() for transaction in chain.values()]
+
+    def get_top_transactions(self, count: int) -> List[Transaction]:
+        # walk the max heap from the root, the next highest fee is always a
+        # child of an entry that was already visited. A transaction waits
+        # until the transaction of its sender with the previous nonce was
+        # taken, so the transactions of a sender stay in nonce order.
+        transactions = []
+        taken = set()
+        waiting = dict()
+        candidates = [(self.max_heap[0], 0)] if len(self.max_heap) > 0 else []
+        while len(candidates) > 0 and len(transactions) < count:
+            entry, index = heapq.heappop(candidates)
+            transaction = entry[2]
+            if index is not None:
+                for child in (2 * index + 1, 2 * index + 2):
+                    if child < len(self.max_heap):
+                        heapq.heappush(candidates, (self.max_heap[child], child))
+
+            if not self.is_pooled(transaction):
+                continue
+            previous = (transaction.sender_hash, transaction.nonce - 1)
+            if transaction.nonce - 1 in self.by_sender[transaction.sender_hash] \
+                    and previous not in taken:
+                waiting[previous] = entry
+                continue
+
+            transactions.append(transaction)
+            key = (transaction.sender_hash, transaction.nonce)
+            taken.add(key)
+            if key in waiting:
+                heapq.heappush(candidates, (waiting.pop(key), None))
+        return transactions
\ No newline at end of file
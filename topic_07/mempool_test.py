@@ -0,0 +1,188 @@
+"""
+This module implements the tests for the mempool.
+"""
+
+import unittest
+from cryptography.hazmat.primitives.asymmetric import ec
+from blocks import UserState
+from mempool import Mempool
+from transactions import create_signed_transaction
+
+RECIPIENT_HASH = bytes.fromhex("3df8f04b3c159fdc6631c4b8b0874940344d173d")
+
+
+class TestSender:
+    """
+    A sender with a private key and an on-chain user state for testing.
+    """
+    def __init__(self, balance : int = 100_000, nonce : int = -1):
+        self.private_key = ec.generate_private_key(ec.SECP256K1)
+        self.state = UserState(balance, nonce)
+
+    def transaction(self, fee : int, nonce : int = None, amount : int = 1000):
+        """
+        Create a signed transaction of the sender.
+        """
+        if nonce is None:
+            nonce = self.state.nonce + 1
+        return create_signed_transaction(self.private_key, RECIPIENT_HASH,
+                                         amount, fee, nonce)
+
+
+class MempoolTest(unittest.TestCase):
+    """
+    Test the fee ordered mempool.
+    """
+    def add(self, mempool, sender, transaction) -> bool:
+        return mempool.add_transaction(transaction, sender.state)
+
+    def test_top_transactions(self):
+        """
+        Verify that the transactions with the highest fees are returned in
+        fee order.
+        """
+        mempool = Mempool(capacity=100)
+        fees = [(fee * 37) % 100 for fee in range(100)]
+        for fee in fees:
+            sender = TestSender()
+            self.assertTrue(self.add(mempool, sender, sender.transaction(fee)))
+
+        top = mempool.get_top_transactions(25)
+        self.assertEqual([t.fee for t in top], sorted(fees, reverse=True)[:25])
+        self.assertEqual(len(mempool.get_top_transactions(1000)), 100)
+
+    def test_replacement(self):
+        """
+        Verify that a transaction is only replaced by one with a higher fee
+        and that the replaced transaction is no longer returned.
+        """
+        mempool = Mempool(capacity=10)
+        sender = TestSender()
+        first = sender.transaction(5)
+        self.assertTrue(self.add(mempool, sender, first))
+        self.assertFalse(self.add(mempool, sender, sender.transaction(5)))
+
+        second = sender.transaction(10)
+        self.assertTrue(self.add(mempool, sender, second))
+        self.assertEqual(mempool.get_transactions(), [second])
+        self.assertEqual(mempool.get_top_transactions(5), [second])
+        self.assertIs(mempool.get_min_fee(), second)
+
+    def test_eviction(self):
+        """
+        Verify that the lowest fee transaction is evicted once the mempool
+        is full.
+        """
+        mempool = Mempool(capacity=3)
+        for fee in (4, 2, 6):
+            sender = TestSender()
+            self.add(mempool, sender, sender.transaction(fee))
+
+        sender = TestSender()
+        self.assertFalse(self.add(mempool, sender, sender.transaction(2)))
+        self.assertTrue(self.add(mempool, sender, sender.transaction(3)))
+        self.assertEqual(sorted(t.fee for t in mempool.get_transactions()), [3, 4, 6])
+        self.assertEqual(mempool.get_min_fee().fee, 3)
+
+    def test_many_evictions(self):
+        """
+        Verify that evicted transactions do not accumulate in the heaps.
+        """
+        mempool = Mempool(capacity=5)
+        for fee in range(1, 200):
+            other = TestSender()
+            self.assertTrue(self.add(mempool, other, other.transaction(fee)))
+
+        self.assertEqual(len(mempool.get_transactions()), 5)
+        self.assertLessEqual(len(mempool.min_heap), 10)
+        self.assertLessEqual(len(mempool.max_heap), 10)
+        self.assertEqual([t.fee for t in mempool.get_top_transactions(5)],
+                         [199, 198, 197, 196, 195])
+
+    def test_many_replacements(self):
+        """
+        Verify that the heaps stay consistent while they are compacted.
+        """
+        mempool = Mempool(capacity=5)
+        senders = [TestSender() for _ in range(5)]
+        for fee in range(1, 200):
+            sender = senders[fee % 5]
+            self.add(mempool, sender, sender.transaction(fee))
+
+        self.assertLessEqual(len(mempool.min_heap), 10)
+        self.assertLessEqual(len(mempool.max_heap), 10)
+        self.assertEqual([t.fee for t in mempool.get_top_transactions(5)],
+                         [199, 198, 197, 196, 195])
+        self.assertEqual(mempool.get_min_fee().fee, 195)
+
+    def test_nonce_chains(self):
+        """
+        Verify that a sender can queue consecutive nonces that are returned
+        in nonce order, and that gaps and unaffordable transactions are
+        rejected.
+        """
+        mempool = Mempool(capacity=10)
+        sender = TestSender(balance=3500)
+        other = TestSender()
+        chain = [sender.transaction(fee, nonce) for nonce, fee in enumerate([1, 50, 40])]
+        for transaction in chain:
+            self.assertTrue(self.add(mempool, sender, transaction))
+        self.assertTrue(self.add(mempool, other, other.transaction(45)))
+
+        with self.assertRaisesRegex(ValueError, 'Invalid nonce'):
+            self.add(mempool, sender, sender.transaction(60, 4, amount=100))
+        with self.assertRaisesRegex(ValueError, 'Balance too small'):
+            self.add(mempool, sender, sender.transaction(60, 3))
+
+        top = mempool.get_top_transactions(10)
+        self.assertEqual([t.fee for t in top], [45, 1, 50, 40])
+        self.assertEqual([t.nonce for t in top if t.sender_hash == chain[0].sender_hash], [0, 1, 2])
+
+        # a larger replacement drops the transactions that are unaffordable
+        self.assertTrue(self.add(mempool, sender, sender.transaction(60, 1, amount=2000)))
+        self.assertEqual(sorted(t.nonce for t in mempool.get_transactions()
+                                if t.sender_hash == chain[0].sender_hash), [0, 1])
+
+    def test_filter(self):
+        """
+        Verify that the transactions included in a block are removed and the
+        rest of the nonce chain is kept.
+        """
+        mempool = Mempool(capacity=10)
+        sender = TestSender()
+        chain = [sender.transaction(10, nonce) for nonce in range(3)]
+        for transaction in chain:
+            self.add(mempool, sender, transaction)
+
+        mempool.filter({chain[0].sender_hash: UserState(99_000, 0)})
+        self.assertEqual(mempool.get_transactions(), chain[1:])
+        self.assertEqual(mempool.count, 2)
+
+    def test_revalidate(self):
+        """
+        Verify that only the chains of the touched senders are checked
+        against their new state.
+        """
+        mempool = Mempool(capacity=10)
+        sender = TestSender()
+        other = TestSender()
+        chain = [sender.transaction(10, nonce) for nonce in range(3)]
+        for transaction in chain:
+            self.add(mempool, sender, transaction)
+        other_transaction = other.transaction(10)
+        self.add(mempool, other, other_transaction)
+
+        # the first transaction was included and the balance now only
+        # covers one more transaction
+        user_states = {chain[0].sender_hash: UserState(1500, 0)}
+        mempool.revalidate(user_states, {chain[0].sender_hash})
+        self.assertEqual(mempool.get_transactions(), [chain[1], other_transaction])
+        self.assertEqual(mempool.count, 2)
+
+        mempool.revalidate(user_states, {other_transaction.sender_hash})
+        self.assertEqual(mempool.get_transactions(), [chain[1]])
+        self.assertEqual(mempool.get_top_transactions(5), [chain[1]])
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,110 @@
+"""
+This module implements the SHA-256 midstate of the constant part of a
+block, so that the miners only have to hash the final block or blocks
+of the message for every nonce.
+"""
+
+import struct
+
+# the SHA-256 round constants
+K = [
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2]
+
+# the SHA-256 initial hash value
+INITIAL_STATE = (
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+    0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
+
+# the number of bytes in the nonce that follows the block data
+NONCE_SIZE = 8
+
+
+def rotate_right(value : int, count : int) -> int:
+    return ((value >> count) | (value << (32 - count))) & 0xffffffff
+
+
+def compress(state : tuple, chunk : bytes) -> tuple:
+    """
+    Apply the SHA-256 compression function to a 64 byte chunk.
+
+    Parameters:
+        state (tuple): The eight 32 bit words of the hash state.
+        chunk (bytes): The 64 byte chunk of the message.
+
+    Returns:
+        tuple: The new hash state.
+    """
+    w = list(struct.unpack('>16L', chunk))
+    for i in range(16, 64):
+        s0 = rotate_right(w[i - 15], 7) ^ rotate_right(w[i - 15], 18) ^ (w[i - 15] >> 3)
+        s1 = rotate_right(w[i - 2], 17) ^ rotate_right(w[i - 2], 19) ^ (w[i - 2] >> 10)
+        w.append((w[i - 16] + s0 + w[i - 7] + s1) & 0xffffffff)
+
+    a, b, c, d, e, f, g, h = state
+    for i in range(64):
+        s1 = rotate_right(e, 6) ^ rotate_right(e, 11) ^ rotate_right(e, 25)
+        ch = (e & f) ^ (~e & g)
+        temp1 = (h + s1 + ch + K[i] + w[i]) & 0xffffffff
+        s0 = rotate_right(a, 2) ^ rotate_right(a, 13) ^ rotate_right(a, 22)
+        maj = (a & b) ^ (a & c) ^ (b & c)
+        temp2 = (s0 + maj) & 0xffffffff
+        a, b, c, d, e, f, g, h = \
+            (temp1 + temp2) & 0xffffffff, a, b, c, (d + temp1) & 0xffffffff, e, f, g
+
+    return tuple((x + y) & 0xffffffff for x, y in zip(state, (a, b, c, d, e, f, g, h)))
+
+
+class Midstate:
+    """
+    The SHA-256 state after the complete 64 byte chunks of the block data,
+    and the padded final chunks that only differ in the nonce.
+    """
+    def __init__(self, block_data : bytes):
+        """
+        Calculate the midstate of the block data the nonce is appended to.
+
+        Parameters:
+            block_data (bytes): The block data without the nonce, as
+                returned by Block.to_bytes.
+        """
+        block_data = bytes(block_data)
+        prefix_length = len(block_data) - len(block_data) % 64
+
+        self.state = INITIAL_STATE
+        for offset in range(0, prefix_length, 64):
+            self.state = compress(self.state, block_data[offset:offset + 64])
+
+        # the final chunks with a zero nonce, the padding and the length
+        message_length = len(block_data) + NONCE_SIZE
+        tail = block_data[prefix_length:] + bytes(NONCE_SIZE) + b'\x80'
+        tail += bytes(-(len(tail) + 8) % 64)
+        tail += struct.pack('>Q', message_length * 8)
+
+        self.tail = tail
+        self.nonce_offset = len(block_data) - prefix_length
+
+    def hash(self, nonce : int) -> bytes:
+        """
+        Calculate the hash of the block data followed by a nonce.
+
+        Parameters:
+            nonce (int): The nonce.
+
+        Returns:
+            bytes: The SHA-256 digest, equal to the block id of the block.
+        """
+        tail = bytearray(self.tail)
+        tail[self.nonce_offset:self.nonce_offset + NONCE_SIZE] = \
+            nonce.to_bytes(NONCE_SIZE, byteorder='little')
+
+        state = self.state
+        for offset in range(0, len(tail), 64):
+            state = compress(state, bytes(tail[offset:offset + 64]))
+        return struct.pack('>8L', *state)
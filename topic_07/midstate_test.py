@@ -0,0 +1,32 @@
+"""
+This module implements the tests for the SHA-256 midstate.
+"""
+
+import os
+import hashlib
+import unittest
+from midstate import Midstate
+
+
+class MidstateTest(unittest.TestCase):
+    """
+    Test the SHA-256 midstate.
+    """
+    def test_hash(self):
+        """
+        Verify that hashing from the midstate matches hashlib for block data
+        lengths that need one and two final chunks.
+        """
+        for length in [0, 12, 44, 55, 56, 63, 64, 76, 108, 876]:
+            with self.subTest(length=length):
+                block_data = os.urandom(length)
+                midstate = Midstate(block_data)
+                self.assertEqual(len(midstate.tail), 64 if length % 64 < 48 else 128)
+
+                for nonce in [0, 1, 2 ** 40 + 7, 2 ** 64 - 1]:
+                    expected = hashlib.sha256(block_data + nonce.to_bytes(8, 'little')).digest()
+                    self.assertEqual(midstate.hash(nonce), expected)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
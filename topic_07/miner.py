@@ -1,48 +1,159 @@
+import logging
+import threading
 import time
-from typing import List
+from typing import List, Optional
 
 from pykka import ThreadingActor
 
 from blocks import mine_block
+from mining_backend import nonce_partition
+from mining_metrics import get_sink
 from node import NodeStateSummary
 from transactions import Transaction
 
+# a template is rebuilt after this many seconds so the timestamp stays current
+TEMPLATE_LIFETIME = 15.0
+
+# the number of transactions in a block template
+BLOCK_TRANSACTIONS = 25
+
 
 class Miner(ThreadingActor):
-    def __init__(self, node, address):
+    def __init__(self, node, address, backend: Optional[str] = None,
+                 worker_id: int = 0, worker_count: int = 1):
         super().__init__()
         self.node = node
         self.address = address
+        self.backend = backend
+
+        # miners sharing an address search their own slice of the nonces
+        self.start_nonce, self.end_nonce = nonce_partition(worker_id, worker_count)
+        self.last_template = None
+
+        # mining runs on its own thread so the actor can receive the tip and
+        # mempool changes of the node, which abandon the current template
+        self.mining_thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.stopping = False
+        self.template_block_id: Optional[bytes] = None
+        self.template_min_fee: Optional[int] = None
+        self.template_stale = False
+
+        self.templates = 0
+        self.blocks_found = 0
+        self.stale_templates = 0
+        self.refreshed_templates = 0
+        self.stale_seconds = 0.0
+        self.rolled_timestamps = 0
+
+    def on_start(self):
+        self.node.subscribe(self.actor_ref)
+
+    def on_stop(self):
+        self.stopping = True
+        self.stop_event.set()
+        if self.mining_thread is not None and self.mining_thread is not threading.current_thread():
+            self.mining_thread.join()
+
+    def tip_changed(self, summary: NodeStateSummary):
+        # the template extends a block that is no longer the tip
+        if summary.block_id != self.template_block_id:
+            self.template_stale = True
+            self.stop_event.set()
+
+    def mempool_changed(self, transactions: List[Transaction]):
+        # a transaction pays more than the cheapest one in the template, or
+        # there is room for it
+        if self.template_min_fee is None or any(t.fee > self.template_min_fee for t in transactions):
+            self.stop_event.set()
+
+    def get_metrics(self) -> dict:
+        return dict(
+            templates=self.templates,
+            blocks_found=self.blocks_found,
+            stale_templates=self.stale_templates,
+            refreshed_templates=self.refreshed_templates,
+            stale_seconds=self.stale_seconds,
+            rolled_timestamps=self.rolled_timestamps)
 
     def mine_block(self):
-        print("About to mine block")
+        # clear the stop event before the template is read, so a change
+        # that arrives while it is built abandons it
+        self.stop_event.clear()
+        self.template_stale = False
+        summary: NodeStateSummary = self.node.state_summary().get()
+        difficulty = self.node.current_difficulty().get()
+        transactions: List[Transaction] = self.node.get_top_transactions(BLOCK_TRANSACTIONS).get()
+
+        self.template_block_id = summary.block_id
+        self.template_min_fee = None
+        if len(transactions) == BLOCK_TRANSACTIONS:
+            self.template_min_fee = min(transaction.fee for transaction in transactions)
+        self.templates += 1
+        sink = get_sink()
+        sink.increment('zimcoin_templates_total')
+
+        # a template with the same tip and transactions as the last one
+        # gets a later timestamp, so its nonces are not searched again
+        start = time.time()
+        timestamp = int(start)
+        template = (summary.block_id, [transaction.txid for transaction in transactions])
+        if self.last_template is not None and self.last_template[0] == template:
+            timestamp = max(timestamp, self.last_template[1] + 1)
+
         while True:
-            summary: NodeStateSummary = self.node.state_summary().get()
-            time.sleep(30)
-            difficulty = self.node.current_difficulty().get()
-            transactions: List[Transaction] = self.node.get_transactions().get()
-            transactions.sort(key=lambda t: t.fee, reverse=True)
-            transactions = transactions[:25]
-
-            print("Attempting mining with difficulty", difficulty)
+            self.last_template = (template, timestamp)
             block = mine_block(
                 summary.block_id or bytes(32),
                 summary.height,
                 self.address,
                 transactions,
-                int(time.time()),
+                timestamp,
                 difficulty,
-                time.time() + 15.0
+                start + TEMPLATE_LIFETIME,
+                stop_event=self.stop_event,
+                backend=self.backend,
+                start_nonce=self.start_nonce,
+                end_nonce=self.end_nonce
             )
-            if block is not None:
+            if block.nonce != 0 or self.stop_event.is_set() or time.time() >= start + TEMPLATE_LIFETIME:
                 break
 
-        print("Mined block", block.block_id.hex())
-        self.node.received_blocks([block])
+            # the slice of the nonces was searched, roll the timestamp
+            timestamp += 1
+            self.rolled_timestamps += 1
+            sink.increment('zimcoin_rolled_timestamps_total')
 
         if block.nonce != 0:
-            time.sleep(120)
+            logging.info('Mined block %s', block.block_id.hex())
+            try:
+                self.node.received_blocks([block]).get()
+            except Exception as exception:
+                # the tip moved while the block was mined, so the work on
+                # it was stale
+                logging.warning('Mined block %s was rejected: %s', block.block_id.hex(), exception)
+                self.stale_templates += 1
+                sink.increment('zimcoin_templates_abandoned_total', labels=dict(reason='stale'))
+            else:
+                self.blocks_found += 1
+                sink.increment('zimcoin_blocks_found_total')
+        elif self.template_stale:
+            # count the time that would have been spent on the stale
+            # template until its cutoff time
+            stale_seconds = max(0.0, start + TEMPLATE_LIFETIME - time.time())
+            self.stale_templates += 1
+            self.stale_seconds += stale_seconds
+            sink.increment('zimcoin_templates_abandoned_total', labels=dict(reason='stale'))
+            sink.increment('zimcoin_stale_seconds_total', stale_seconds)
+        elif self.stop_event.is_set() and not self.stopping:
+            self.refreshed_templates += 1
+            sink.increment('zimcoin_templates_abandoned_total', labels=dict(reason='refreshed'))
+
+    def mine_blocks(self):
+        while not self.stopping:
+            self.mine_block()
 
     def start_mining(self):
-        while True:
-            self.mine_block()
\ No newline at end of file
+        if self.mining_thread is None:
+            self.mining_thread = threading.Thread(target=self.mine_blocks, daemon=True)
+            self.mining_thread.start()
\ No newline at end of file
@@ -1,15 +1,116 @@
 """
-This module implements a wrapper around the Zimcoin OpenCL miner
-to allow it to be exposed as a method in the block class.
+This module implements a wrapper around the Zimcoin miners to allow them
+to be exposed as a method in the block class. The miner runs on an OpenCL
+device when one is available, and on the CPU otherwise.
 """
 
+import os
+
+# the names of the mining backends
+BACKEND_AUTO = 'auto'
+BACKEND_OPENCL = 'opencl'
+BACKEND_CPU = 'cpu'
+BACKEND_MULTI = 'multi'
+
+# the backend used when none is given, set by the ZIMCOIN_MINER_BACKEND
+# environment variable
+DEFAULT_BACKEND = os.environ.get('ZIMCOIN_MINER_BACKEND', BACKEND_AUTO)
+
+# the miners that were created, by backend and options
+_miners = {}
+
+
+def opencl_device_count() -> int:
+    """
+    Get the number of OpenCL devices to mine on, 0 if pyopencl is not
+    installed.
+    """
+    try:
+        import pyopencl as cl
+    except ImportError:
+        return 0
+
+    try:
+        return sum(len(platform.get_devices()) for platform in cl.get_platforms())
+    except cl.Error:
+        # raised when no platform is installed
+        return 0
+
+
+def select_backend(backend : str = None) -> str:
+    """
+    Get the backend to mine with, resolving BACKEND_AUTO to the scheduler
+    if there are several OpenCL devices, the OpenCL backend if there is
+    one and the CPU backend otherwise.
+    """
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    assert backend in (BACKEND_AUTO, BACKEND_OPENCL, BACKEND_CPU, BACKEND_MULTI), \
+        "Unknown mining backend"
+
+    if backend == BACKEND_AUTO:
+        device_count = opencl_device_count()
+        if device_count > 1:
+            backend = BACKEND_MULTI
+        elif device_count == 1:
+            backend = BACKEND_OPENCL
+        else:
+            backend = BACKEND_CPU
+    return backend
+
+
+def get_miner(platform_id : int = 0, device_id : int = 0,
+              window_size : int = None, backend : str = None):
+    """
+    Get the long-lived miner for a backend, creating it the first time.
+
+    Parameters:
+        platform_id (int): The OpenCL platform id of the miner.
+        device_id (int): The OpenCL device id of the miner.
+        window_size (int): The window size of the miner, defaults to
+            the tuned profile of the device.
+        backend (str): The mining backend, BACKEND_AUTO, BACKEND_OPENCL,
+            BACKEND_CPU or BACKEND_MULTI, defaults to DEFAULT_BACKEND.
+
+    Returns:
+        MiningBackend: The miner.
+    """
+    backend = select_backend(backend)
+
+    if backend == BACKEND_CPU:
+        key = (backend,)
+        if key not in _miners:
+            from cpu_miner import CpuMiner
+            _miners[key] = CpuMiner()
+        return _miners[key]
+
+    if backend == BACKEND_MULTI:
+        key = (backend, window_size)
+        if key not in _miners:
+            from mining_scheduler import MiningScheduler
+            _miners[key] = MiningScheduler(window_size=window_size)
+        return _miners[key]
+
+    key = (backend, platform_id, device_id, window_size)
+    if key not in _miners:
+        from zimcoin_miner import ZimcoinMiner
+        _miners[key] = ZimcoinMiner(
+            platform_id=platform_id,
+            device_id=device_id,
+            window_size=window_size)
+    return _miners[key]
+
+
 # This method is a wrapper function around the miner in the Miner class.
 def mine_block(previous : bytes, height : int, miner : bytes,
                transactions : list, timestamp : int,
                difficulty : int,
                cutoff_time: int = None,
                platform_id : int = 0, device_id : int = 0,
-               window_size : int = 1e5):
+               window_size : int = None,
+               stop_event = None,
+               backend : str = None,
+               start_nonce : int = 0, end_nonce : int = 2 ** 64):
     """
     Mine a block.
 
@@ -20,21 +121,25 @@ def mine_block(previous : bytes, height : int, miner : bytes,
         transactions (list): The list of transactions in the block.
         timestamp (int): The unix timestamp of the block.
         difficulty (int): The difficulty of the block.
+        cutoff_time (int): The unix time at which to give up mining.
         platform_id (int): The OpenCL platform id of the miner.
         device_id (int): The OpenCL device id of the miner.
-        window_size (int): The window size of the miner.
+        window_size (int): The window size of the miner, defaults to
+            the tuned profile of the device.
+        stop_event (threading.Event): Abandon the block when it is set.
+        backend (str): The mining backend, defaults to DEFAULT_BACKEND.
+        start_nonce (int): The first nonce to try.
+        end_nonce (int): The nonce after the last one to try.
 
     Returns:
         Block: The mined block.
     """
-    from zimcoin_miner import ZimcoinMiner
-
-    # create a miner
-    zimcoin_miner = ZimcoinMiner(
+    # get the miner for the backend
+    zimcoin_miner = get_miner(
         platform_id=platform_id,
         device_id=device_id,
         window_size=window_size,
-        cutoff_time=cutoff_time)
+        backend=backend)
 
     # mine the block and return it
     return zimcoin_miner.mine(
@@ -43,4 +148,8 @@ def mine_block(previous : bytes, height : int, miner : bytes,
         miner=miner,
         transactions=transactions,
         timestamp=timestamp,
-        difficulty=difficulty)
+        difficulty=difficulty,
+        cutoff_time=cutoff_time,
+        stop_event=stop_event,
+        start_nonce=start_nonce,
+        end_nonce=end_nonce)
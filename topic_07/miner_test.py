@@ -0,0 +1,180 @@
+"""
+This module implements the tests for the miner actor.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from time import time, sleep
+from pykka import ActorRegistry, ThreadingActor
+from miner import Miner
+from miner_helper import BACKEND_CPU, BACKEND_OPENCL, opencl_device_count
+from mining_backend import NONCE_LIMIT, nonce_partition
+from node import Node, NodeStateSummary
+
+MINER_ADDRESS = bytes.fromhex("3df8f04b3c159fdc6631c4b8b0874940344d173d")
+
+
+def wait_for(condition, timeout : float = 30.0) -> bool:
+    """
+    Wait until a condition is met or the timeout expires.
+    """
+    end = time() + timeout
+    while time() < end:
+        if condition():
+            return True
+        sleep(0.01)
+    return False
+
+
+class StubNode(ThreadingActor):
+    """
+    A node with a tip that only changes when it is told to and a block that
+    cannot be mined.
+    """
+    def __init__(self, difficulty : int = 2 ** 127, reject : bool = False):
+        super().__init__()
+        self.summary = NodeStateSummary(1, bytes([1] * 32), 1000)
+        self.difficulty = difficulty
+        self.templates = threading.Semaphore(0)
+        self.blocks = []
+        self.reject = reject
+
+    def subscribe(self, subscriber):
+        self.subscriber = subscriber
+
+    def state_summary(self) -> NodeStateSummary:
+        return self.summary
+
+    def current_difficulty(self) -> int:
+        self.templates.release()
+        return self.difficulty
+
+    def get_top_transactions(self, count : int) -> list:
+        return []
+
+    def received_blocks(self, blocks : list):
+        if self.reject:
+            raise ValueError("The total difficulty of the new chain is lower than the old chain")
+        self.blocks.extend(blocks)
+
+    def set_tip(self, block_id : bytes):
+        self.summary = NodeStateSummary(2, block_id, 2000)
+        self.subscriber.proxy().tip_changed(self.summary)
+
+
+class MinerTest(unittest.TestCase):
+    """
+    Test that the miner follows the tip of the node. The CPU backend is
+    used as it checks the stop event between small chunks of nonces.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ActorRegistry.stop_all()
+        shutil.rmtree(self.directory)
+
+    def test_mines_blocks(self):
+        """
+        Verify that the miner extends the chain of the node without waiting
+        between blocks.
+        """
+        node = Node.start(os.path.join(self.directory, 'blocks.sqlite')).proxy()
+        miner = Miner.start(node, MINER_ADDRESS, BACKEND_CPU).proxy()
+        miner.start_mining()
+
+        self.assertTrue(wait_for(lambda: node.state_summary().get().height >= 3))
+
+        # a block is counted once the node returns from accepting it
+        self.assertTrue(wait_for(lambda: miner.get_metrics().get()['blocks_found'] >= 3))
+
+    def test_tip_changed(self):
+        """
+        Verify that a new tip abandons the template and is mined on at once.
+        """
+        stub = StubNode.start()
+        templates = stub.proxy().templates.get()
+        miner = Miner.start(stub.proxy(), MINER_ADDRESS, BACKEND_CPU).proxy()
+        miner.start_mining()
+        self.assertTrue(templates.acquire(timeout=10))
+
+        stub.proxy().set_tip(bytes([2] * 32)).get()
+        self.assertTrue(templates.acquire(timeout=5))
+        self.assertTrue(wait_for(lambda: miner.template_block_id.get() == bytes([2] * 32)))
+
+        metrics = miner.get_metrics().get()
+        self.assertEqual(metrics['stale_templates'], 1)
+        self.assertGreater(metrics['stale_seconds'], 0)
+
+        # the same tip does not abandon the template
+        miner.tip_changed(stub.proxy().state_summary().get()).get()
+        self.assertFalse(templates.acquire(timeout=0.5))
+
+    @unittest.skipIf(opencl_device_count() == 0, "No OpenCL device")
+    def test_tip_changed_opencl(self):
+        """
+        Verify that the OpenCL backend abandons a template soon after the
+        tip changes, as its launches are sized to the target latency.
+        """
+        stub = StubNode.start()
+        templates = stub.proxy().templates.get()
+        miner = Miner.start(stub.proxy(), MINER_ADDRESS, BACKEND_OPENCL).proxy()
+        miner.start_mining()
+        self.assertTrue(templates.acquire(timeout=30))
+        sleep(0.5)
+
+        stub.proxy().set_tip(bytes([2] * 32)).get()
+        self.assertTrue(templates.acquire(timeout=5))
+        self.assertTrue(wait_for(lambda: miner.template_block_id.get() == bytes([2] * 32), 5))
+        self.assertEqual(miner.get_metrics().get()['stale_templates'], 1)
+
+    def test_rejected_block(self):
+        """
+        Verify that the miner keeps mining when the node rejects a block,
+        and counts the block as stale work.
+        """
+        stub = StubNode.start(1000, reject=True)
+        miner = Miner.start(stub.proxy(), MINER_ADDRESS, BACKEND_CPU).proxy()
+        miner.start_mining()
+
+        self.assertTrue(wait_for(lambda: miner.get_metrics().get()['stale_templates'] >= 2))
+        self.assertEqual(miner.get_metrics().get()['blocks_found'], 0)
+        self.assertTrue(miner.mining_thread.get().is_alive())
+
+    def test_nonce_partition(self):
+        """
+        Verify that the slices of the workers are disjoint and cover the
+        nonces.
+        """
+        slices = [nonce_partition(worker_id, 3) for worker_id in range(3)]
+        self.assertEqual(slices[0][0], 0)
+        self.assertEqual(slices[-1][1], NONCE_LIMIT)
+        for (_, end), (start, _) in zip(slices, slices[1:]):
+            self.assertEqual(end, start)
+        self.assertEqual(nonce_partition(1, 2, 10, 20), (15, 20))
+
+    def test_roll_timestamp(self):
+        """
+        Verify that a worker with a small slice of the nonces rolls the
+        timestamp once the slice is searched and only mines in its slice.
+        """
+        stub = StubNode.start(2 ** 20)
+        worker_count = NONCE_LIMIT // 5000
+        miner = Miner.start(stub.proxy(), MINER_ADDRESS, BACKEND_CPU, 1, worker_count).proxy()
+        miner.start_mining()
+
+        start = int(time())
+        self.assertTrue(wait_for(lambda: len(stub.proxy().blocks.get()) > 0))
+        self.assertGreater(miner.get_metrics().get()['rolled_timestamps'], 0)
+
+        block = stub.proxy().blocks.get()[0]
+        self.assertTrue(block.verify_proof_of_work())
+        self.assertTrue(5000 <= block.nonce < 10_000)
+        self.assertGreater(block.timestamp, start)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,197 @@
+"""
+This module implements the interface shared by the mining backends, so
+that the node can mine with OpenCL or on the CPU through the same calls.
+"""
+
+import logging
+import threading
+from abc import ABC, abstractmethod
+from time import time, perf_counter
+from blocks import Block
+from mining_metrics import get_sink
+
+# the nonces are 64 bit integers below this limit
+NONCE_LIMIT = 2 ** 64
+
+
+def nonce_partition(worker_id : int, worker_count : int,
+                    start_nonce : int = 0, end_nonce : int = NONCE_LIMIT) -> tuple:
+    """
+    Get the slice of a range of nonces searched by one of several workers,
+    so that workers mining the same block never try the same nonce.
+
+    Parameters:
+        worker_id (int): The id of the worker, from 0 to worker_count - 1.
+        worker_count (int): The number of workers.
+        start_nonce (int): The first nonce of the range.
+        end_nonce (int): The nonce after the range.
+
+    Returns:
+        tuple: The first nonce of the slice and the nonce after it.
+    """
+    assert 0 <= worker_id < worker_count, "Invalid worker id"
+    size = (end_nonce - start_nonce) // worker_count
+    start = start_nonce + worker_id * size
+    end = end_nonce if worker_id == worker_count - 1 else start + size
+    return start, end
+
+
+class MiningBackend(ABC):
+    """
+    A mining backend searches the nonces of a block until the proof of
+    work is met, the cutoff time is reached or the stop event is set.
+    """
+    # the name of the backend, used to select it in miner_helper
+    name = None
+
+    def __init__(self, cutoff_time : int = None):
+        """
+        Initialize the backend.
+
+        Parameters:
+            cutoff_time (int): The default unix time at which to give up
+                mining a block.
+        """
+        self.cutoff_time = cutoff_time
+
+        # the number of nonces tried for the last block that was mined
+        self.hash_count = 0
+
+    @property
+    def device_name(self) -> str:
+        """
+        Get the name of the device the backend mines on.
+        """
+        return self.name
+
+    @staticmethod
+    def create_block(previous : bytes, height : int, miner : bytes,
+                     transactions : list, timestamp : int,
+                     difficulty : int) -> Block:
+        """
+        Create the block that is mined, without a block id or nonce.
+        """
+        return Block(
+            previous=previous,
+            height=height,
+            miner=miner,
+            transactions=transactions,
+            timestamp=timestamp,
+            difficulty=difficulty,
+            block_id=None,
+            nonce=None)
+
+    @staticmethod
+    def finish_block(block : Block, nonce : int) -> Block:
+        """
+        Set the nonce found for a block and calculate its block id. A nonce
+        of 0 means no nonce was found.
+        """
+        block.nonce = nonce
+        block.block_id = block.calculate_block_id()
+        return block
+
+    @staticmethod
+    def is_stopped(cutoff_time : float = None,
+                   stop_event : threading.Event = None) -> bool:
+        """
+        Check if mining should stop because the cutoff time was reached or
+        the stop event was set.
+        """
+        return (cutoff_time is not None and time() >= cutoff_time) \
+            or (stop_event is not None and stop_event.is_set())
+
+    @abstractmethod
+    def search(self, block_data : bytes, target : int,
+               cutoff_time : float = None, stop_event : threading.Event = None,
+               start_nonce : int = 0, end_nonce : int = NONCE_LIMIT) -> int:
+        """
+        Search a range of nonces for one that, appended to the block data,
+        hashes below the target. Sets hash_count to the number of nonces
+        that were tried.
+
+        Parameters:
+            block_data (bytes): The block data without the nonce, as
+                returned by Block.to_bytes.
+            target (int): The target the hash must be below.
+            cutoff_time (float): The unix time at which to give up.
+            stop_event (threading.Event): Give up when it is set.
+            start_nonce (int): The first nonce to try.
+            end_nonce (int): The nonce after the last one to try, so that
+                several backends can search disjoint ranges.
+
+        Returns:
+            int: The nonce that was found, or 0 if the search was stopped
+                or the range was searched without finding one.
+        """
+
+    def record_search(self, nonce : int, elapsed : float,
+                      cutoff_time : float = None, stop_event : threading.Event = None) -> str:
+        """
+        Record the hashes, hashrate and result of a search to the metrics
+        sink.
+
+        Parameters:
+            nonce (int): The nonce that was found, or 0.
+            elapsed (float): The time the search took in seconds.
+            cutoff_time (float): The cutoff time of the search.
+            stop_event (threading.Event): The stop event of the search.
+
+        Returns:
+            str: The result of the search, 'found', 'stopped', 'cutoff' or
+                'exhausted'.
+        """
+        if nonce != 0:
+            result = 'found'
+        elif stop_event is not None and stop_event.is_set():
+            result = 'stopped'
+        elif cutoff_time is not None and time() >= cutoff_time:
+            result = 'cutoff'
+        else:
+            result = 'exhausted'
+
+        labels = dict(backend=self.name)
+        sink = get_sink()
+        sink.increment('zimcoin_mining_hashes_total', self.hash_count, labels)
+        sink.increment('zimcoin_mining_seconds_total', elapsed, labels)
+        sink.increment('zimcoin_mining_searches_total', 1, dict(labels, result=result))
+        if elapsed > 0:
+            sink.set('zimcoin_mining_hashrate', self.hash_count / elapsed, labels)
+        if nonce != 0:
+            sink.observe('zimcoin_mining_solution_seconds', elapsed, labels)
+        return result
+
+    def mine(self, previous : bytes, height : int, miner : bytes,
+             transactions : list, timestamp : int,
+             difficulty : int, cutoff_time : int = None,
+             stop_event : threading.Event = None,
+             start_nonce : int = 0, end_nonce : int = NONCE_LIMIT) -> Block:
+        """
+        Mine a block. The cutoff time defaults to the one the backend was
+        created with, and setting the stop event abandons the block, for
+        example when the template changed.
+
+        Returns:
+            Block: The mined block, with a nonce of 0 if the block was
+                abandoned or the range was searched before a nonce was
+                found.
+        """
+        if cutoff_time is None:
+            cutoff_time = self.cutoff_time
+
+        input_block = self.create_block(previous, height, miner, transactions,
+                                        timestamp, difficulty)
+        start = perf_counter()
+        nonce = self.search(bytes(input_block.to_bytes()), input_block.calculate_target(),
+                            cutoff_time, stop_event, start_nonce, end_nonce)
+        elapsed = perf_counter() - start
+        result = self.record_search(nonce, elapsed, cutoff_time, stop_event)
+
+        logging.info('Mining at difficulty %d on %s: %s after %d hashes in %.3fs, nonce %d',
+                     difficulty, self.device_name, result, self.hash_count, elapsed, nonce)
+        return self.finish_block(input_block, nonce)
+
+    def close(self):
+        """
+        Release the resources held by the backend.
+        """
@@ -0,0 +1,187 @@
+"""
+This module implements the metrics recorded while mining, so that the
+hashrate and kernel latency of mining hosts can be monitored. The metrics
+are recorded to a sink, which keeps them in process by default and can be
+replaced to send them elsewhere.
+"""
+
+import threading
+
+# the type and help text of every metric
+METRICS = {
+    'zimcoin_mining_hashes_total':
+        ('counter', 'The number of nonces tried.'),
+    'zimcoin_mining_seconds_total':
+        ('counter', 'The time spent searching for nonces.'),
+    'zimcoin_mining_hashrate':
+        ('gauge', 'The hashes per second of the last search.'),
+    'zimcoin_mining_searches_total':
+        ('counter', 'The number of searches, by whether a nonce was found, the cutoff time '
+                    'was reached, the search was stopped or the nonces were exhausted.'),
+    'zimcoin_mining_solution_seconds':
+        ('summary', 'The time taken to find the nonce of a block.'),
+    'zimcoin_kernel_seconds':
+        ('summary', 'The time a kernel launch ran on the device.'),
+    'zimcoin_host_seconds':
+        ('summary', 'The time the host spent queueing a kernel launch and reading its result.'),
+    'zimcoin_templates_total':
+        ('counter', 'The number of block templates mined.'),
+    'zimcoin_templates_abandoned_total':
+        ('counter', 'The number of block templates abandoned, by whether the tip changed '
+                    'or the template was refreshed.'),
+    'zimcoin_blocks_found_total':
+        ('counter', 'The number of blocks mined.'),
+    'zimcoin_stale_seconds_total':
+        ('counter', 'The time that would have been spent on templates made stale by a new tip.'),
+    'zimcoin_rolled_timestamps_total':
+        ('counter', 'The number of times the timestamp of a template was rolled.'),
+}
+
+# the content type of the Prometheus text format
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def metric_key(name : str, labels : dict = None) -> tuple:
+    """
+    Get the key a metric is stored under, its name and sorted labels.
+    """
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def format_labels(labels : tuple, extra : tuple = ()) -> str:
+    """
+    Format the labels of a metric in the Prometheus text format.
+    """
+    labels = labels + extra
+    if len(labels) == 0:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class MetricsSink:
+    """
+    A metrics sink receives the metrics recorded while mining. The base
+    sink discards them.
+    """
+
+    def increment(self, name : str, value : float = 1.0, labels : dict = None):
+        """
+        Add to a counter.
+
+        Parameters:
+            name (str): The name of the metric, one of METRICS.
+            value (float): The amount to add.
+            labels (dict): The labels of the counter.
+        """
+
+    def set(self, name : str, value : float, labels : dict = None):
+        """
+        Set a gauge to a value.
+        """
+
+    def observe(self, name : str, value : float, labels : dict = None):
+        """
+        Record an observation of a summary, such as the duration of a
+        kernel launch.
+        """
+
+    def to_prometheus(self) -> str:
+        """
+        Get the metrics in the Prometheus text format, empty for sinks
+        that send the metrics elsewhere.
+        """
+        return ''
+
+
+class InProcessMetrics(MetricsSink):
+    """
+    Keep the metrics in process, to be read by the node or exported in
+    the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # the values of the counters and gauges, and the count and sum of
+        # the summaries, by name and labels
+        self.values = dict()
+        self.summaries = dict()
+
+    def increment(self, name : str, value : float = 1.0, labels : dict = None):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + value
+
+    def set(self, name : str, value : float, labels : dict = None):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.values[key] = float(value)
+
+    def observe(self, name : str, value : float, labels : dict = None):
+        key = metric_key(name, labels)
+        with self.lock:
+            count, total = self.summaries.get(key, (0, 0.0))
+            self.summaries[key] = (count + 1, total + value)
+
+    def get(self, name : str, labels : dict = None) -> float:
+        """
+        Get the value of a counter or gauge, 0 if it was never recorded.
+        """
+        with self.lock:
+            return self.values.get(metric_key(name, labels), 0.0)
+
+    def get_summary(self, name : str, labels : dict = None) -> tuple:
+        """
+        Get the number and sum of the observations of a summary.
+        """
+        with self.lock:
+            return self.summaries.get(metric_key(name, labels), (0, 0.0))
+
+    def reset(self):
+        """
+        Clear every metric.
+        """
+        with self.lock:
+            self.values.clear()
+            self.summaries.clear()
+
+    def to_prometheus(self) -> str:
+        with self.lock:
+            values = dict(self.values)
+            summaries = dict(self.summaries)
+
+        lines = []
+        for name in sorted({key[0] for key in values} | {key[0] for key in summaries}):
+            metric_type, help_text = METRICS.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for (key_name, labels), value in sorted(values.items()):
+                if key_name == name:
+                    lines.append(f'{name}{format_labels(labels)} {value!r}')
+            for (key_name, labels), (count, total) in sorted(summaries.items()):
+                if key_name == name:
+                    lines.append(f'{name}_count{format_labels(labels)} {count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {total!r}')
+        return '\n'.join(lines) + '\n'
+
+
+# the sink the miners record to
+_sink = InProcessMetrics()
+
+
+def get_sink() -> MetricsSink:
+    """
+    Get the sink the metrics are recorded to.
+    """
+    return _sink
+
+
+def set_sink(sink : MetricsSink):
+    """
+    Record the metrics to another sink, for example one that sends them to
+    a monitoring service.
+    """
+    global _sink
+    _sink = sink
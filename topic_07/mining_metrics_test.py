@@ -0,0 +1,89 @@
+"""
+This module implements the tests for the mining metrics.
+"""
+
+import threading
+import unittest
+from time import time
+from cpu_miner import CpuMiner
+from mining_metrics import InProcessMetrics, get_sink, set_sink
+
+MINER_ADDRESS = bytes.fromhex("3df8f04b3c159fdc6631c4b8b0874940344d173d")
+
+
+class MiningMetricsTest(unittest.TestCase):
+    """
+    Test the mining metrics.
+    """
+    def setUp(self):
+        self.default_sink = get_sink()
+        self.sink = InProcessMetrics()
+        set_sink(self.sink)
+
+    def tearDown(self):
+        set_sink(self.default_sink)
+
+    def test_in_process_metrics(self):
+        """
+        Verify that counters, gauges and summaries are kept by label.
+        """
+        self.sink.increment('zimcoin_blocks_found_total')
+        self.sink.increment('zimcoin_blocks_found_total', 2)
+        self.sink.increment('zimcoin_templates_abandoned_total', labels=dict(reason='stale'))
+        self.sink.set('zimcoin_mining_hashrate', 100, dict(backend='cpu'))
+        self.sink.set('zimcoin_mining_hashrate', 200, dict(backend='cpu'))
+        self.sink.observe('zimcoin_kernel_seconds', 0.5)
+        self.sink.observe('zimcoin_kernel_seconds', 0.25)
+
+        self.assertEqual(self.sink.get('zimcoin_blocks_found_total'), 3)
+        self.assertEqual(self.sink.get('zimcoin_templates_abandoned_total', dict(reason='stale')), 1)
+        self.assertEqual(self.sink.get('zimcoin_templates_abandoned_total', dict(reason='refreshed')), 0)
+        self.assertEqual(self.sink.get('zimcoin_mining_hashrate', dict(backend='cpu')), 200)
+        self.assertEqual(self.sink.get_summary('zimcoin_kernel_seconds'), (2, 0.75))
+
+        self.sink.reset()
+        self.assertEqual(self.sink.get('zimcoin_blocks_found_total'), 0)
+
+    def test_prometheus_text(self):
+        """
+        Verify the Prometheus text format of the metrics.
+        """
+        self.sink.increment('zimcoin_mining_searches_total', labels=dict(backend='cpu', result='found'))
+        self.sink.observe('zimcoin_host_seconds', 0.5, dict(device='a "quoted" device'))
+
+        lines = self.sink.to_prometheus().splitlines()
+        self.assertIn('# TYPE zimcoin_mining_searches_total counter', lines)
+        self.assertIn('zimcoin_mining_searches_total{backend="cpu",result="found"} 1.0', lines)
+        self.assertIn('# TYPE zimcoin_host_seconds summary', lines)
+        self.assertIn('zimcoin_host_seconds_count{device="a \\"quoted\\" device"} 1', lines)
+        self.assertIn('zimcoin_host_seconds_sum{device="a \\"quoted\\" device"} 0.5', lines)
+
+    def test_mine_records_search(self):
+        """
+        Verify that mining a block records its hashes and result, and that
+        an abandoned block is recorded as stopped.
+        """
+        miner = CpuMiner(processes=1)
+        block = miner.mine(bytes(32), 0, MINER_ADDRESS, [], int(time()), 1000, time() + 30)
+        self.assertTrue(block.verify_proof_of_work())
+
+        labels = dict(backend='cpu')
+        self.assertEqual(self.sink.get('zimcoin_mining_hashes_total', labels), miner.hash_count)
+        self.assertEqual(self.sink.get('zimcoin_mining_searches_total', dict(labels, result='found')), 1)
+        self.assertEqual(self.sink.get_summary('zimcoin_mining_solution_seconds', labels)[0], 1)
+        self.assertGreater(self.sink.get('zimcoin_mining_hashrate', labels), 0)
+
+        stop_event = threading.Event()
+        stop_event.set()
+        block = miner.mine(bytes(32), 0, MINER_ADDRESS, [], int(time()), 2 ** 127,
+                           stop_event=stop_event)
+        self.assertEqual(block.nonce, 0)
+        self.assertEqual(self.sink.get('zimcoin_mining_searches_total', dict(labels, result='stopped')), 1)
+
+        block = miner.mine(bytes(32), 0, MINER_ADDRESS, [], int(time()), 2 ** 127,
+                           start_nonce=1, end_nonce=1000)
+        self.assertEqual(self.sink.get('zimcoin_mining_searches_total', dict(labels, result='exhausted')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,303 @@
+import hashlib
+import json
+import socket
+import socketserver
+import threading
+import time
+from typing import Dict, List, Optional
+
+from pykka import ActorDeadError, ThreadingActor
+
+from blocks import Block
+from miner_helper import get_miner
+from mining_backend import MiningBackend, nonce_partition
+from node import NodeStateSummary
+from transactions import Transaction
+
+POOL_PORT = 46031
+
+# every worker searches one of this many slices of the nonces
+POOL_SLOTS = 2 ** 16
+
+# the expected number of hashes for a share, a nonce that meets the share
+# target but not necessarily the block target
+SHARE_DIFFICULTY = 2 ** 20
+
+# the number of previous templates shares are recognised as stale for
+MAX_STALE_TEMPLATES = 10
+
+# the number of transactions in a block template
+BLOCK_TRANSACTIONS = 25
+
+
+def send_message(connection: socket.socket, message: dict):
+    connection.sendall(json.dumps(message).encode('utf8') + b'\n')
+
+
+def hash_value(block_data: bytes, nonce: int) -> int:
+    digest = hashlib.sha256(block_data)
+    digest.update(nonce.to_bytes(8, byteorder='little'))
+    return int.from_bytes(digest.digest(), byteorder='big')
+
+
+class PoolWorkerState:
+    def __init__(self, worker_id: int, name: str, connection: socket.socket):
+        self.worker_id = worker_id
+        self.name = name
+        self.connection = connection
+        self.start_nonce, self.end_nonce = nonce_partition(worker_id % POOL_SLOTS, POOL_SLOTS)
+        self.connected_at = time.time()
+        self.shares = 0
+        self.stale_shares = 0
+        self.invalid_shares = 0
+        self.solutions = 0
+
+
+class PoolTemplate:
+    def __init__(self, template_id: int, tip: Optional[bytes], block: Block, share_difficulty: int):
+        self.template_id = template_id
+        self.tip = tip
+        self.block = block
+        self.block_data = bytes(block.to_bytes())
+        self.target = block.calculate_target()
+        self.share_target = max(2 ** 256 // share_difficulty, self.target)
+        self.min_fee: Optional[int] = None
+        if len(block.transactions) == BLOCK_TRANSACTIONS:
+            self.min_fee = min(transaction.fee for transaction in block.transactions)
+        self.nonces = set()
+
+
+class PoolRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        pool = self.server.pool
+        worker_id = None
+        try:
+            for line in self.rfile:
+                parsed = json.loads(line)
+                if parsed["type"] == 'hello' and worker_id is None:
+                    worker_id = pool.add_worker(str(parsed["name"]), self.request).get()
+                elif parsed["type"] == 'share' and worker_id is not None:
+                    pool.received_share(worker_id, int(parsed["template_id"]), int(parsed["nonce"]))
+        except (ActorDeadError, OSError, ValueError, KeyError) as exception:
+            print("Pool connection closed", exception)
+        finally:
+            if worker_id is not None:
+                try:
+                    pool.remove_worker(worker_id)
+                except ActorDeadError:
+                    pass
+
+
+class PoolTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, pool):
+        super().__init__(address, PoolRequestHandler)
+        self.pool = pool
+
+
+class PoolServer(ThreadingActor):
+    def __init__(self, node, address: bytes, host: str = '127.0.0.1', port: int = POOL_PORT,
+                 share_difficulty: int = SHARE_DIFFICULTY):
+        super().__init__()
+        self.node = node
+        self.address = address
+        self.share_difficulty = share_difficulty
+
+        self.workers: Dict[int, PoolWorkerState] = dict()
+        self.next_worker_id = 0
+        self.templates: Dict[int, PoolTemplate] = dict()
+        self.template: Optional[PoolTemplate] = None
+        self.next_template_id = 0
+        self.stale_templates = 0
+
+        # workers connect on a plain socket as they mine in a blocking loop
+        self.server = PoolTCPServer((host, port), None)
+        self.port = self.server.server_address[1]
+
+    def on_start(self):
+        self.server.pool = self.actor_ref.proxy()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.node.subscribe(self.actor_ref)
+        self.update_template()
+
+    def on_stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for worker in self.workers.values():
+            worker.connection.close()
+
+    def get_port(self) -> int:
+        return self.port
+
+    def update_template(self):
+        summary: NodeStateSummary = self.node.state_summary().get()
+        difficulty = self.node.current_difficulty().get()
+        transactions: List[Transaction] = self.node.get_top_transactions(BLOCK_TRANSACTIONS).get()
+
+        # a later timestamp keeps a template with the same tip and
+        # transactions from repeating the block data of the last one
+        timestamp = int(time.time())
+        if self.template is not None:
+            timestamp = max(timestamp, self.template.block.timestamp + 1)
+
+        block = MiningBackend.create_block(summary.block_id or bytes(32), summary.height, self.address,
+                                           transactions, timestamp, difficulty)
+        self.template = PoolTemplate(self.next_template_id, summary.block_id, block, self.share_difficulty)
+        self.templates[self.template.template_id] = self.template
+        self.templates.pop(self.template.template_id - MAX_STALE_TEMPLATES, None)
+        self.next_template_id += 1
+
+        for worker in list(self.workers.values()):
+            self.send_template(worker)
+
+    def send_template(self, worker: PoolWorkerState):
+        try:
+            send_message(worker.connection, dict(
+                type='template',
+                template_id=self.template.template_id,
+                block_data=self.template.block_data.hex(),
+                share_target=self.template.share_target,
+                start_nonce=worker.start_nonce,
+                end_nonce=worker.end_nonce))
+        except OSError as exception:
+            print("Removing pool worker", worker.name, exception)
+            self.workers.pop(worker.worker_id, None)
+
+    def tip_changed(self, summary: NodeStateSummary):
+        if summary.block_id != self.template.tip:
+            self.stale_templates += 1
+            self.update_template()
+
+    def mempool_changed(self, transactions: List[Transaction]):
+        if self.template.min_fee is None or any(t.fee > self.template.min_fee for t in transactions):
+            self.update_template()
+
+    def add_worker(self, name: str, connection: socket.socket) -> int:
+        worker = PoolWorkerState(self.next_worker_id, name, connection)
+        self.next_worker_id += 1
+        self.workers[worker.worker_id] = worker
+        print("Pool worker", name, "connected with id", worker.worker_id)
+        self.send_template(worker)
+        return worker.worker_id
+
+    def remove_worker(self, worker_id: int):
+        self.workers.pop(worker_id, None)
+
+    def received_share(self, worker_id: int, template_id: int, nonce: int):
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            return
+
+        if template_id != self.template.template_id:
+            if template_id in self.templates:
+                worker.stale_shares += 1
+            else:
+                worker.invalid_shares += 1
+            return
+
+        template = self.template
+        value = hash_value(template.block_data, nonce)
+        if not worker.start_nonce <= nonce < worker.end_nonce or nonce in template.nonces \
+                or value >= template.share_target:
+            worker.invalid_shares += 1
+            return
+        template.nonces.add(nonce)
+        worker.shares += 1
+
+        if value < template.target:
+            block = MiningBackend.create_block(template.block.previous, template.block.height,
+                                               template.block.miner, template.block.transactions,
+                                               template.block.timestamp, template.block.difficulty)
+            block = MiningBackend.finish_block(block, nonce)
+            worker.solutions += 1
+            print("Pool worker", worker.name, "mined block", block.block_id.hex())
+            self.node.received_blocks([block])
+
+    def get_stats(self) -> List[dict]:
+        now = time.time()
+        return [dict(
+            worker_id=worker.worker_id,
+            name=worker.name,
+            shares=worker.shares,
+            stale_shares=worker.stale_shares,
+            invalid_shares=worker.invalid_shares,
+            solutions=worker.solutions,
+            hashrate=worker.shares * self.share_difficulty / max(now - worker.connected_at, 1e-6))
+            for worker in self.workers.values()]
+
+
+class PoolWorker:
+    def __init__(self, host: str = '127.0.0.1', port: int = POOL_PORT, name: Optional[str] = None,
+                 miner: Optional[MiningBackend] = None, backend: Optional[str] = None):
+        self.name = name or socket.gethostname()
+        self.miner = miner or get_miner(backend=backend)
+        self.connection = socket.create_connection((host, port))
+        self.lock = threading.Lock()
+        self.template: Optional[dict] = None
+        self.new_template = threading.Event()
+        self.stop_event = threading.Event()
+        self.stopping = False
+        self.shares = 0
+        self.hash_count = 0
+
+        send_message(self.connection, dict(type='hello', name=self.name))
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    def receive(self):
+        # a new template abandons the search of the current one
+        try:
+            for line in self.connection.makefile('rb'):
+                parsed = json.loads(line)
+                if parsed["type"] == 'template':
+                    with self.lock:
+                        self.template = parsed
+                    self.new_template.set()
+                    self.stop_event.set()
+        except (OSError, ValueError) as exception:
+            print("Pool connection closed", exception)
+        self.stop()
+
+    def stop(self):
+        self.stopping = True
+        self.stop_event.set()
+        self.new_template.set()
+
+    def close(self):
+        self.stop()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+    def run(self):
+        while not self.stopping:
+            self.new_template.wait()
+            with self.lock:
+                self.new_template.clear()
+                self.stop_event.clear()
+                template = self.template
+            if self.stopping:
+                break
+
+            block_data = bytes.fromhex(template["block_data"])
+            share_target = int(template["share_target"])
+            start_nonce, end_nonce = int(template["start_nonce"]), int(template["end_nonce"])
+            while not self.stop_event.is_set():
+                # the metrics of the worker count a share as a nonce that was found
+                start = time.perf_counter()
+                nonce = self.miner.search(block_data, share_target, stop_event=self.stop_event,
+                                          start_nonce=start_nonce, end_nonce=end_nonce)
+                self.miner.record_search(nonce, time.perf_counter() - start, stop_event=self.stop_event)
+                self.hash_count += self.miner.hash_count
+                if nonce == 0:
+                    break
+
+                self.shares += 1
+                try:
+                    send_message(self.connection, dict(type='share', template_id=template["template_id"], nonce=nonce))
+                except OSError:
+                    self.stop()
+                start_nonce = nonce + 1
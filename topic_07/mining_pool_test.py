@@ -0,0 +1,105 @@
+"""
+This module implements the tests for the mining pool.
+"""
+
+import os
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from time import time, sleep
+from pykka import ActorRegistry
+from cpu_miner import CpuMiner
+from mining_pool import PoolServer, PoolWorker, POOL_SLOTS, send_message
+from miner_helper import BACKEND_CPU, mine_block
+from node import Node
+
+MINER_ADDRESS = bytes.fromhex("3df8f04b3c159fdc6631c4b8b0874940344d173d")
+
+
+def wait_for(condition, timeout : float = 30.0) -> bool:
+    """
+    Wait until a condition is met or the timeout expires.
+    """
+    end = time() + timeout
+    while time() < end:
+        if condition():
+            return True
+        sleep(0.01)
+    return False
+
+
+class MiningPoolTest(unittest.TestCase):
+    """
+    Test the pool server with workers mining on the CPU.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.node = Node.start(os.path.join(self.directory, 'blocks.sqlite')).proxy()
+        self.pool = PoolServer.start(self.node, MINER_ADDRESS, port=0, share_difficulty=64).proxy()
+        self.port = self.pool.get_port().get()
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.close()
+        ActorRegistry.stop_all()
+        shutil.rmtree(self.directory)
+
+    def start_worker(self, name : str) -> PoolWorker:
+        worker = PoolWorker(port=self.port, name=name, miner=CpuMiner(processes=1, chunk_size=1000))
+        threading.Thread(target=worker.run, daemon=True).start()
+        self.workers.append(worker)
+        return worker
+
+    def test_workers_mine_blocks(self):
+        """
+        Verify that the shares of several workers are counted and that
+        their solutions extend the chain of the node.
+        """
+        first = self.start_worker('first')
+        second = self.start_worker('second')
+
+        self.assertTrue(wait_for(lambda: self.node.state_summary().get().height >= 3))
+        stats = self.pool.get_stats().get()
+        self.assertEqual([worker['name'] for worker in stats], ['first', 'second'])
+        self.assertGreater(sum(worker['solutions'] for worker in stats), 0)
+        self.assertTrue(all(worker['invalid_shares'] == 0 for worker in stats))
+        self.assertGreater(stats[0]['hashrate'], 0)
+        self.assertGreater(first.shares + second.shares, 0)
+
+    def test_stale_and_invalid_shares(self):
+        """
+        Verify that shares for an old template are stale and shares that
+        do not meet the share target or are outside the worker's slice are
+        invalid.
+        """
+        connection = socket.create_connection(('127.0.0.1', self.port))
+        send_message(connection, dict(type='hello', name='test'))
+        reader = connection.makefile('rb')
+        template = json.loads(reader.readline())
+        self.assertEqual(template['start_nonce'], 0)
+        self.assertEqual(template['end_nonce'], 2 ** 64 // POOL_SLOTS)
+
+        # a new tip makes the template stale
+        block = mine_block(bytes(32), 0, MINER_ADDRESS, [], int(time()), 1000, time() + 30,
+                           backend=BACKEND_CPU)
+        self.node.received_blocks([block]).get()
+        new_template = json.loads(reader.readline())
+        self.assertGreater(new_template['template_id'], template['template_id'])
+
+        send_message(connection, dict(type='share', template_id=template['template_id'], nonce=1))
+        send_message(connection, dict(type='share', template_id=-1, nonce=1))
+        send_message(connection, dict(type='share', template_id=new_template['template_id'],
+                                      nonce=2 ** 63))
+
+        def stats():
+            return [worker for worker in self.pool.get_stats().get() if worker['name'] == 'test'][0]
+        self.assertTrue(wait_for(lambda: stats()['stale_shares'] == 1 and stats()['invalid_shares'] == 2))
+        connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
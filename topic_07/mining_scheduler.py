@@ -0,0 +1,155 @@
+"""
+This module implements a scheduler that mines a block on several devices
+at once, each searching its own range of the nonces.
+"""
+
+import threading
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from mining_backend import MiningBackend, NONCE_LIMIT
+
+# the time to wait for a device to finish before the stop event of the
+# caller is checked again
+POLL_INTERVAL = 0.01
+
+
+def create_device_miners(window_size : int = None) -> list:
+    """
+    Create an OpenCL miner for every device of every platform.
+
+    Parameters:
+        window_size (int): The window size of the miners, defaults to
+            the tuned profile of every device.
+
+    Returns:
+        list: The miners.
+    """
+    from Library.opencl_information import opencl_information
+    from zimcoin_miner import ZimcoinMiner
+
+    return [ZimcoinMiner(platform_id=platform_id, device_id=device_id, window_size=window_size)
+            for platform_id, device_id, _ in opencl_information().get_devices()]
+
+
+class MiningScheduler(MiningBackend):
+    """
+    Mine for Zimcoins with several backends. The nonces are split into
+    disjoint ranges sized to the hashrate each backend reached on the
+    previous block, and every backend stops once one finds a nonce.
+    """
+    name = 'multi'
+
+    def __init__(self, miners : list = None, window_size : int = None,
+                 cutoff_time : int = None):
+        """
+        Initialize the scheduler.
+
+        Parameters:
+            miners (list): The backends to mine with, defaults to an OpenCL
+                miner for every device.
+            window_size (int): The window size of the default miners.
+            cutoff_time (int): The default unix time at which to give up
+                mining a block.
+        """
+        super().__init__(cutoff_time)
+        if miners is None:
+            miners = create_device_miners(window_size)
+        assert len(miners) > 0, "No mining devices"
+
+        self.miners = miners
+        self.hashrates = [None] * len(miners)
+        self.executor = ThreadPoolExecutor(max_workers=len(miners))
+
+    @property
+    def device_name(self) -> str:
+        """
+        Get the names of the devices that are mined on.
+        """
+        return ', '.join(miner.device_name for miner in self.miners)
+
+    def close(self):
+        """
+        Release the miners and the threads that run them.
+        """
+        self.executor.shutdown(wait=True)
+        for miner in self.miners:
+            miner.close()
+
+    def get_ranges(self, start_nonce : int, end_nonce : int) -> list:
+        """
+        Split a range of nonces between the miners in proportion to their
+        hashrates. Miners without a measured hashrate are given the
+        average hashrate of the others.
+
+        Returns:
+            list: The (start, end) nonce range of every miner.
+        """
+        measured = [rate for rate in self.hashrates if rate]
+        default_rate = sum(measured) / len(measured) if measured else 1.0
+        rates = [rate or default_rate for rate in self.hashrates]
+
+        ranges = []
+        total_rate = sum(rates)
+        start = start_nonce
+        for index, rate in enumerate(rates):
+            if index == len(rates) - 1:
+                end = end_nonce
+            else:
+                end = start + int((end_nonce - start_nonce) * rate / total_rate)
+            ranges.append((start, end))
+            start = end
+        return ranges
+
+    def get_rates(self) -> list:
+        """
+        Get the hashrate of every device on the last block.
+
+        Returns:
+            list: The (device name, hashes per second) of every miner.
+        """
+        return [(miner.device_name, rate or 0.0) for miner, rate in zip(self.miners, self.hashrates)]
+
+    def search_range(self, miner : MiningBackend, index : int, found : threading.Event,
+                     block_data : bytes, target : int, cutoff_time : float,
+                     start_nonce : int, end_nonce : int) -> int:
+        """
+        Search the block data with one of the miners on its range of
+        nonces, and tell the other miners to stop if a nonce is found.
+        """
+        start = perf_counter()
+        try:
+            nonce = miner.search(block_data, target, cutoff_time, found, start_nonce, end_nonce)
+        finally:
+            elapsed = perf_counter() - start
+            if elapsed > 0 and miner.hash_count > 0:
+                self.hashrates[index] = miner.hash_count / elapsed
+
+        if nonce != 0:
+            found.set()
+        return nonce
+
+    def search(self, block_data : bytes, target : int,
+               cutoff_time : float = None, stop_event : threading.Event = None,
+               start_nonce : int = 0, end_nonce : int = NONCE_LIMIT) -> int:
+        """
+        Search the nonces of the block data on every device. Setting the
+        stop event stops every device.
+        """
+        found = threading.Event()
+        futures = [self.executor.submit(self.search_range, device_miner, index, found,
+                                        block_data, target, cutoff_time, range_start, range_end)
+                   for index, (device_miner, (range_start, range_end))
+                   in enumerate(zip(self.miners, self.get_ranges(start_nonce, end_nonce)))]
+
+        # pass the stop event of the caller on to the devices, and stop
+        # every device if one of them fails
+        pending = set(futures)
+        while len(pending) > 0:
+            done, pending = wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            if any(future.exception() is not None for future in done) \
+                    or (stop_event is not None and stop_event.is_set()):
+                found.set()
+        nonces = [future.result() for future in futures]
+
+        self.hash_count = sum(device_miner.hash_count for device_miner in self.miners)
+        return max(nonces)
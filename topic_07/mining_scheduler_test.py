@@ -0,0 +1,66 @@
+"""
+This module implements the tests for the multi-device mining scheduler.
+"""
+
+import threading
+import unittest
+from time import time
+from cpu_miner import CpuMiner
+from mining_backend import NONCE_LIMIT
+from mining_scheduler import MiningScheduler
+
+MINER_ADDRESS = bytes.fromhex("3df8f04b3c159fdc6631c4b8b0874940344d173d")
+
+
+class MiningSchedulerTest(unittest.TestCase):
+    """
+    Test the scheduler with CPU miners standing in for the devices.
+    """
+    def setUp(self):
+        self.scheduler = MiningScheduler([CpuMiner(processes=1, chunk_size=1000),
+                                          CpuMiner(processes=1, chunk_size=1000)])
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def test_ranges(self):
+        """
+        Verify that the nonce ranges are disjoint, cover the whole range and
+        follow the measured hashrates.
+        """
+        ranges = self.scheduler.get_ranges(0, NONCE_LIMIT)
+        self.assertEqual(ranges, [(0, NONCE_LIMIT // 2), (NONCE_LIMIT // 2, NONCE_LIMIT)])
+
+        self.scheduler.hashrates = [3000.0, 1000.0]
+        ranges = self.scheduler.get_ranges(100, 500)
+        self.assertEqual(ranges, [(100, 400), (400, 500)])
+
+    def test_mine(self):
+        """
+        Verify that a block is mined, the other device is stopped and the
+        rates of the devices that tried nonces are measured.
+        """
+        block = self.scheduler.mine(bytes(32), 0, MINER_ADDRESS, [], int(time()), 100_000, time() + 30)
+        self.assertTrue(block.verify_proof_of_work())
+        for miner, (_, rate) in zip(self.scheduler.miners, self.scheduler.get_rates()):
+            self.assertEqual(rate > 0, miner.hash_count > 0)
+        self.assertGreater(max(rate for _, rate in self.scheduler.get_rates()), 0)
+        self.assertEqual(self.scheduler.hash_count,
+                         sum(miner.hash_count for miner in self.scheduler.miners))
+
+    def test_stop_event(self):
+        """
+        Verify that setting the stop event stops every device.
+        """
+        stop_event = threading.Event()
+        threading.Timer(0.2, stop_event.set).start()
+
+        start = time()
+        block = self.scheduler.mine(bytes(32), 0, MINER_ADDRESS, [], int(time()), 2 ** 127,
+                                    stop_event=stop_event)
+        self.assertEqual(block.nonce, 0)
+        self.assertLess(time() - start, 10)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
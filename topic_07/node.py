@@ -1,11 +1,13 @@
-from typing import List, Optional, Dict
+import threading
+from typing import List, Optional, Dict, Set
 
-from pykka import ActorRef, ThreadingActor
+from pykka import ActorDeadError, ActorRef, ThreadingActor
 
-from blockchain_state import BlockchainState, verify_reorg
-from blocks import Block
-from mempool import Mempool
-from persistence import Persistence
+from blockchain_state import BlockchainState
+from blocks import Block, UserState
+from mempool import Mempool, MAX_TRANSACTIONS
+from persistence import Persistence, StateSnapshot, CODEC_JSON, BLOCK_BATCH_SIZE, SNAPSHOT_INTERVAL
+from signatures import SignatureVerifier
 from transactions import Transaction
 
 
@@ -17,14 +19,125 @@ class NodeStateSummary:
 
 
 class Node(ThreadingActor):
-    def __init__(self, file_name):
+    def __init__(self, file_name, signature_workers: Optional[int] = None, codec: str = CODEC_JSON,
+                 trust_snapshot: bool = True, mempool_capacity: int = MAX_TRANSACTIONS):
         super().__init__()
         self.blockchain_state = BlockchainState([], dict(), 0)
-        self.mempool = Mempool()
+        self.mempool = Mempool(mempool_capacity)
         self.connections: Dict[ActorRef, Optional[NodeStateSummary]] = dict()
-        self.persistence = Persistence.start(file_name).proxy()
-        for block in self.persistence.get_blocks().get():
-            self.blockchain_state.verify_and_apply_block(block)
+        self.subscribers: Set[ActorRef] = set()
+        self.signature_verifier = SignatureVerifier(signature_workers)
+        self.persistence = Persistence.start(file_name, codec).proxy()
+        self.trust_snapshot = trust_snapshot
+        self.snapshot_height = 0
+        self.loaded_snapshot = self.load_snapshot()
+        self.load_blocks()
+        self.blockchain_state.pop_touched_users()
+        self.save_snapshot()
+
+    def on_start(self):
+        # re-verify the blocks below an untrusted snapshot while the node runs
+        if self.loaded_snapshot is not None and not self.trust_snapshot:
+            threading.Thread(target=self.verify_snapshot, args=(self.loaded_snapshot,), daemon=True).start()
+
+    def load_snapshot(self) -> Optional[StateSnapshot]:
+        # start from the newest snapshot instead of replaying the whole chain
+        snapshot = self.persistence.get_snapshot().get()
+        if snapshot is None:
+            return None
+
+        blocks = self.persistence.get_block_range(0, snapshot.height).get()
+        if len(blocks) != snapshot.height:
+            return None
+
+        self.blockchain_state = BlockchainState(blocks, snapshot.user_states, snapshot.total_difficulty)
+        self.snapshot_height = snapshot.height
+        return snapshot
+
+    def load_blocks(self):
+        # read the next batch of blocks while the current one is applied
+        height = len(self.blockchain_state.longest_chain)
+        next_blocks = self.persistence.get_block_range(height, height + BLOCK_BATCH_SIZE)
+        while True:
+            blocks = next_blocks.get()
+            if len(blocks) == 0:
+                break
+
+            height += len(blocks)
+            next_blocks = self.persistence.get_block_range(height, height + BLOCK_BATCH_SIZE)
+
+            signatures_valid = self.signature_verifier.verify_blocks(blocks)
+            for block, valid in zip(blocks, signatures_valid):
+                self.blockchain_state.verify_and_apply_block(block, verify_signatures=not valid)
+
+    def save_snapshot(self):
+        height = len(self.blockchain_state.longest_chain)
+        if 0 <= height - self.snapshot_height < SNAPSHOT_INTERVAL:
+            return
+
+        # copy the user states, they keep changing after the message is sent
+        user_states = {key: UserState(state.balance, state.nonce)
+                       for key, state in self.blockchain_state.user_states.items()}
+        self.persistence.save_snapshot(StateSnapshot(
+            height, self.blockchain_state.longest_chain[-1].block_id,
+            self.blockchain_state.total_difficulty, user_states))
+        self.snapshot_height = height
+
+    def verify_snapshot(self, snapshot: StateSnapshot):
+        # runs on a background thread with its own copy of the blocks
+        state = BlockchainState([], dict(), 0)
+        try:
+            for block in self.persistence.get_block_range(0, snapshot.height).get():
+                state.verify_and_apply_block(block)
+        except Exception as exception:
+            print("Snapshot at height", snapshot.height, "failed verification", exception)
+            valid = False
+        else:
+            valid = len(state.longest_chain) == snapshot.height \
+                and state.total_difficulty == snapshot.total_difficulty \
+                and {key: (user_state.balance, user_state.nonce) for key, user_state in state.user_states.items()} \
+                == {key: (user_state.balance, user_state.nonce) for key, user_state in snapshot.user_states.items()}
+        try:
+            self.actor_ref.proxy().snapshot_verified(snapshot.height, valid)
+        except ActorDeadError:
+            # the node was stopped before the verification finished
+            pass
+
+    def snapshot_verified(self, height: int, valid: bool):
+        if valid:
+            return
+
+        # replay the whole chain instead of trusting the snapshot
+        print("Snapshot at height", height, "does not match the chain, replaying all blocks")
+        self.persistence.remove_snapshot(height).get()
+        self.blockchain_state = BlockchainState([], dict(), 0)
+        self.snapshot_height = 0
+        self.load_blocks()
+        self.blockchain_state.pop_touched_users()
+        self.mempool.filter(self.blockchain_state.user_states)
+
+        new_state_summary = self.state_summary()
+        for connection in self.connections:
+            connection.proxy().send_state_summary(new_state_summary)
+        self.notify_subscribers('tip_changed', new_state_summary)
+
+    def on_stop(self):
+        self.signature_verifier.close()
+        self.persistence.stop()
+
+    def subscribe(self, subscriber: ActorRef):
+        # the subscriber is told about new tips and mempool transactions
+        self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber: ActorRef):
+        self.subscribers.discard(subscriber)
+
+    def notify_subscribers(self, event: str, *args):
+        for subscriber in list(self.subscribers):
+            try:
+                getattr(subscriber.proxy(), event)(*args)
+            except ActorDeadError:
+                self.subscribers.discard(subscriber)
 
     def received_blocks(self, blocks: List[Block]):
         first_block = blocks[0]
@@ -40,17 +153,19 @@ class Node(ThreadingActor):
         if blocks[0].height == height:
             applied_blocks = []
             old_block_id = self.state_summary().block_id
-            for block in blocks:
+            signatures_valid = self.signature_verifier.verify_blocks(blocks)
+            for block, valid in zip(blocks, signatures_valid):
                 try:
-                    self.blockchain_state.verify_and_apply_block(block)
+                    self.blockchain_state.verify_and_apply_block(block, verify_signatures=not valid)
                 except Exception as exception:
                     print("Block", block.block_id.hex(), "failed validation", exception)
                     break
                 else:
                     applied_blocks.append(block)
-                    self.persistence.save_block(block)
 
             if len(applied_blocks) != 0:
+                self.persistence.save_blocks(applied_blocks)
+
                 for (connection, state) in self.connections.items():
                     if state is not None and state.block_id == old_block_id:
                         connection.proxy().send_blocks([block])
@@ -60,21 +175,18 @@ class Node(ThreadingActor):
                 for connection in self.connections:
                     connection.proxy().send_state_summary(new_state_summary)
         else:
-            self.blockchain_state = verify_reorg(self.blockchain_state, blocks)
-
-            for block in blocks:
-                self.persistence.save_block(block)
-
-            for to_remove in range(height, blocks[-1].height, -1):
-                self.persistence.remove_block(to_remove)
+            blocks = self.blockchain_state.reorganize(blocks)
+            self.persistence.save_branch(blocks)
 
             new_state_summary = self.state_summary()
 
             for connection in self.connections:
                 connection.proxy().send_state_summary(new_state_summary)
 
+        self.save_snapshot()
         self.ask_for_better_chains()
-        self.mempool.filter(self.blockchain_state.user_states)
+        self.mempool.revalidate(self.blockchain_state.user_states, self.blockchain_state.pop_touched_users())
+        self.notify_subscribers('tip_changed', self.state_summary())
 
     def state_summary(self) -> NodeStateSummary:
         height = len(self.blockchain_state.longest_chain)
@@ -116,18 +228,22 @@ class Node(ThreadingActor):
     def get_transactions(self) -> List[Transaction]:
         return self.mempool.get_transactions()
 
+    def get_top_transactions(self, count: int) -> List[Transaction]:
+        return self.mempool.get_top_transactions(count)
+
     def received_transactions(self, transactions: List[Transaction]):
         accepted_transactions = []
         for transaction in transactions:
             try:
                 sender_state = self.blockchain_state.user_states.get(transaction.sender_hash)
-                transaction.verify(sender_state.balance, sender_state.nonce)
-            except:
-                print("Transaction", transaction.txid, "failed verification")
+                accepted = self.mempool.add_transaction(transaction, sender_state)
+            except ValueError as exception:
+                print("Transaction", transaction.txid, "failed verification", exception)
             else:
-                if self.mempool.add_transaction(transaction):
+                if accepted:
                     accepted_transactions.append(transaction)
 
         if len(accepted_transactions) > 0:
             for connection in self.connections:
                 connection.proxy().send_transactions(accepted_transactions)
+            self.notify_subscribers('mempool_changed', accepted_transactions)
@@ -0,0 +1,75 @@
+"""
+This module implements the tests for the node actor.
+"""
+
+import os
+import hashlib
+import tempfile
+import unittest
+from time import time
+from pykka import ActorRegistry
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from miner_helper import BACKEND_CPU, mine_block
+from node import Node
+from transactions import Transaction, create_signed_transaction
+
+RECIPIENT_HASH = bytes.fromhex("3df8f04b3c159fdc6631c4b8b0874940344d173d")
+
+
+def public_key_hash(private_key) -> tuple:
+    """
+    Get the DER encoded public key of a private key and its hash.
+    """
+    public_key = private_key.public_key().public_bytes(
+        encoding=Encoding.DER,
+        format=PublicFormat.SubjectPublicKeyInfo)
+    return public_key, hashlib.sha1(public_key).digest()
+
+
+class NodeTest(unittest.TestCase):
+    """
+    Test the node actor.
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.node = Node.start(os.path.join(self.directory.name, 'blocks.sqlite')).proxy()
+
+    def tearDown(self):
+        ActorRegistry.stop_all()
+        self.directory.cleanup()
+
+    def mine(self, miner : bytes):
+        """
+        Mine a block paying the reward to a public key hash.
+        """
+        summary = self.node.state_summary().get()
+        block = mine_block(summary.block_id or bytes(32), summary.height, miner, [],
+                           int(time()), self.node.current_difficulty().get(), time() + 30,
+                           backend=BACKEND_CPU)
+        self.node.received_blocks([block]).get()
+
+    def test_rsa_transaction(self):
+        """
+        Verify that a transaction signed with an RSA key is rejected without
+        dropping the other transactions of the batch.
+        """
+        rsa_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        rsa_public_key, rsa_hash = public_key_hash(rsa_key)
+        ec_key = ec.generate_private_key(ec.SECP256K1)
+        self.mine(rsa_hash)
+        self.mine(public_key_hash(ec_key)[1])
+
+        rsa_transaction = Transaction(rsa_hash, RECIPIENT_HASH, rsa_public_key, 10, 1, 0, None, None)
+        rsa_transaction.signature = rsa_key.sign(rsa_transaction.create_signature_hash(),
+                                                 padding.PKCS1v15(), hashes.SHA256())
+        rsa_transaction.txid = rsa_transaction.create_txid()
+        transaction = create_signed_transaction(ec_key, RECIPIENT_HASH, 10, 1, 0)
+
+        self.node.received_transactions([rsa_transaction, transaction]).get()
+        self.assertEqual([t.txid for t in self.node.get_top_transactions(10).get()], [transaction.txid])
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
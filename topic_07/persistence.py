@@ -1,11 +1,79 @@
-from typing import List
+import json
+import pickle
+import sqlite3
+import struct
+from typing import Dict, Iterator, List, Optional, Union
 
 from pykka import ThreadingActor
-from sqlitedict import SqliteDict
 
-from blocks import Block
+from blocks import Block, UserState
 from transactions import Transaction
 
+# Binary records start with the codec version, the record type and the
+# length of the payload that follows. Block and transaction payloads use
+# the packed form of Block.pack and Transaction.pack, and the payload of a
+# blocks or transactions record is a sequence of block or transaction
+# records.
+CODEC_VERSION = 1
+RECORD_HEADER = struct.Struct('<BBI')
+RECORD_BLOCK = 1
+RECORD_TRANSACTION = 2
+RECORD_BLOCKS = 3
+RECORD_TRANSACTIONS = 4
+RECORD_USER_STATES = 5
+
+# the packed form of a user state in a snapshot: sender hash, balance, nonce
+PACKED_USER_STATE = struct.Struct('<20sQq')
+
+CODEC_JSON = 'json'
+CODEC_BINARY = 'binary'
+
+# the number of blocks read from the database in a single query
+BLOCK_BATCH_SIZE = 500
+
+# the number of blocks between account state snapshots, and the number of
+# snapshots kept in the database
+SNAPSHOT_INTERVAL = 1000
+SNAPSHOT_COUNT = 3
+
+# Every stored block, including the blocks on side branches, is kept in the
+# blocks table. The chain table maps the heights of the longest chain to
+# block ids, and the transactions table indexes the transactions in the
+# stored blocks. A snapshot holds the user states after the first height
+# blocks of the chain, ending with block_id.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    block_id BLOB PRIMARY KEY,
+    previous BLOB NOT NULL,
+    height INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blocks_height ON blocks (height);
+CREATE TABLE IF NOT EXISTS chain (
+    height INTEGER PRIMARY KEY,
+    block_id BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    block_id BLOB NOT NULL,
+    position INTEGER NOT NULL,
+    txid BLOB NOT NULL,
+    sender_hash BLOB NOT NULL,
+    nonce INTEGER NOT NULL,
+    PRIMARY KEY (block_id, position)
+);
+CREATE INDEX IF NOT EXISTS transactions_txid ON transactions (txid);
+CREATE INDEX IF NOT EXISTS transactions_sender ON transactions (sender_hash, nonce);
+CREATE TABLE IF NOT EXISTS snapshots (
+    height INTEGER PRIMARY KEY,
+    block_id BLOB NOT NULL,
+    total_difficulty TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+"""
+
+# the table used by the SqliteDict based persistence of earlier versions
+LEGACY_TABLE = "unnamed"
+
 
 def dict_to_transaction(data: dict):
     return Transaction(
@@ -55,24 +123,268 @@ def block_to_dict(block: Block) -> dict:
         nonce=block.nonce)
 
 
+def encode_record(record_type: int, payload: bytes) -> bytes:
+    return RECORD_HEADER.pack(CODEC_VERSION, record_type, len(payload)) + payload
+
+
+def decode_record(data, offset: int = 0):
+    data = memoryview(data)
+    try:
+        version, record_type, length = RECORD_HEADER.unpack_from(data, offset)
+    except struct.error as error:
+        raise ValueError("The record is truncated") from error
+    if version != CODEC_VERSION:
+        raise ValueError(f"Unsupported codec version {version}")
+    offset += RECORD_HEADER.size
+    if offset + length > len(data):
+        raise ValueError("The record is truncated")
+    return record_type, data[offset:offset + length], offset + length
+
+
+def decode_records(data, expected_type: int) -> list:
+    payloads = []
+    data = memoryview(data)
+    offset = 0
+    while offset < len(data):
+        record_type, payload, offset = decode_record(data, offset)
+        if record_type != expected_type:
+            raise ValueError(f"Unexpected record type {record_type}")
+        payloads.append(payload)
+    return payloads
+
+
+def unpack_payload(unpack_from, payload):
+    item, offset = unpack_from(payload)
+    if offset != len(payload):
+        raise ValueError("The record has trailing data")
+    return item
+
+
+def transaction_to_bytes(transaction: Transaction) -> bytes:
+    return encode_record(RECORD_TRANSACTION, transaction.pack())
+
+
+def bytes_to_transaction(data) -> Transaction:
+    record_type, payload, offset = decode_record(data)
+    if record_type != RECORD_TRANSACTION or offset != len(data):
+        raise ValueError("The data is not a single transaction record")
+    return unpack_payload(Transaction.unpack_from, payload)
+
+
+def block_to_bytes(block: Block) -> bytes:
+    return encode_record(RECORD_BLOCK, block.pack())
+
+
+def bytes_to_block(data) -> Block:
+    record_type, payload, offset = decode_record(data)
+    if record_type != RECORD_BLOCK or offset != len(data):
+        raise ValueError("The data is not a single block record")
+    return unpack_payload(Block.unpack_from, payload)
+
+
+def blocks_to_bytes(blocks: List[Block]) -> bytes:
+    return encode_record(RECORD_BLOCKS, b"".join(map(block_to_bytes, blocks)))
+
+
+def transactions_to_bytes(transactions: List[Transaction]) -> bytes:
+    return encode_record(RECORD_TRANSACTIONS, b"".join(map(transaction_to_bytes, transactions)))
+
+
+def decode_message(data):
+    record_type, payload, offset = decode_record(data)
+    if offset != len(data):
+        raise ValueError("The message has trailing data")
+    if record_type == RECORD_BLOCKS:
+        return record_type, [unpack_payload(Block.unpack_from, block)
+                             for block in decode_records(payload, RECORD_BLOCK)]
+    if record_type == RECORD_TRANSACTIONS:
+        return record_type, [unpack_payload(Transaction.unpack_from, transaction)
+                             for transaction in decode_records(payload, RECORD_TRANSACTION)]
+    raise ValueError(f"Unexpected message type {record_type}")
+
+
+def user_states_to_bytes(user_states: Dict[bytes, UserState]) -> bytes:
+    return encode_record(RECORD_USER_STATES, b"".join(
+        PACKED_USER_STATE.pack(key, state.balance, state.nonce)
+        for key, state in user_states.items()))
+
+
+def bytes_to_user_states(data) -> Dict[bytes, UserState]:
+    record_type, payload, offset = decode_record(data)
+    if record_type != RECORD_USER_STATES or offset != len(data):
+        raise ValueError("The data is not a single user states record")
+    if len(payload) % PACKED_USER_STATE.size != 0:
+        raise ValueError("The user states record is truncated")
+    return {key: UserState(balance, nonce)
+            for key, balance, nonce in PACKED_USER_STATE.iter_unpack(payload)}
+
+
+class StateSnapshot:
+    def __init__(self, height: int, block_id: bytes, total_difficulty: int,
+                 user_states: Dict[bytes, UserState]):
+        self.height = height
+        self.block_id = block_id
+        self.total_difficulty = total_difficulty
+        self.user_states = user_states
+
+
+def stored_to_block(data: Union[dict, str, bytes]) -> Block:
+    if isinstance(data, dict):
+        return dict_to_block(data)
+    if isinstance(data, str):
+        return dict_to_block(json.loads(data))
+    return bytes_to_block(data)
+
+
 class Persistence(ThreadingActor):
-    def __init__(self, file_name):
+    def __init__(self, file_name, codec: str = CODEC_JSON):
         super().__init__()
-        self.db = SqliteDict(file_name, autocommit=True)
+        assert codec in (CODEC_JSON, CODEC_BINARY), "Unknown codec"
+        self.codec = codec
+
+        # the actor serialises access, so the connection is shared with
+        # the actor thread
+        self.db = sqlite3.connect(file_name, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.executescript(SCHEMA)
+        self.migrate_legacy_blocks()
+
+    def on_stop(self):
+        self.db.close()
+
+    def migrate_legacy_blocks(self):
+        # copy the blocks of a SqliteDict database into the new tables
+        if self.db.execute("SELECT 1 FROM chain LIMIT 1").fetchone() is not None:
+            return
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                           (LEGACY_TABLE,)).fetchone() is None:
+            return
+
+        rows = self.db.execute(
+            'SELECT key, value FROM "%s" ORDER BY CAST(key AS INTEGER)' % LEGACY_TABLE)
+        blocks = []
+        for key, value in rows:
+            if int(key) != len(blocks):
+                break
+            blocks.append(stored_to_block(pickle.loads(value)))
+        self.save_blocks(blocks)
+
+    def encode_block(self, block: Block) -> Union[str, bytes]:
+        if self.codec == CODEC_BINARY:
+            return block_to_bytes(block)
+        return json.dumps(block_to_dict(block))
+
+    def insert_blocks(self, blocks: List[Block]):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO blocks (block_id, previous, height, data) VALUES (?, ?, ?, ?)",
+            [(block.block_id, block.previous, block.height, self.encode_block(block))
+             for block in blocks])
+        self.db.executemany(
+            "INSERT OR REPLACE INTO transactions (block_id, position, txid, sender_hash, nonce) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(block.block_id, position, transaction.txid, transaction.sender_hash, transaction.nonce)
+             for block in blocks
+             for position, transaction in enumerate(block.transactions)])
+        self.db.executemany(
+            "INSERT OR REPLACE INTO chain (height, block_id) VALUES (?, ?)",
+            [(block.height, block.block_id) for block in blocks])
 
     def get_blocks(self) -> List[Block]:
-        height = 0
+        return list(self.iter_blocks())
+
+    def get_block_range(self, start: int, end: int) -> List[Block]:
+        # read the blocks of the longest chain from start up to end in a
+        # single query, stopping at the first missing height
+        rows = self.db.execute(
+            "SELECT chain.height, blocks.data FROM chain JOIN blocks USING (block_id) "
+            "WHERE chain.height >= ? AND chain.height < ? ORDER BY chain.height",
+            (start, end))
+
         blocks = []
-        while True:
-            block_dict = self.db.get(height)
-            if block_dict is None:
+        for height, data in rows:
+            if height != start + len(blocks):
                 break
-            blocks.append(dict_to_block(block_dict))
-            height += 1
+            blocks.append(stored_to_block(data))
         return blocks
 
+    def iter_blocks(self, start: int = 0, end: Optional[int] = None) -> Iterator[Block]:
+        height = start
+        while end is None or height < end:
+            batch_end = height + BLOCK_BATCH_SIZE
+            if end is not None:
+                batch_end = min(batch_end, end)
+
+            blocks = self.get_block_range(height, batch_end)
+            yield from blocks
+
+            if len(blocks) < batch_end - height:
+                break
+            height = batch_end
+
+    def get_block(self, block_id: bytes) -> Optional[Block]:
+        row = self.db.execute("SELECT data FROM blocks WHERE block_id = ?", (block_id,)).fetchone()
+        if row is None:
+            return None
+        return stored_to_block(row[0])
+
+    def get_transaction(self, txid: bytes) -> Optional[Transaction]:
+        row = self.db.execute(
+            "SELECT blocks.data, transactions.position FROM transactions JOIN blocks USING (block_id) "
+            "WHERE transactions.txid = ?", (txid,)).fetchone()
+        if row is None:
+            return None
+        return stored_to_block(row[0]).transactions[row[1]]
+
+    def get_sender_txids(self, sender_hash: bytes) -> List[bytes]:
+        rows = self.db.execute(
+            "SELECT transactions.txid FROM transactions JOIN chain USING (block_id) "
+            "WHERE transactions.sender_hash = ? ORDER BY transactions.nonce", (sender_hash,))
+        return [txid for txid, in rows]
+
     def save_block(self, block: Block):
-        self.db[block.height] = block_to_dict(block)
+        self.save_blocks([block])
+
+    def save_blocks(self, blocks: List[Block]):
+        # store the blocks on the longest chain in a single transaction
+        with self.db:
+            self.insert_blocks(blocks)
+
+    def save_branch(self, blocks: List[Block]):
+        # replace the end of the longest chain with a branch in a single
+        # transaction, keeping the replaced blocks as a side branch
+        with self.db:
+            self.insert_blocks(blocks)
+            self.db.execute("DELETE FROM chain WHERE height > ?", (blocks[-1].height,))
 
     def remove_block(self, height: int):
-        del self.db[height]
\ No newline at end of file
+        with self.db:
+            self.db.execute("DELETE FROM chain WHERE height = ?", (height,))
+
+    def save_snapshot(self, snapshot: StateSnapshot):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO snapshots (height, block_id, total_difficulty, data) "
+                "VALUES (?, ?, ?, ?)",
+                (snapshot.height, snapshot.block_id, str(snapshot.total_difficulty),
+                 user_states_to_bytes(snapshot.user_states)))
+            self.db.execute(
+                "DELETE FROM snapshots WHERE height NOT IN "
+                "(SELECT height FROM snapshots ORDER BY height DESC LIMIT ?)", (SNAPSHOT_COUNT,))
+
+    def get_snapshot(self) -> Optional[StateSnapshot]:
+        # the newest snapshot that ends with a block on the longest chain
+        row = self.db.execute(
+            "SELECT snapshots.height, snapshots.block_id, snapshots.total_difficulty, snapshots.data "
+            "FROM snapshots JOIN chain ON chain.height = snapshots.height - 1 "
+            "AND chain.block_id = snapshots.block_id "
+            "ORDER BY snapshots.height DESC LIMIT 1").fetchone()
+        if row is None:
+            return None
+        height, block_id, total_difficulty, data = row
+        return StateSnapshot(height, block_id, int(total_difficulty), bytes_to_user_states(data))
+
+    def remove_snapshot(self, height: int):
+        with self.db:
+            self.db.execute("DELETE FROM snapshots WHERE height = ?", (height,))
\ No newline at end of file
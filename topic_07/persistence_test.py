@@ -0,0 +1,241 @@
+"""
+This module implements the tests for the block persistence and the
+block and transaction codecs.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from pykka import ActorRegistry
+from sqlitedict import SqliteDict
+from cryptography.hazmat.primitives.asymmetric import ec
+from blocks import Block, UserState
+from node import Node
+from persistence import Persistence, StateSnapshot, block_to_dict, block_to_bytes, bytes_to_block, \
+    transaction_to_bytes, bytes_to_transaction, blocks_to_bytes, transactions_to_bytes, \
+    decode_message, RECORD_BLOCKS, RECORD_TRANSACTIONS, CODEC_BINARY
+from transactions import create_signed_transaction
+
+
+def create_test_blocks(count : int) -> list:
+    """
+    Create a chain of (unmined) blocks with transactions for testing.
+    """
+    private_key = ec.generate_private_key(ec.SECP256K1)
+    recipient_hash = bytes.fromhex("3df8f04b3c159fdc6631c4b8b0874940344d173d")
+
+    blocks = []
+    previous = bytes(32)
+    for height in range(count):
+        transactions = [create_signed_transaction(private_key, recipient_hash, 100, 1, height)]
+        block = Block(previous, height, recipient_hash, transactions,
+                      1_650_000_000 + height, 2 ** 100 + height, os.urandom(32), height)
+        blocks.append(block)
+        previous = block.block_id
+    return blocks
+
+
+class CodecTest(unittest.TestCase):
+    """
+    Test the binary codec.
+    """
+    def test_round_trip(self):
+        """
+        Verify that blocks and transactions survive encoding.
+        """
+        blocks = create_test_blocks(3)
+        transaction = blocks[0].transactions[0]
+
+        decoded = bytes_to_transaction(transaction_to_bytes(transaction))
+        self.assertEqual(decoded.create_txid(), transaction.txid)
+
+        decoded = bytes_to_block(memoryview(block_to_bytes(blocks[1])))
+        self.assertEqual(block_to_dict(decoded), block_to_dict(blocks[1]))
+
+        message_type, decoded = decode_message(blocks_to_bytes(blocks))
+        self.assertEqual(message_type, RECORD_BLOCKS)
+        self.assertEqual(list(map(block_to_dict, decoded)), list(map(block_to_dict, blocks)))
+
+        message_type, decoded = decode_message(transactions_to_bytes([]))
+        self.assertEqual((message_type, decoded), (RECORD_TRANSACTIONS, []))
+
+    def test_invalid(self):
+        """
+        Verify that invalid data is rejected.
+        """
+        data = block_to_bytes(create_test_blocks(1)[0])
+
+        with self.assertRaisesRegex(ValueError, 'truncated'):
+            bytes_to_block(data[:-1])
+        with self.assertRaisesRegex(ValueError, 'version'):
+            bytes_to_block(b'\x02' + data[1:])
+        with self.assertRaisesRegex(ValueError, 'single block'):
+            bytes_to_block(data + data)
+        with self.assertRaisesRegex(ValueError, 'single transaction'):
+            bytes_to_transaction(data)
+
+
+class PersistenceTest(unittest.TestCase):
+    """
+    Test the storage of blocks.
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.directory.name, 'blocks.sqlite')
+
+    def tearDown(self):
+        ActorRegistry.stop_all()
+        self.directory.cleanup()
+
+    def test_binary_reads_json(self):
+        """
+        Verify that blocks stored as JSON dicts are read by the binary codec.
+        """
+        blocks = create_test_blocks(4)
+
+        persistence = Persistence.start(self.file_name).proxy()
+        for block in blocks[:2]:
+            persistence.save_block(block).get()
+        persistence.stop()
+
+        persistence = Persistence.start(self.file_name, CODEC_BINARY).proxy()
+        for block in blocks[2:]:
+            persistence.save_block(block).get()
+        stored = persistence.get_blocks().get()
+        persistence.stop()
+
+        self.assertEqual(json.dumps(list(map(block_to_dict, stored))),
+                         json.dumps(list(map(block_to_dict, blocks))))
+
+    def test_block_ranges(self):
+        """
+        Verify that blocks are read in ranges up to the first missing height.
+        """
+        blocks = create_test_blocks(7)
+
+        persistence = Persistence.start(self.file_name).proxy()
+        for block in blocks:
+            persistence.save_block(block).get()
+        persistence.remove_block(5).get()
+
+        heights = lambda blocks: [block.height for block in blocks]
+        self.assertEqual(heights(persistence.get_block_range(1, 4).get()), [1, 2, 3])
+        self.assertEqual(heights(persistence.get_block_range(3, 10).get()), [3, 4])
+        self.assertEqual(heights(persistence.get_block_range(5, 10).get()), [])
+        self.assertEqual(heights(persistence.get_blocks().get()), [0, 1, 2, 3, 4])
+        persistence.stop()
+
+    def test_lookups(self):
+        """
+        Verify that blocks and transactions are found by their ids.
+        """
+        blocks = create_test_blocks(3)
+
+        persistence = Persistence.start(self.file_name, CODEC_BINARY).proxy()
+        persistence.save_blocks(blocks).get()
+
+        transaction = blocks[1].transactions[0]
+        self.assertEqual(persistence.get_block(blocks[2].block_id).get().block_id, blocks[2].block_id)
+        self.assertIsNone(persistence.get_block(bytes(32)).get())
+        self.assertEqual(persistence.get_transaction(transaction.txid).get().txid, transaction.txid)
+        self.assertIsNone(persistence.get_transaction(bytes(32)).get())
+        self.assertEqual(persistence.get_sender_txids(transaction.sender_hash).get(),
+                         [block.transactions[0].txid for block in blocks])
+        persistence.stop()
+
+    def test_save_branch(self):
+        """
+        Verify that a branch replaces the end of the chain and that the
+        replaced blocks are kept.
+        """
+        blocks = create_test_blocks(5)
+        branch = create_test_blocks(2)
+        branch[0].previous = blocks[1].block_id
+        for height, block in enumerate(branch, start=2):
+            block.height = height
+
+        persistence = Persistence.start(self.file_name).proxy()
+        persistence.save_blocks(blocks).get()
+        persistence.save_branch(branch).get()
+
+        stored = persistence.get_blocks().get()
+        self.assertEqual([block.block_id for block in stored],
+                         [block.block_id for block in blocks[:2] + branch])
+        self.assertIsNotNone(persistence.get_block(blocks[4].block_id).get())
+        persistence.stop()
+
+    def test_legacy_migration(self):
+        """
+        Verify that the blocks of a SqliteDict database are imported.
+        """
+        blocks = create_test_blocks(3)
+
+        legacy = SqliteDict(self.file_name, autocommit=True)
+        for block in blocks:
+            legacy[block.height] = block_to_dict(block)
+        legacy.close()
+
+        persistence = Persistence.start(self.file_name).proxy()
+        stored = persistence.get_blocks().get()
+        persistence.stop()
+
+        self.assertEqual(json.dumps(list(map(block_to_dict, stored))),
+                         json.dumps(list(map(block_to_dict, blocks))))
+
+    def test_snapshots(self):
+        """
+        Verify that only snapshots ending on the longest chain are loaded.
+        """
+        blocks = create_test_blocks(5)
+        branch = create_test_blocks(1)
+        branch[0].previous = blocks[2].block_id
+        branch[0].height = 3
+
+        sender_hash = blocks[0].transactions[0].sender_hash
+        persistence = Persistence.start(self.file_name).proxy()
+        persistence.save_blocks(blocks).get()
+        self.assertIsNone(persistence.get_snapshot().get())
+
+        persistence.save_snapshot(StateSnapshot(
+            3, blocks[2].block_id, 2 ** 200, {sender_hash: UserState(10, -1)})).get()
+        persistence.save_snapshot(StateSnapshot(
+            5, blocks[4].block_id, 2 ** 201, {sender_hash: UserState(20, 1)})).get()
+        snapshot = persistence.get_snapshot().get()
+        self.assertEqual(snapshot.height, 5)
+        self.assertEqual(snapshot.total_difficulty, 2 ** 201)
+        self.assertEqual(snapshot.user_states[sender_hash].balance, 20)
+        self.assertEqual(snapshot.user_states[sender_hash].nonce, 1)
+
+        persistence.save_branch(branch).get()
+        snapshot = persistence.get_snapshot().get()
+        self.assertEqual(snapshot.height, 3)
+        self.assertEqual(snapshot.user_states[sender_hash].nonce, -1)
+        persistence.stop()
+
+    def test_node_snapshot(self):
+        """
+        Verify that a node started from a snapshot has the same state as a
+        node that replayed the whole chain.
+        """
+        shutil.copy('blocks.sqlite', self.file_name)
+
+        node = Node.start(self.file_name, 1).proxy()
+        replayed = node.blockchain_state.get()
+        node.stop()
+
+        node = Node.start(self.file_name, 1, trust_snapshot=False).proxy()
+        self.assertIsNotNone(node.loaded_snapshot.get())
+        restored = node.blockchain_state.get()
+        node.stop()
+
+        self.assertEqual(restored.total_difficulty, replayed.total_difficulty)
+        self.assertEqual(len(restored.longest_chain), len(replayed.longest_chain))
+        self.assertEqual(
+            {key: (state.balance, state.nonce) for key, state in restored.user_states.items()},
+            {key: (state.balance, state.nonce) for key, state in replayed.user_states.items()})
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,375 @@
+"""
+This module implements the verification of transaction signatures as a
+separate stage from the balance and nonce checks. Signatures do not
+depend on the user states, so the signatures of all the transactions in
+a block, or in a batch of blocks, can be verified across a process pool
+before the blocks are applied.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.serialization import load_der_public_key
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import utils
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+
+# the default number of worker processes used to verify signatures
+SIGNATURE_WORKERS = os.cpu_count() or 1
+
+# batches with fewer transactions are verified in the calling process
+MIN_PARALLEL_BATCH = 64
+
+# the number of parsed public keys kept in the public key cache
+PUBLIC_KEY_CACHE_SIZE = 4096
+
+# the number of transaction ids and the number of seconds for which
+# valid signatures are remembered by the signature cache
+SIGNATURE_CACHE_SIZE = 100_000
+SIGNATURE_CACHE_MAX_AGE = 3600.0
+
+
+class PublicKeyCache:
+    """
+    This class is a bounded least recently used cache of the parsed
+    public keys of senders, keyed by the sender hash. It also remembers
+    that the sender hash is the SHA-1 hash of the DER encoded key, so
+    neither has to be recomputed for senders seen before.
+    """
+    def __init__(self, max_size : int = PUBLIC_KEY_CACHE_SIZE):
+        """
+        Initialize the cache.
+
+        Parameters:
+            max_size (int): The maximum number of senders in the cache.
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, sender_hash : bytes, sender_public_key : bytes) -> list:
+        """
+        Get the [sender_public_key, public_key] entry of a sender if the
+        cached DER key matches, counting the hit or miss.
+        """
+        with self.lock:
+            entry = self.entries.get(sender_hash)
+            if entry is not None and entry[0] == sender_public_key:
+                self.entries.move_to_end(sender_hash)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def store(self, sender_hash : bytes, entry : list) -> None:
+        """
+        Add an entry to the cache, evicting the least recently used one
+        if the cache is full.
+        """
+        with self.lock:
+            self.entries[sender_hash] = entry
+            self.entries.move_to_end(sender_hash)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def verify_sender_hash(self, sender_hash : bytes,
+                           sender_public_key : bytes) -> bool:
+        """
+        Verify that the sender hash is the SHA-1 hash of the public key.
+
+        Returns:
+            bool: True if the sender hash is correct, False otherwise.
+        """
+        if self.lookup(sender_hash, sender_public_key) is not None:
+            return True
+
+        if hashlib.sha1(sender_public_key).digest() != sender_hash:
+            return False
+
+        self.store(sender_hash, [sender_public_key, None])
+        return True
+
+    def load_public_key(self, sender_hash : bytes,
+                        sender_public_key : bytes) -> ec.EllipticCurvePublicKey:
+        """
+        Get the parsed public key of a sender.
+
+        Returns:
+            EllipticCurvePublicKey: The public key or None if the sender
+                hash is not the SHA-1 hash of the public key.
+        """
+        entry = self.lookup(sender_hash, sender_public_key)
+        if entry is not None and entry[1] is not None:
+            return entry[1]
+
+        if entry is None \
+                and hashlib.sha1(sender_public_key).digest() != sender_hash:
+            return None
+
+        public_key = load_der_public_key(sender_public_key)
+        self.store(sender_hash, [sender_public_key, public_key])
+        return public_key
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Get the fraction of the lookups that were found in the cache.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def clear(self) -> None:
+        """
+        Remove all the entries and reset the counters.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# the public key cache shared by all the transaction verification
+PUBLIC_KEY_CACHE = PublicKeyCache()
+
+
+class SignatureCache:
+    """
+    This class remembers the ids of the transactions whose signatures
+    were verified. The transaction id is a hash over all the fields of a
+    transaction, including the signature, so a transaction with a cached
+    id that matches its contents only needs the balance and nonce checks.
+    Entries are evicted when they are too old or the cache is full.
+    """
+    def __init__(self, max_size : int = SIGNATURE_CACHE_SIZE,
+                 max_age : float = SIGNATURE_CACHE_MAX_AGE):
+        """
+        Initialize the cache.
+
+        Parameters:
+            max_size (int): The maximum number of transaction ids.
+            max_age (float): The number of seconds after which an entry
+                is evicted.
+        """
+        self.max_size = max_size
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, txid : bytes) -> bool:
+        """
+        Check if the signature of a transaction is known to be valid,
+        counting the hit or miss.
+        """
+        with self.lock:
+            added = self.entries.get(txid)
+            if added is not None and time.monotonic() - added <= self.max_age:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, txid : bytes) -> None:
+        """
+        Remember that the signature of a transaction is valid, evicting
+        the oldest entries if they expired or the cache is full.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.entries[txid] = now
+            self.entries.move_to_end(txid)
+            while len(self.entries) > self.max_size or (self.entries \
+                    and now - next(iter(self.entries.values())) > self.max_age):
+                self.entries.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Get the fraction of the lookups that were found in the cache.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def clear(self) -> None:
+        """
+        Remove all the entries and reset the counters.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# the signature cache shared by all the transaction verification
+SIGNATURE_CACHE = SignatureCache()
+
+
+def verify_signature(sender_hash : bytes, sender_public_key : bytes,
+                     signature : bytes, signature_hash : bytes) -> bool:
+    """
+    Verify a single transaction signature.
+
+    Parameters:
+        sender_hash (bytes): The public key hash of the sender.
+        sender_public_key (bytes): The DER encoded public key of the sender.
+        signature (bytes): The signature of the transaction.
+        signature_hash (bytes): The hash of the signed transaction data.
+
+    Returns:
+        bool: True if the signature is valid, False otherwise.
+    """
+    try:
+        public_key = PUBLIC_KEY_CACHE.load_public_key(
+            sender_hash, sender_public_key)
+        if public_key is None:
+            return False
+        public_key.verify(
+            signature,
+            signature_hash,
+            ec.ECDSA(utils.Prehashed(hashes.SHA256())))
+    except (InvalidSignature, UnsupportedAlgorithm, ValueError, TypeError):
+        return False
+
+    return True
+
+
+def verify_signature_batch(signatures : list) -> list:
+    """
+    Verify a batch of (sender_hash, sender_public_key, signature,
+    signature_hash) tuples. This is the function executed by the worker
+    processes.
+
+    Returns:
+        list: A boolean for each signature indicating if it is valid.
+    """
+    return [verify_signature(*signature) for signature in signatures]
+
+
+class SignatureVerifier:
+    """
+    This class verifies the signatures of transactions in parallel using
+    a pool of worker processes, falling back to verifying them serially.
+    """
+    def __init__(self, workers : int = None,
+                 min_parallel_batch : int = MIN_PARALLEL_BATCH):
+        """
+        Initialize the signature verifier.
+
+        Parameters:
+            workers (int): The number of worker processes, one or less
+                verifies the signatures in the calling process.
+            min_parallel_batch (int): The smallest number of transactions
+                that will be verified in the worker processes.
+        """
+        self.workers = SIGNATURE_WORKERS if workers is None else workers
+        self.min_parallel_batch = min_parallel_batch
+        self.executor = None
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        """
+        Get the process pool, creating it the first time it is used.
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    def verify(self, transactions : list) -> list:
+        """
+        Verify the signatures of a list of transactions. Transactions in
+        the signature cache are not verified again, and the valid
+        signatures are added to the cache.
+
+        Parameters:
+            transactions (list): The transactions to verify.
+
+        Returns:
+            list: A boolean for each transaction indicating if the
+                signature is valid.
+        """
+        results = [True] * len(transactions)
+        pending = [index for index, transaction in enumerate(transactions)
+                   if not SIGNATURE_CACHE.contains(transaction.txid)]
+
+        signatures = [(transactions[index].sender_hash,
+                       transactions[index].sender_public_key,
+                       transactions[index].signature,
+                       transactions[index].create_signature_hash())
+                      for index in pending]
+
+        for index, valid in zip(pending, self.verify_signatures(signatures)):
+            results[index] = valid
+
+            # only cache the signature if the txid commits to it
+            transaction = transactions[index]
+            if valid and transaction.txid == transaction.create_txid():
+                SIGNATURE_CACHE.add(transaction.txid)
+
+        return results
+
+    def verify_signatures(self, signatures : list) -> list:
+        """
+        Verify a list of (sender_hash, sender_public_key, signature,
+        signature_hash) tuples using the worker processes if the list is
+        large enough.
+
+        Returns:
+            list: A boolean for each signature indicating if it is valid.
+        """
+        if self.workers <= 1 or len(signatures) < self.min_parallel_batch:
+            return verify_signature_batch(signatures)
+
+        # split the signatures into a few chunks per worker
+        chunk_count = self.workers * 4
+        chunk_size = -(-len(signatures) // chunk_count)
+        chunks = [signatures[i:i + chunk_size]
+                  for i in range(0, len(signatures), chunk_size)]
+
+        try:
+            results = []
+            for chunk_results in self.get_executor().map(verify_signature_batch, chunks):
+                results.extend(chunk_results)
+            return results
+        except (OSError, BrokenProcessPool) as exception:
+            logging.warning('Verifying signatures serially: %s', exception)
+            self.close()
+            self.workers = 1
+            return verify_signature_batch(signatures)
+
+    def verify_blocks(self, blocks : list) -> list:
+        """
+        Verify the signatures of all the transactions in a list of blocks.
+
+        Parameters:
+            blocks (list): The blocks to verify.
+
+        Returns:
+            list: A boolean for each block indicating if the signatures
+                of all its transactions are valid.
+        """
+        transactions = [transaction
+                        for block in blocks
+                        for transaction in block.transactions]
+        results = iter(self.verify(transactions))
+
+        return [all([next(results) for _ in block.transactions])
+                for block in blocks]
+
+    def close(self) -> None:
+        """
+        Shut down the worker processes.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
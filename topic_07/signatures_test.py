@@ -0,0 +1,140 @@
+"""
+This module implements the tests for the parallel verification of
+transaction signatures.
+"""
+
+import unittest
+from cryptography.hazmat.primitives.asymmetric import ec
+from blocks import Block
+from signatures import PublicKeyCache, SignatureCache, SignatureVerifier, SIGNATURE_CACHE
+from transactions import create_signed_transaction
+
+
+class SignatureVerifierTest(unittest.TestCase):
+    """
+    Test the signature verification stage.
+    """
+    def setUp(self):
+        private_key = ec.generate_private_key(ec.SECP256K1)
+        recipient_hash = bytes.fromhex("3df8f04b3c159fdc6631c4b8b0874940344d173d")
+        self.transactions = [
+            create_signed_transaction(private_key, recipient_hash, 100, 1, nonce)
+            for nonce in range(20)]
+
+        # invalidate the signature of one of the transactions
+        self.transactions[7].signature = self.transactions[8].signature
+
+    def test_serial(self):
+        """
+        Verify the signatures in the calling process.
+        """
+        verifier = SignatureVerifier(workers=1)
+        results = verifier.verify(self.transactions)
+
+        self.assertEqual(results, [i != 7 for i in range(20)])
+
+    def test_parallel(self):
+        """
+        Verify the signatures using worker processes.
+        """
+        verifier = SignatureVerifier(workers=2, min_parallel_batch=1)
+        try:
+            results = verifier.verify(self.transactions)
+        finally:
+            verifier.close()
+
+        self.assertEqual(results, [i != 7 for i in range(20)])
+
+    def test_verify_blocks(self):
+        """
+        Verify the signatures of the transactions in a list of blocks.
+        """
+        blocks = [
+            Block(bytes(32), height, bytes(20), self.transactions[start:end],
+                  0, 1000, bytes(32), 0)
+            for height, (start, end) in enumerate([(0, 5), (5, 10), (10, 10), (10, 20)])]
+
+        verifier = SignatureVerifier(workers=1)
+        self.assertEqual(verifier.verify_blocks(blocks), [True, False, True, True])
+
+    def test_cached_signatures(self):
+        """
+        Verify that cached signatures are not verified again and that
+        only transactions whose id matches their contents are cached.
+        """
+        # a valid signature with an id that does not match the contents
+        self.transactions[3].txid = self.transactions[4].txid
+        self.transactions[4].txid = bytes(32)
+
+        verifier = SignatureVerifier(workers=1)
+        verifier.verify(self.transactions)
+
+        self.assertTrue(SIGNATURE_CACHE.contains(self.transactions[0].txid))
+        self.assertFalse(SIGNATURE_CACHE.contains(self.transactions[3].txid))
+        self.assertFalse(SIGNATURE_CACHE.contains(self.transactions[7].txid))
+
+        # the cached transactions still have to pass the stateful checks
+        self.transactions[0].verify(1000, -1)
+        with self.assertRaisesRegex(Exception, 'The transaction ID is invalid'):
+            self.transactions[3].verify(1000, 2)
+
+
+class SignatureCacheTest(unittest.TestCase):
+    """
+    Test the cache of verified signatures.
+    """
+    def test_eviction(self):
+        """
+        Verify that entries are evicted by count and by age.
+        """
+        cache = SignatureCache(max_size=2, max_age=60)
+        for txid in [b'a', b'b', b'c']:
+            cache.add(txid)
+
+        self.assertFalse(cache.contains(b'a'))
+        self.assertTrue(cache.contains(b'b'))
+        self.assertTrue(cache.contains(b'c'))
+        self.assertAlmostEqual(cache.hit_rate, 2 / 3)
+
+        cache.max_age = -1
+        self.assertFalse(cache.contains(b'c'))
+        cache.add(b'd')
+        self.assertEqual(list(cache.entries), [])
+
+
+class PublicKeyCacheTest(unittest.TestCase):
+    """
+    Test the cache of parsed public keys.
+    """
+    def test_cache(self):
+        """
+        Verify the sender hash memoization, the counters and the eviction.
+        """
+        recipient_hash = bytes.fromhex("3df8f04b3c159fdc6631c4b8b0874940344d173d")
+        transactions = [
+            create_signed_transaction(ec.generate_private_key(ec.SECP256K1),
+                                      recipient_hash, 100, 1, 0)
+            for _ in range(3)]
+        cache = PublicKeyCache(max_size=2)
+
+        first = transactions[0]
+        self.assertTrue(cache.verify_sender_hash(first.sender_hash, first.sender_public_key))
+        self.assertFalse(cache.verify_sender_hash(recipient_hash, first.sender_public_key))
+        public_key = cache.load_public_key(first.sender_hash, first.sender_public_key)
+        self.assertIs(cache.load_public_key(first.sender_hash, first.sender_public_key), public_key)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # a different key for a cached sender hash is not accepted
+        self.assertIsNone(cache.load_public_key(
+            first.sender_hash, transactions[1].sender_public_key))
+
+        # the least recently used sender is evicted
+        for transaction in transactions[1:]:
+            cache.load_public_key(transaction.sender_hash, transaction.sender_public_key)
+        self.assertNotIn(first.sender_hash, cache.entries)
+        self.assertEqual(len(cache.entries), 2)
+        self.assertAlmostEqual(cache.hit_rate, 2 / 7)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -3,20 +3,29 @@ This module define the Transaction class.
 """
 
 from __future__ import annotations
+import struct
 import hashlib
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.serialization import load_der_public_key
 from cryptography.hazmat.primitives.serialization import Encoding
 from cryptography.hazmat.primitives.serialization import PublicFormat
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.asymmetric import utils
-from cryptography.exceptions import InvalidSignature
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+from signatures import PUBLIC_KEY_CACHE, SIGNATURE_CACHE
+
+# the fixed size part of a packed transaction: the sender hash, recipient
+# hash and txid, the amount, fee and nonce, and the lengths of the public
+# key and the signature that follow it
+PACKED_TRANSACTION = struct.Struct('<20s20s32sQQQHH')
 
 
 class Transaction:
     """
     Zimcoin transaction class.
     """
+    __slots__ = ('sender_hash', 'recipient_hash', 'sender_public_key',
+                 'amount', 'fee', 'nonce', 'signature', 'txid')
+
     def __init__(self, sender_hash:bytes, recipient_hash:bytes,
                  sender_public_key:bytes, amount:int, fee:int, nonce:int,
                  signature, txid):
@@ -29,9 +38,59 @@ class Transaction:
         self.signature = signature
         self.txid = txid
 
-    def verify(self, sender_balance:int, sender_previous_nonce:int) -> bool:
+    def pack(self) -> bytes:
+        """
+        Pack the transaction into bytes with the hashes and integers at
+        fixed offsets, followed by the public key and the signature.
         """
-        Verify that the transaction is valid.
+        if len(self.sender_hash) != 20:
+            raise ValueError('Invalid sender hash')
+        if len(self.recipient_hash) != 20:
+            raise ValueError('Invalid recipient hash')
+        if len(self.txid) != 32:
+            raise ValueError('The transaction ID is invalid')
+
+        return PACKED_TRANSACTION.pack(
+            self.sender_hash,
+            self.recipient_hash,
+            self.txid,
+            self.amount,
+            self.fee,
+            self.nonce,
+            len(self.sender_public_key),
+            len(self.signature)) + self.sender_public_key + self.signature
+
+    @staticmethod
+    def unpack_from(buffer, offset:int = 0) -> tuple:
+        """
+        Unpack a transaction packed by Transaction.pack.
+
+        Returns the transaction and the offset following it in the buffer.
+        """
+        try:
+            (sender_hash, recipient_hash, txid, amount, fee, nonce,
+             public_key_length, signature_length) = \
+                PACKED_TRANSACTION.unpack_from(buffer, offset)
+            offset += PACKED_TRANSACTION.size
+
+            # struct caches the compiled formats for the few key and
+            # signature lengths that occur
+            sender_public_key, signature = struct.unpack_from(
+                f'<{public_key_length}s{signature_length}s', buffer, offset)
+            offset += public_key_length + signature_length
+        except struct.error as error:
+            raise ValueError('The packed transaction is truncated') from error
+
+        transaction = Transaction(sender_hash, recipient_hash,
+                                  sender_public_key, amount, fee, nonce,
+                                  signature, txid)
+        return transaction, offset
+
+    def verify(self, sender_balance:int, sender_previous_nonce:int,
+               check_signature:bool = True) -> bool:
+        """
+        Verify that the transaction is valid. The signature check can be
+        skipped when the signature was already verified separately.
         """
         # sender and recipient validation
         if len(self.sender_hash) != 20:
@@ -40,7 +99,8 @@ class Transaction:
             raise ValueError('Invalid recipient hash')
 
         # validate the sender hash
-        if self.sender_hash != hashlib.sha1(self.sender_public_key).digest():
+        if not PUBLIC_KEY_CACHE.verify_sender_hash(self.sender_hash,
+                                                  self.sender_public_key):
             raise ValueError('The sender hash is not computed correctly')
 
         # amount validation
@@ -69,15 +129,33 @@ class Transaction:
         if self.txid != self.create_txid():
             raise ValueError('The transaction ID is invalid')
 
-        # validate the signature
+        # validate the signature unless the transaction id, which was
+        # verified above, is known to have a valid signature
+        if check_signature and not SIGNATURE_CACHE.contains(self.txid):
+            self.verify_signature()
+            SIGNATURE_CACHE.add(self.txid)
+
+        return True
+
+    def verify_signature(self) -> bool:
+        """
+        Verify the signature of the transaction. This does not depend on
+        the state of the sender.
+        """
         try:
-            sender_public_key = load_der_public_key(self.sender_public_key)
+            sender_public_key = PUBLIC_KEY_CACHE.load_public_key(
+                self.sender_hash, self.sender_public_key)
+            if sender_public_key is None:
+                raise ValueError('The sender hash is not computed correctly')
             sender_public_key.verify(
                 self.signature,
                 self.create_signature_hash(),
                 ec.ECDSA(utils.Prehashed(hashes.SHA256())))
         except InvalidSignature as invalid_signature:
             raise ValueError('The signature is invalid') from invalid_signature
+        except (UnsupportedAlgorithm, TypeError) as invalid_key:
+            # the key is not an elliptic curve key or uses an unsupported curve
+            raise ValueError('The sender public key is invalid') from invalid_key
 
         return True
 
@@ -8,7 +8,9 @@ import unittest
 import copy
 import hashlib
 from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from transactions import Transaction
 
 class InitialTransactionTests(unittest.TestCase):
@@ -386,6 +388,26 @@ class CourseworkTransactionTests(unittest.TestCase):
         with self.assertRaisesRegex(ValueError, 'The signature is invalid'):
             tx.verify(sender_balance=100, sender_previous_nonce=tx.nonce-1)
 
+    def test_rsa_public_key(self):
+        """
+        Generate a transaction signed with an RSA key. Check that transaction.verify raises
+        a ValueError rather than the TypeError of verifying with a key that is not an
+        elliptic curve key.
+        """
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        public_key = private_key.public_key().public_bytes(
+            encoding=Encoding.DER,
+            format=PublicFormat.SubjectPublicKeyInfo)
+
+        tx = self.create_valid_transaction(amount=50)
+        tx.sender_public_key = public_key
+        tx.sender_hash = hashlib.sha1(public_key).digest()
+        tx.signature = private_key.sign(tx.create_signature_hash(), padding.PKCS1v15(), hashes.SHA256())
+        tx.txid = tx.create_txid()
+
+        with self.assertRaisesRegex(ValueError, 'The sender public key is invalid'):
+            tx.verify(sender_balance=100, sender_previous_nonce=tx.nonce-1)
+
     def test_invalid_sender_balance(self):
         """
         Generate a valid transaction, check that transaction.verify raises an exception if either
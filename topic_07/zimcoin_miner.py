@@ -3,24 +3,67 @@ This module implements the Zimcoin miner functionality.
 """
 
 import os
+import json
+import hashlib
 import logging
+import threading
 import pyopencl as cl
 import numpy as np
-from blocks import Block
-from time import time
+from collections import deque
+from midstate import Midstate
+from mining_backend import MiningBackend, NONCE_LIMIT
+from mining_metrics import get_sink
+from time import sleep, perf_counter
 
+# the directory the compiled OpenCL program binaries are cached in
+PROGRAM_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'zimcoin')
 
-class ZimcoinMiner:
+# the size of the tail buffer, the final one or two chunks of the block
+# data that hold the nonce
+MAX_TAIL_SIZE = 128
+
+# the number of kernel launches kept in flight while mining
+PIPELINE_DEPTH = 2
+
+# the time to wait between polls of the result of the oldest launch
+POLL_INTERVAL = 0.001
+
+# the largest number of nonces tried by each work item when there is no
+# profile for the device
+WINDOW_SIZE = 1e5
+
+# the longest a kernel launch may run when the miner is tuned, as the
+# stop event and the cutoff time are only checked between launches
+TARGET_LATENCY = 0.1
+
+# the window sizes tried when the miner is tuned
+TUNE_WINDOW_SIZES = [1, 10, 100, 1_000, 10_000, 100_000]
+
+
+class ZimcoinMiner(MiningBackend):
     """
     Mine for Zimcoins using OpenCL.
     """
+    name = 'opencl'
+
     def __init__(self,
                  platform_id : int, device_id : int,
-                 window_size : int = 1e6,
-                 cutoff_time: int = None):
+                 window_size : int = None,
+                 cutoff_time: int = None,
+                 cache_dir : str = PROGRAM_CACHE_DIR,
+                 pipeline_depth : int = PIPELINE_DEPTH,
+                 global_size : int = None,
+                 local_size : int = None,
+                 use_profile : bool = True):
         """
-        Initialize the miner.
+        Initialize the miner. The OpenCL context, queue and program are
+        created once and reused for every block that is mined. The global,
+        local and window sizes that are not given are read from the
+        profile saved by tune for the device. Without a profile the window
+        size is calibrated so that a launch takes about TARGET_LATENCY.
         """
+        super().__init__(cutoff_time)
+
         # set the opencl platform and device
         self.platform_id = platform_id
         self.device_id = device_id
@@ -33,10 +76,13 @@ class ZimcoinMiner:
         ]
 
         # initialize the opencl context
-        self.cl_devices = cl.get_platforms()[self.platform_id].get_devices()
-        self.cl_context = cl.Context(self.cl_devices)
-        self.cl_queue = cl.CommandQueue(self.cl_context, self.cl_devices[self.device_id])
-        self.cl_device = self.cl_devices[self.device_id ]
+        self.cl_platform = cl.get_platforms()[self.platform_id]
+        self.cl_devices = self.cl_platform.get_devices()
+        self.cl_device = self.cl_devices[self.device_id]
+        self.cl_context = cl.Context([self.cl_device])
+        # the queue is profiled to record the time the kernel launches run
+        self.cl_queue = cl.CommandQueue(self.cl_context, self.cl_device,
+                                        properties=cl.command_queue_properties.PROFILING_ENABLE)
 
         # configure the number of threads to use
         self.cl_threads = self.cl_device.max_compute_units \
@@ -45,10 +91,57 @@ class ZimcoinMiner:
         if self.cl_device .type & 4 == 0:
             self.cl_threads = self.cl_device.max_work_group_size
 
-        # build the opencl program
+        # build the opencl program, or load it from the cache
+        self.cache_dir = cache_dir
+        self.program_from_cache = False
         self.cl_program = self.build_program()
 
-        self.cutoff_time = cutoff_time
+        # use the tuned sizes of the device unless they are given
+        self.local_size = None
+        self.profile = self.load_profile() if use_profile else None
+        if self.profile is not None:
+            self.cl_threads = self.profile['global_size']
+            self.local_size = self.profile['local_size']
+            self.window_size = self.profile['window_size']
+        if global_size is not None:
+            self.cl_threads = global_size
+        if local_size is not None:
+            self.local_size = local_size
+        if window_size is not None:
+            self.window_size = window_size
+        calibrate = self.window_size is None
+        if calibrate:
+            self.window_size = 1
+
+        self.pipeline_depth = pipeline_depth
+
+        # allocate the device buffers once for every block that is mined
+        self.allocate_buffers()
+        if calibrate:
+            self.calibrate()
+
+    def launch(self, seed : int, slot : int) -> cl.Event:
+        """
+        Queue a kernel launch from a seed and the read of its result into
+        one of the pipeline slots of host arrays. The event of the kernel
+        is kept in the slot to record the time it ran.
+
+        Returns:
+            pyopencl.Event: The event of the result read.
+        """
+        self.seeds[slot][0] = seed
+        cl.enqueue_copy(self.cl_queue, self.cl_seed, self.seeds[slot], is_blocking=False)
+        local_size = None if self.local_size is None else (self.local_size,)
+        self.kernel_events[slot] = cl.enqueue_nd_range_kernel(
+            self.cl_queue, self.cl_kernel, (self.thread_count,), local_size)
+        return cl.enqueue_copy(self.cl_queue, self.nonce_results[slot], self.cl_nonce, is_blocking=False)
+
+    @property
+    def device_name(self) -> str:
+        """
+        Get the name of the OpenCL platform and device.
+        """
+        return f'{self.cl_platform.name}: {self.cl_device.name}'
 
     @property
     def thread_count(self) -> int:
@@ -59,7 +152,9 @@ class ZimcoinMiner:
 
     def build_program(self, build_options=None) -> cl.Program:
         """
-        Build a program from an OpenCL source file.
+        Build a program from an OpenCL source file. The program binary is
+        cached on disk keyed by the source and the device, so it is only
+        compiled the first time a miner is created for a device.
 
         Parameters
         ----------
@@ -76,82 +171,338 @@ class ZimcoinMiner:
                 file_source = cl_file.read()
                 program_source += '\n' + file_source
 
-        program_source = cl.Program(self.cl_context, program_source)
-
-
         if build_options is None:
             build_options = []
 
-        self.cl_program = program_source.build(options=build_options)
+        # load the cached binary for the source and the device
+        cache_file = self.program_cache_file(program_source, build_options)
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'rb') as binary_file:
+                    binary = binary_file.read()
+                self.cl_program = cl.Program(self.cl_context, [self.cl_device], [binary]) \
+                    .build(options=build_options)
+                self.program_from_cache = True
+                return self.cl_program
+            except (cl.Error, OSError) as error:
+                logging.warning('Rebuilding the cached OpenCL program: %s', error)
+
+        self.cl_program = cl.Program(self.cl_context, program_source) \
+            .build(options=build_options)
+        self.program_from_cache = False
+
+        # cache the binary for the next miner
+        if cache_file is not None:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(cache_file + '.tmp', 'wb') as binary_file:
+                    binary_file.write(self.cl_program.binaries[0])
+                os.replace(cache_file + '.tmp', cache_file)
+            except OSError as error:
+                logging.warning('Could not cache the OpenCL program: %s', error)
 
         return self.cl_program
 
-    def mine(self, previous : bytes, height : int, miner : bytes,
-             transactions : list, timestamp : int,
-             difficulty : int) -> Block:
-        """
-        Mine for Zimcoins.
-        """
-        print(f'*** Mining: miner={miner.hex()}, difficulty={difficulty}, device={self.cl_device.name}')
-        
-        # create the block from the input data
-        input_block = Block(
-            previous=previous,
-            height=height,
-            miner=miner,
-            transactions=transactions,
-            timestamp=timestamp,
-            difficulty=difficulty,
-            block_id=None,
-            nonce=None)
-
-        # set up the variables for finding the nonce
-        block_data = np.frombuffer(input_block.to_bytes(), dtype=np.uint32)
-        block_data_len = np.int32(block_data.size) * 4
-
-        seed = np.ulonglong(0)
-
-        target = np.frombuffer(
-            input_block.calculate_target() \
-                .to_bytes(32, byteorder='big', signed=False),
+    def program_cache_file(self, program_source : str, build_options : list) -> str:
+        """
+        Get the file the program binary is cached in, or None if the
+        binary should not be cached.
+        """
+        if self.cache_dir is None:
+            return None
+
+        digest = hashlib.sha256()
+        for value in [program_source, ' '.join(build_options),
+                      self.cl_platform.name, self.cl_platform.version,
+                      self.cl_device.name, self.cl_device.driver_version]:
+            digest.update(value.encode('utf8'))
+            digest.update(b'\0')
+        return os.path.join(self.cache_dir, digest.hexdigest() + '.bin')
+
+    def profile_file(self) -> str:
+        """
+        Get the file the tuned sizes of the device are saved in, or None
+        if there is no cache directory.
+        """
+        if self.cache_dir is None:
+            return None
+
+        digest = hashlib.sha256()
+        for value in [self.cl_platform.name, self.cl_platform.version,
+                      self.cl_device.name, self.cl_device.driver_version]:
+            digest.update(value.encode('utf8'))
+            digest.update(b'\0')
+        return os.path.join(self.cache_dir, 'profile-' + digest.hexdigest() + '.json')
+
+    def load_profile(self) -> dict:
+        """
+        Load the tuned sizes of the device.
+
+        Returns:
+            dict: The global_size, local_size and window_size, and the
+                hashrate and latency they were measured with, or None if
+                the device was not tuned.
+        """
+        profile_file = self.profile_file()
+        if profile_file is None or not os.path.exists(profile_file):
+            return None
+
+        try:
+            with open(profile_file, 'r', encoding='utf8') as json_file:
+                profile = json.load(json_file)
+            return {key: profile[key] for key in
+                    ['global_size', 'local_size', 'window_size', 'hashrate', 'latency']}
+        except (OSError, ValueError, KeyError) as error:
+            logging.warning('Ignoring the mining profile %s: %s', profile_file, error)
+            return None
+
+    def save_profile(self, profile : dict):
+        """
+        Save the tuned sizes of the device, to be loaded by the next miner.
+        """
+        profile_file = self.profile_file()
+        if profile_file is None:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(profile_file + '.tmp', 'w', encoding='utf8') as json_file:
+            json.dump(profile, json_file, indent=2)
+        os.replace(profile_file + '.tmp', profile_file)
+
+    def configure(self, global_size : int, local_size : int, window_size : int):
+        """
+        Change the global, local and window sizes of the kernel launches.
+        """
+        self.cl_threads = global_size
+        self.local_size = local_size
+        self.window_size = window_size
+        cl.enqueue_copy(self.cl_queue, self.cl_window_size,
+                        np.array([window_size], dtype=np.uint32))
+
+    def tuning_grid(self) -> tuple:
+        """
+        Get the global and local sizes tried when the miner is tuned, based
+        on the compute units and work group size of the device.
+        """
+        compute_units = self.cl_device.max_compute_units
+        max_work_group_size = self.cl_device.max_work_group_size
+
+        global_sizes = sorted({compute_units * size for size in [64, 256, 1024, 4096]
+                               if size <= max_work_group_size * 4} | {self.cl_threads})
+        local_sizes = [None] + [size for size in [32, 64, 128, 256]
+                                if size <= max_work_group_size]
+        return global_sizes, local_sizes
+
+    def measure_latency(self) -> float:
+        """
+        Measure the time a single kernel launch takes.
+        """
+        start = perf_counter()
+        self.launch(0, 0).wait()
+        return perf_counter() - start
+
+    def write_unmined_template(self):
+        """
+        Write the template of a block that cannot be mined, so that every
+        launch tries all of its nonces when it is measured.
+        """
+        block = self.create_block(bytes(32), 0, bytes(20), [], 0, 2 ** 127)
+        self.write_template(bytes(block.to_bytes()), block.calculate_target())
+
+    def calibrate(self, max_latency : float = TARGET_LATENCY):
+        """
+        Choose the window size of a device without a profile from the
+        latency of a launch with a window of 1, so that the stop event and
+        the cutoff time are checked about every max_latency seconds. The
+        window is capped at WINDOW_SIZE.
+        """
+        self.write_unmined_template()
+        self.configure(self.cl_threads, self.local_size, 1)
+
+        # the first launch warms up the device
+        self.measure_latency()
+        latency = self.measure_latency()
+        window_size = int(min(max(max_latency / max(latency, 1e-9), 1), WINDOW_SIZE))
+        self.configure(self.cl_threads, self.local_size, window_size)
+
+    def tune(self, max_latency : float = TARGET_LATENCY,
+             global_sizes : list = None, local_sizes : list = None,
+             window_sizes : list = None, save : bool = True) -> list:
+        """
+        Measure the hashrate of a grid of global, local and window sizes on
+        a block that cannot be mined, and use the sizes with the highest
+        hashrate whose launches take at most the maximum latency. The sizes
+        are saved as the profile of the device.
+
+        Parameters:
+            max_latency (float): The longest a launch may take in seconds.
+            global_sizes (list): The global sizes to try.
+            local_sizes (list): The local sizes to try, None lets the
+                OpenCL implementation choose.
+            window_sizes (list): The window sizes to try.
+            save (bool): Save the best sizes as the profile of the device.
+
+        Returns:
+            list: The (global_size, local_size, window_size, hashrate,
+                latency) of every measured combination.
+        """
+        default_global_sizes, default_local_sizes = self.tuning_grid()
+        global_sizes = global_sizes or default_global_sizes
+        local_sizes = local_sizes or default_local_sizes
+        window_sizes = sorted(window_sizes or TUNE_WINDOW_SIZES)
+
+        self.write_unmined_template()
+
+        results = []
+        best = None
+        for global_size in global_sizes:
+            for local_size in local_sizes:
+                if local_size is not None and global_size % local_size != 0:
+                    continue
+                for window_size in window_sizes:
+                    self.configure(global_size, local_size, window_size)
+                    try:
+                        # the first launch warms up the device
+                        self.measure_latency()
+                        latency = self.measure_latency()
+                    except cl.Error as error:
+                        logging.warning('Skipping the sizes %d, %s: %s', global_size, local_size, error)
+                        break
+
+                    hashrate = global_size * window_size / latency
+                    results.append((global_size, local_size, window_size, hashrate, latency))
+                    if latency > max_latency:
+                        # larger windows only take longer
+                        break
+                    if best is None or hashrate > best['hashrate']:
+                        best = dict(global_size=global_size, local_size=local_size,
+                                    window_size=window_size, hashrate=hashrate,
+                                    latency=latency)
+
+        # fall back to the fastest launch if none are within the latency
+        if best is None:
+            fastest = min(results, key=lambda result: result[4])
+            best = dict(zip(['global_size', 'local_size', 'window_size', 'hashrate', 'latency'],
+                            fastest))
+
+        self.configure(best['global_size'], best['local_size'], best['window_size'])
+        self.profile = best
+        if save:
+            self.save_profile(best)
+        return results
+
+    def allocate_buffers(self):
+        """
+        Allocate the device buffers and the host arrays they are copied
+        from and to, and bind them to the mining kernel.
+        """
+        mem_flags = cl.mem_flags
+
+        # the host arrays are kept alive while copies to or from them run
+        self.seeds = [np.zeros(shape=1, dtype=np.ulonglong) for _ in range(self.pipeline_depth)]
+        self.tail_info = np.zeros(shape=2, dtype=np.int32)
+        self.no_nonce = np.zeros(shape=1, dtype=np.ulonglong)
+        self.nonce_results = [np.zeros(shape=1, dtype=np.ulonglong) for _ in range(self.pipeline_depth)]
+        self.kernel_events = [None] * self.pipeline_depth
+
+        self.cl_window_size = cl.Buffer(self.cl_context, mem_flags.READ_ONLY | mem_flags.COPY_HOST_PTR,
+                                        hostbuf=np.array([self.window_size], dtype=np.uint32))
+        self.cl_seed = cl.Buffer(self.cl_context, mem_flags.READ_ONLY, self.seeds[0].nbytes)
+        self.cl_midstate = cl.Buffer(self.cl_context, mem_flags.READ_ONLY, 32)
+        self.cl_tail = cl.Buffer(self.cl_context, mem_flags.READ_ONLY, MAX_TAIL_SIZE)
+        self.cl_tail_info = cl.Buffer(self.cl_context, mem_flags.READ_ONLY, self.tail_info.nbytes)
+        self.cl_nonce = cl.Buffer(self.cl_context, mem_flags.READ_WRITE, self.no_nonce.nbytes)
+        self.cl_target = cl.Buffer(self.cl_context, mem_flags.READ_ONLY, 32)
+
+        self.cl_kernel = self.cl_program.mine_midstate
+        self.cl_kernel.set_args(
+            self.cl_seed,
+            self.cl_window_size,
+            self.cl_midstate,
+            self.cl_tail,
+            self.cl_tail_info,
+            self.cl_nonce,
+            self.cl_target)
+
+    def write_template(self, block_data : bytes, target : int):
+        """
+        Copy the midstate of the block data, its final chunks and the
+        target to the device and clear the nonce found for the previous
+        block.
+        """
+        midstate = Midstate(block_data)
+        midstate_words = np.array(midstate.state, dtype=np.uint32)
+        tail_words = np.frombuffer(midstate.tail, dtype='>u4').astype(np.uint32)
+        self.tail_info[0] = tail_words.size
+        self.tail_info[1] = midstate.nonce_offset
+
+        target_words = np.frombuffer(
+            target.to_bytes(32, byteorder='big', signed=False),
             np.uint32)
 
-        nonce = np.zeros(shape=1, dtype=np.ulonglong)
-
-        # allocate the memory for the variables on the device
-        cl_window_size = cl.Buffer(self.cl_context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=np.uint32(self.window_size))
-        cl_block_data = cl.Buffer(self.cl_context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=block_data)
-        cl_block_data_len = cl.Buffer(self.cl_context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=block_data_len)
-        cl_nonce = cl.Buffer(self.cl_context, cl.mem_flags.WRITE_ONLY, nonce.nbytes)
-        cl_target = cl.Buffer(self.cl_context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=target)
-
-        # search for a valid nonce
-        while (nonce[0] == 0) and (self.cutoff_time is None or time() < self.cutoff_time):
-        #while (nonce[0] == 0):
-            print('**** Starting Iteration')
-            cl_seed = cl.Buffer(self.cl_context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=seed)
-
-            # execute the kernel
-            self.cl_program.mine_sequential(
-                self.cl_queue, (self.thread_count,), None,
-                cl_seed,
-                cl_window_size,
-                cl_block_data,
-                cl_block_data_len,
-                cl_nonce,
-                cl_target,
-                None)
-
-            # get the results
-            cl.enqueue_copy(self.cl_queue, nonce, cl_nonce)
-
-            seed = np.ulonglong(seed + self.thread_count * self.window_size)
-
-        # update the block with the nonce
-        input_block.nonce = int.from_bytes(nonce[0].tobytes(), byteorder='little')
-        input_block.block_id = input_block.calculate_block_id()
-
-        print(f'*** Found block nonce: {input_block.nonce }')
-
-        # return the block
-        return input_block
+        cl.enqueue_copy(self.cl_queue, self.cl_midstate, midstate_words)
+        cl.enqueue_copy(self.cl_queue, self.cl_tail, tail_words)
+        cl.enqueue_copy(self.cl_queue, self.cl_tail_info, self.tail_info)
+        cl.enqueue_copy(self.cl_queue, self.cl_target, target_words)
+        cl.enqueue_copy(self.cl_queue, self.cl_nonce, self.no_nonce)
+
+    def kernel_seconds(self, slot : int) -> float:
+        """
+        Get the time the last kernel launch of a pipeline slot ran on the
+        device, from the profiling information of its event.
+        """
+        profile = self.kernel_events[slot].profile
+        return (profile.end - profile.start) * 1e-9
+
+    def search(self, block_data : bytes, target : int,
+               cutoff_time : float = None, stop_event : threading.Event = None,
+               start_nonce : int = 0, end_nonce : int = NONCE_LIMIT) -> int:
+        """
+        Search the nonces of the block data on the device. Only whole
+        launches that fit in the nonce range are run.
+        """
+        self.write_template(block_data, target)
+
+        # keep several launches on consecutive seed ranges in flight and
+        # poll the result of the oldest one without blocking
+        launch_size = self.thread_count * int(self.window_size)
+        seed = start_nonce
+        in_flight = deque()
+        for slot in range(self.pipeline_depth):
+            if seed + launch_size > end_nonce:
+                break
+            in_flight.append((slot, self.launch(seed, slot)))
+            seed += launch_size
+
+        nonce = 0
+        self.hash_count = 0
+        sink = get_sink()
+        labels = dict(device=self.device_name)
+        while len(in_flight) > 0:
+            stopped = self.is_stopped(cutoff_time, stop_event)
+
+            slot, read_event = in_flight[0]
+            if read_event.command_execution_status != cl.command_execution_status.COMPLETE:
+                if stopped:
+                    break
+                sleep(POLL_INTERVAL)
+                continue
+
+            # the host time of an iteration is spent reading the result of a
+            # launch and queueing the next one
+            host_start = perf_counter()
+            in_flight.popleft()
+            self.hash_count += launch_size
+            sink.observe('zimcoin_kernel_seconds', self.kernel_seconds(slot), labels)
+            nonce = int(self.nonce_results[slot][0])
+            if nonce == 0 and not stopped and seed + launch_size <= end_nonce:
+                in_flight.append((slot, self.launch(seed, slot)))
+                seed += launch_size
+            sink.observe('zimcoin_host_seconds', perf_counter() - host_start, labels)
+            if nonce != 0 or stopped:
+                break
+
+        # the launches still in flight are not waited for, they return as
+        # soon as they see the nonce and the in-order queue runs them before
+        # the buffers are written for the next block
+        return nonce
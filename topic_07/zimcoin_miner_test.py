@@ -0,0 +1,125 @@
+"""
+This module implements the tests for the OpenCL miner.
+"""
+
+import tempfile
+import threading
+import unittest
+from time import time
+from miner_helper import get_miner, mine_block
+from mining_metrics import InProcessMetrics, get_sink, set_sink
+from zimcoin_miner import ZimcoinMiner, TARGET_LATENCY, WINDOW_SIZE
+
+MINER_ADDRESS = bytes.fromhex("3df8f04b3c159fdc6631c4b8b0874940344d173d")
+
+
+class ZimcoinMinerTest(unittest.TestCase):
+    """
+    Test the OpenCL miner.
+    """
+    def test_program_cache(self):
+        """
+        Verify that the program binary is cached and loaded by the next
+        miner for the device.
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = ZimcoinMiner(0, 0, window_size=1000, cache_dir=cache_dir)
+            self.assertFalse(first.program_from_cache)
+
+            second = ZimcoinMiner(0, 0, window_size=1000, cache_dir=cache_dir)
+            self.assertTrue(second.program_from_cache)
+
+            block = second.mine(bytes(32), 0, MINER_ADDRESS, [], int(time()), 1000)
+            self.assertTrue(block.verify_proof_of_work())
+
+    def test_tune(self):
+        """
+        Verify that the best sizes within the latency are saved and loaded
+        by the next miner for the device, unless they are overridden.
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            miner = ZimcoinMiner(0, 0, cache_dir=cache_dir)
+            results = miner.tune(max_latency=1.0, global_sizes=[64, 128], local_sizes=[None, 32],
+                                 window_sizes=[1, 10])
+            self.assertEqual(len(results), 8)
+
+            best = max((result for result in results if result[4] <= 1.0), key=lambda result: result[3])
+            self.assertEqual(miner.profile['hashrate'], best[3])
+            self.assertEqual((miner.thread_count, miner.local_size, miner.window_size), best[:3])
+
+            tuned = ZimcoinMiner(0, 0, cache_dir=cache_dir)
+            self.assertEqual((tuned.thread_count, tuned.local_size, tuned.window_size), best[:3])
+            block = tuned.mine(bytes(32), 0, MINER_ADDRESS, [], int(time()), 1000)
+            self.assertTrue(block.verify_proof_of_work())
+
+            overridden = ZimcoinMiner(0, 0, window_size=1000, cache_dir=cache_dir)
+            self.assertEqual(overridden.window_size, 1000)
+            self.assertEqual(overridden.thread_count, best[0])
+
+    def test_calibrate(self):
+        """
+        Verify that a device without a profile gets a window size whose
+        launches take about the target latency.
+        """
+        miner = ZimcoinMiner(0, 0, use_profile=False)
+        self.assertGreaterEqual(miner.window_size, 1)
+        self.assertLessEqual(miner.window_size, WINDOW_SIZE)
+        self.assertLess(miner.measure_latency(), 10 * TARGET_LATENCY)
+
+        block = miner.mine(bytes(32), 0, MINER_ADDRESS, [], int(time()), 1000, time() + 30)
+        self.assertTrue(block.verify_proof_of_work())
+
+    def test_reused_miner(self):
+        """
+        Verify that the same miner mines consecutive blocks.
+        """
+        miner = get_miner()
+        self.assertIs(get_miner(), miner)
+
+        previous = bytes(32)
+        for height in range(3):
+            block = mine_block(previous, height, MINER_ADDRESS, [], int(time()), 1000, time() + 30)
+            self.assertTrue(block.verify_proof_of_work())
+            previous = block.block_id
+
+    def test_stop_event(self):
+        """
+        Verify that setting the stop event abandons a block that cannot be
+        found.
+        """
+        miner = ZimcoinMiner(0, 0, window_size=1)
+        stop_event = threading.Event()
+        threading.Timer(0.2, stop_event.set).start()
+
+        start = time()
+        block = miner.mine(bytes(32), 0, MINER_ADDRESS, [], int(time()), 2 ** 127,
+                           stop_event=stop_event)
+        self.assertEqual(block.nonce, 0)
+        self.assertLess(time() - start, 10)
+
+    def test_metrics(self):
+        """
+        Verify that the kernel and host time of every launch are recorded.
+        """
+        sink = InProcessMetrics()
+        default_sink = get_sink()
+        set_sink(sink)
+        try:
+            miner = ZimcoinMiner(0, 0, window_size=1, global_size=64, local_size=None,
+                                 use_profile=False)
+            block = miner.mine(bytes(32), 0, MINER_ADDRESS, [], int(time()), 1000, time() + 30)
+        finally:
+            set_sink(default_sink)
+        self.assertTrue(block.verify_proof_of_work())
+
+        labels = dict(device=miner.device_name)
+        launches = miner.hash_count // 64
+        self.assertEqual(sink.get_summary('zimcoin_kernel_seconds', labels)[0], launches)
+        self.assertGreater(sink.get_summary('zimcoin_kernel_seconds', labels)[1], 0)
+        self.assertEqual(sink.get_summary('zimcoin_host_seconds', labels)[0], launches)
+        self.assertEqual(sink.get('zimcoin_mining_searches_total',
+                                  dict(backend='opencl', result='found')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)